@@ -0,0 +1,279 @@
+'''
+Summaries of Multiple Image Analysis results over time
+
+Results are reduced to running totals per calendar month (MonthlyAggregates): class counts and the
+number of times each diameter occurs. Diameters come from contour areas (whole or half pixels) and the mm
+per pixel, so the distinct diameters of a month are bounded by the possible spot sizes, not by the number
+of results, and the totals can be built from chunks of files larger than memory and merged. Means and
+percentiles are computed from the exact diameters.
+PeriodSummary groups the months into months, quarters or years for the Time Series Analysis page:
+
+    aggregates = aggregate_results(iter_results_chunks(files))
+    summary = PeriodSummary(aggregates)
+    summary.classification('Quarter')       # one row per quarter
+    summary.diameter('Year')
+'''
+
+import numpy as np
+import pandas as pd
+
+# Time groupings offered on the analysis pages, and the matching pandas period frequencies
+PERIOD_FREQS = {'Month': 'M', 'Quarter': 'Q', 'Year': 'Y'}
+
+# Months in each time grouping
+PERIOD_MONTHS = {'Month': 1, 'Quarter': 3, 'Year': 12}
+
+# DBS smaller than this equivalent diameter (mm) are insufficient
+MIN_DIAMETER_MM = 8
+
+# Month code of results without a datetime. They count in totals but not in any period
+UNDATED = -1
+
+# Counts kept for each month
+CLASS_COLUMNS = ['total', 'acceptable', 'small', 'multispotted']
+
+
+def dbs_classes(df):
+    '''
+    Boolean arrays (acceptable, small, multispotted) classifying each DBS in a results DataFrame.
+    DBS with no diameter are in none of the classes
+    '''
+
+    diam = df['equiv_diam_mm'].to_numpy(dtype=float)
+    multispot = (df['pred_multi'] == '0304').to_numpy(dtype=bool)
+    controls = (df['pred_multi'] == 'controls').to_numpy(dtype=bool)
+
+    # comparisons with NaN are False, as in the pandas comparisons they replace
+    with np.errstate(invalid='ignore'):
+        large = diam >= MIN_DIAMETER_MM
+        small = diam < MIN_DIAMETER_MM
+
+    return controls & large, small, multispot & large
+
+
+def month_codes(datetimes):
+    ''' Months since year 0 of a datetime Series, UNDATED where the datetime is missing
+    '''
+
+    codes = np.full(len(datetimes), UNDATED, dtype=np.int64)
+    dated = datetimes.notna().to_numpy()
+    codes[dated] = datetimes[dated].dt.year.to_numpy() * 12 + datetimes[dated].dt.month.to_numpy() - 1
+    return codes
+
+
+class MonthlyAggregates:
+    '''
+    Running totals of results for each calendar month
+
+    classes: DataFrame indexed by month code with the number of results and of acceptable, small and
+             multispotted DBS (CLASS_COLUMNS)
+    diameters: Series indexed by (month code, diameter in mm) with the number of results of that diameter
+    '''
+
+    def __init__(self):
+        self.classes = pd.DataFrame(columns=CLASS_COLUMNS, dtype=np.int64)
+        self.diameters = pd.Series(dtype=np.int64, index=pd.MultiIndex.from_arrays(
+            [np.zeros(0, dtype=np.int64), np.zeros(0, dtype=float)], names=['month', 'diameter']))
+
+    def __len__(self):
+        return int(self.classes['total'].sum())
+
+    def add(self, df):
+        '''
+        Add a chunk of results with datetime, equiv_diam_mm and pred_multi columns
+        '''
+
+        months = month_codes(df['datetime'])
+        acceptable, small, multispot = dbs_classes(df)
+
+        classes = pd.DataFrame({'total': 1, 'acceptable': acceptable, 'small': small, 'multispotted': multispot},
+                               index=months, columns=CLASS_COLUMNS).astype(np.int64).groupby(level=0).sum()
+
+        diam = df['equiv_diam_mm'].to_numpy(dtype=float)
+        measured = ~np.isnan(diam)
+        diameters = pd.Series(1, index=pd.MultiIndex.from_arrays([months[measured], diam[measured]],
+                                                                 names=['month', 'diameter']))
+        diameters = diameters.groupby(level=[0, 1]).sum()
+
+        self._combine(classes, diameters)
+        return self
+
+    def merge(self, other):
+        ''' Add the totals of other MonthlyAggregates
+        '''
+        self._combine(other.classes, other.diameters)
+        return self
+
+    def _combine(self, classes, diameters):
+        # both are bounded by the number of months and distinct diameters, so combining does not grow with
+        # the results
+        self.classes = self.classes.add(classes, fill_value=0).astype(np.int64).sort_index()
+        self.diameters = pd.concat([self.diameters, diameters]).groupby(level=[0, 1]).sum().astype(np.int64)
+
+    def totals(self):
+        ''' Dict of CLASS_COLUMNS counts over all months, including undated results
+        '''
+        return {column: int(self.classes[column].sum()) for column in CLASS_COLUMNS}
+
+    def distribution(self):
+        ''' ecdf.ECDF of the diameters of all results, including undated results
+        '''
+
+        # imported here as ecdf depends on this module
+        from ecdf import ECDF
+
+        counts = self.diameters.groupby(level='diameter').sum()
+        return ECDF(counts.index.to_numpy(), counts.to_numpy())
+
+
+# Columns kept for the first punch of each sample
+_FIRST_PUNCH_COLUMNS = ['sample_id', 'datetime', 'equiv_diam_mm', 'pred_multi']
+
+
+def _punch_order(df):
+    # datetime of each row as an integer, rows without a datetime last
+    order = df['datetime'].astype('datetime64[us]').to_numpy().view(np.int64).copy()
+    order[df['datetime'].isna().to_numpy()] = np.iinfo(np.int64).max
+    return order
+
+
+def _first_punch_rows(df):
+    # earliest punch of each sample. Rows without a datetime count as latest, ties keep the row read first
+    # (idxmin returns the first of equal values)
+    df = df.reset_index(drop=True)
+    first = pd.Series(_punch_order(df)).groupby(df['sample_id'].to_numpy(), sort=False, dropna=False).idxmin()
+    return df.loc[np.sort(first.to_numpy())].reset_index(drop=True)
+
+
+def aggregate_results(chunks, first_punch=False):
+    '''
+    MonthlyAggregates of results read in chunks (see results_io.iter_results_chunks)
+
+    first_punch: only count the first punch of each sample ID. The earliest row of each sample seen so
+                 far is kept while reading and merged with the earliest rows of each chunk, so memory
+                 grows with the number of samples, not rows
+    '''
+
+    aggregates = MonthlyAggregates()
+    first = None
+
+    for chunk in chunks:
+        if not first_punch:
+            aggregates.add(chunk)
+            continue
+
+        chunk = _first_punch_rows(chunk[[column for column in _FIRST_PUNCH_COLUMNS if column in chunk.columns]])
+        first = chunk if first is None else _first_punch_rows(pd.concat([first, chunk], ignore_index=True))
+
+    if first is not None:
+        aggregates.add(first)
+
+    return aggregates
+
+
+class PeriodSummary:
+    '''
+    Classification and diameter summaries of MonthlyAggregates grouped by month, quarter or year.
+    Results without a datetime are left out
+    '''
+
+    def __init__(self, aggregates):
+        self.aggregates = aggregates
+        self._periods = {}
+        self._ecdfs = {}
+
+    def _dated(self, grouping):
+        # class counts of the dated months, and the period key of each
+        classes = self.aggregates.classes
+        classes = classes[classes.index != UNDATED]
+        return classes, classes.index.to_numpy(dtype=np.int64) // PERIOD_MONTHS[grouping]
+
+    def periods(self, grouping):
+        '''
+        DataFrame of the periods of a grouping ('Month', 'Quarter' or 'Year') with any results, in order.
+        Columns: key (months since year 0 divided by the months in a period), period_start (timestamp)
+        and label (e.g. '2024-01', '2024Q1' or '2024')
+        '''
+
+        if grouping not in self._periods:
+            keys = np.unique(self._dated(grouping)[1])
+
+            starts = keys * PERIOD_MONTHS[grouping]
+            period_start = pd.to_datetime(pd.DataFrame({'year': starts // 12, 'month': starts % 12 + 1, 'day': 1}))
+
+            self._periods[grouping] = pd.DataFrame({
+                'key': keys,
+                'period_start': period_start.astype('datetime64[us]').to_numpy(),
+                'label': period_start.dt.to_period(PERIOD_FREQS[grouping]).astype(str).to_numpy(),
+            })
+
+        return self._periods[grouping]
+
+    def _class_counts(self, grouping):
+        # CLASS_COLUMNS counts of each period, in the order of periods(grouping)
+        classes, keys = self._dated(grouping)
+        sums = classes.groupby(keys).sum()
+        return [sums[column].to_numpy() for column in CLASS_COLUMNS]
+
+    def counts(self, grouping):
+        ''' Number of results in each period, in the order of periods(grouping)
+        '''
+        return self._class_counts(grouping)[0]
+
+    def classification(self, grouping):
+        '''
+        Total DBS and percentages of acceptable, small (< 8 mm) and multispotted DBS in each period
+        '''
+
+        total, acceptable, small, multispot = self._class_counts(grouping)
+
+        return pd.DataFrame({
+            'period': self.periods(grouping)['period_start'],
+            'Total DBS': total.astype(float),
+            'Acceptable DBS (%)': (acceptable / total) * 100,
+            'Small DBS (<8mm) (%)': (small / total) * 100,
+            'Multispotted DBS (%)': (multispot / total) * 100,
+        })
+
+    def diameter(self, grouping):
+        '''
+        Mean, median and interquartile range of the DBS diameter, and the number of results, in each period
+        '''
+
+        ecdfs = list(self.ecdfs(grouping).values())
+
+        return pd.DataFrame({
+            'period': self.periods(grouping)['period_start'],
+            'Mean Diameter (mm)': np.array([e.mean() for e in ecdfs], dtype=float),
+            'Median Diameter (mm)': np.array([e.median() for e in ecdfs], dtype=float),
+            '25th Percentile (mm)': np.array([e.quantile(0.25) for e in ecdfs], dtype=float),
+            '75th Percentile (mm)': np.array([e.quantile(0.75) for e in ecdfs], dtype=float),
+            'Count': self.counts(grouping).astype(float),
+        })
+
+    def ecdfs(self, grouping):
+        '''
+        Dict of period label to ecdf.ECDF of the diameters in that period, in the order of periods(grouping).
+        Kept for later calls
+        '''
+
+        # imported here as ecdf depends on this module
+        from ecdf import ECDF
+
+        if grouping not in self._ecdfs:
+            diameters = self.aggregates.diameters
+            months = diameters.index.get_level_values('month').to_numpy(dtype=np.int64)
+            dated = months != UNDATED
+
+            counts = pd.Series(diameters.to_numpy()[dated], index=pd.MultiIndex.from_arrays(
+                [months[dated] // PERIOD_MONTHS[grouping], diameters.index.get_level_values('diameter')[dated]]))
+            counts = counts.groupby(level=[0, 1]).sum()
+
+            by_key = {key: ECDF(group.index.get_level_values(1).to_numpy(), group.to_numpy())
+                      for key, group in counts.groupby(level=0)}
+
+            periods = self.periods(grouping)
+            self._ecdfs[grouping] = {label: by_key.get(key, ECDF([]))
+                                     for key, label in zip(periods['key'], periods['label'])}
+
+        return self._ecdfs[grouping]
@@ -0,0 +1,488 @@
+import io
+import os
+import glob
+import queue
+import struct
+import itertools
+import threading
+import contextvars
+import zipfile
+import multiprocessing
+from collections import deque, Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+import profiling
+from functions import (
+    spot_metrics_image_pixels,
+    spot_metrics_decoded_pixels,
+    decode_image,
+    scale_spot_metrics,
+    IMAGE_EXTENSIONS
+)
+from result_cache import params_fingerprint
+
+# Number of images sent to a worker process at a time when no chunksize is given.
+# Larger chunks reduce inter-process overhead, smaller chunks balance load better.
+DEFAULT_CHUNKSIZE = 8
+
+# Number of chunks queued per worker process. Only this many chunks are held in memory at once,
+# so images are read lazily from the input iterable as results are consumed
+CHUNKS_PER_WORKER = 2
+
+# Below this many images starting worker processes costs more than it saves
+PARALLEL_MIN_IMAGES = 64
+
+# Start method of the worker processes. They are not forked, as the calling process may be running other
+# threads (e.g. the Streamlit server) and a forked child inherits their locks in whatever state they are in
+POOL_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# Decoded images queued for the analysis threads of the threaded pipeline. The decode thread waits
+# when the queue is full, so decoding does not run ahead of analysis
+DECODE_QUEUE_SIZE = 4
+
+# Detection parameters for the current worker process, and whether to record profiling spans,
+# set once by _init_worker
+_worker_params = None
+_worker_trace = False
+
+
+def analyse_image(name, data, params):
+    '''
+    Detect and measure blood spots in one encoded image, capturing any error
+
+    params: dict of keyword arguments for functions.spot_metrics_image_pixels
+            (x_min, x_max, y_min, y_max, center, radius, profile, select_punched, mode)
+
+    Returns (name, spot_metrics in pixel units, image width, error). error is None on success,
+    otherwise a description of the failure and spot_metrics is an empty list
+    '''
+
+    try:
+        with profiling.span('image', file=name):
+            spot_met_pixels, width = spot_metrics_image_pixels(data, **params)
+    except Exception as e:
+        return name, [], None, f"{type(e).__name__}: {e}"
+
+    return name, spot_met_pixels, width, None
+
+
+def analyse_decoded_image(name, img, params):
+    '''
+    As analyse_image, for an image that has already been decoded (see functions.decode_image)
+    '''
+
+    try:
+        with profiling.span('image', file=name):
+            spot_met_pixels, width = spot_metrics_decoded_pixels(img, **params)
+    except Exception as e:
+        return name, [], None, f"{type(e).__name__}: {e}"
+
+    return name, spot_met_pixels, width, None
+
+
+def _init_worker(params, trace=False):
+    ''' Store the detection parameters in the worker so they are not pickled with every image
+    '''
+    global _worker_params, _worker_trace
+    _worker_params = params
+    _worker_trace = trace
+
+
+def _analyse_chunk_in_worker(chunk):
+    # returns (results, profiling spans recorded while analysing the chunk)
+    if not _worker_trace:
+        return [analyse_image(name, data, _worker_params) for name, data in chunk], []
+
+    events = []
+    with profiling.capture(events.append):
+        results = [analyse_image(name, data, _worker_params) for name, data in chunk]
+    return results, events
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _lookup(cache, fingerprint, name, data):
+    # returns (cache key, cached result or None)
+    if cache is None:
+        return None, None
+
+    with profiling.span('cache.lookup'):
+        key = cache.key(data, fingerprint)
+        cached = cache.get(key)
+
+    if cached is None:
+        return key, None
+
+    spot_met_pixels, width = cached
+    return key, (name, spot_met_pixels, width, None)
+
+
+def _store(cache, key, result):
+    name, spot_met_pixels, width, error = result
+
+    # failures are not cached so they are retried next time
+    if cache is not None and error is None:
+        with profiling.span('cache.store'):
+            cache.put(key, spot_met_pixels, width)
+
+
+# marks the end of the input in the queues of the threaded pipeline
+_END = object()
+
+
+def _start_thread(target):
+    # threads run in a copy of the current context, so profiling captures include their spans
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(target,), daemon=True)
+    thread.start()
+    return thread
+
+
+def _iter_threaded_pixel_results(images, params, n_threads, cache):
+    '''
+    Threaded pipeline: one thread reads, looks up and decodes images, n_threads threads detect and measure
+    them. cv2.imdecode and most of the detection release the GIL, so decoding the next image overlaps with
+    the analysis of the current one. Results are yielded in input order
+    '''
+
+    fingerprint = params_fingerprint(params) if cache is not None else None
+
+    decoded = queue.Queue(maxsize=DECODE_QUEUE_SIZE)
+    finished = queue.Queue()
+
+    # images between being read and being yielded. The decode thread waits for a slot before reading
+    # an image, so finished results do not pile up if the consumer is slow
+    slots = threading.Semaphore(DECODE_QUEUE_SIZE + 2 * n_threads)
+    stop = threading.Event()
+
+    def decode_stage():
+        n_images = 0
+        try:
+            for index, (name, data) in enumerate(images):
+                while not slots.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                if stop.is_set():
+                    return
+                n_images = index + 1
+
+                key, result = _lookup(cache, fingerprint, name, data)
+                if result is not None:
+                    finished.put((index, key, result))
+                    continue
+
+                try:
+                    img = decode_image(data)
+                except Exception as e:
+                    finished.put((index, key, (name, [], None, f"{type(e).__name__}: {e}")))
+                    continue
+
+                decoded.put((index, key, name, img))
+        except BaseException as e:
+            # errors reading the input are raised in the consumer
+            finished.put((None, None, e))
+        else:
+            finished.put((n_images, None, _END))
+        finally:
+            for _ in range(n_threads):
+                decoded.put(_END)
+
+    def analysis_stage():
+        while True:
+            item = decoded.get()
+            if item is _END:
+                return
+            index, key, name, img = item
+            if not stop.is_set():
+                finished.put((index, key, analyse_decoded_image(name, img, params)))
+
+    threads = [_start_thread(decode_stage)] + [_start_thread(analysis_stage) for _ in range(n_threads)]
+
+    try:
+        waiting = {}
+        next_index = 0
+        n_images = None
+
+        while n_images is None or next_index < n_images:
+            index, key, result = finished.get()
+            if result is _END:
+                n_images = index
+            elif index is None:
+                raise result
+            else:
+                waiting[index] = (key, result)
+
+            while next_index in waiting:
+                key, result = waiting.pop(next_index)
+                _store(cache, key, result)
+                yield result
+                slots.release()
+                next_index += 1
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def _iter_pixel_results(images, params, n_workers, chunksize, cache, n_threads=0):
+    fingerprint = params_fingerprint(params) if cache is not None else None
+
+    if n_workers == 1 and n_threads:
+        yield from _iter_threaded_pixel_results(images, params, n_threads, cache)
+        return
+
+    if n_workers == 1:
+        for name, data in images:
+            key, result = _lookup(cache, fingerprint, name, data)
+            if result is None:
+                result = analyse_image(name, data, params)
+                _store(cache, key, result)
+            yield result
+        return
+
+    max_pending = n_workers * CHUNKS_PER_WORKER
+
+    # spans recorded in the workers are sent back with the results
+    initargs = (params, profiling.enabled())
+
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context(POOL_START_METHOD),
+                             initializer=_init_worker, initargs=initargs) as executor:
+        # each entry is (cache keys, results with None for images sent to a worker, future or None)
+        pending = deque()
+
+        def collect_oldest():
+            keys, results, future = pending.popleft()
+            computed = iter(())
+            if future is not None:
+                computed, events = future.result()
+                profiling.emit(events)
+                computed = iter(computed)
+            for key, result in zip(keys, results):
+                if result is None:
+                    result = next(computed)
+                    _store(cache, key, result)
+                yield result
+
+        for chunk in _chunks(images, chunksize):
+            keys, results, misses = [], [], []
+
+            for name, data in chunk:
+                key, result = _lookup(cache, fingerprint, name, data)
+                keys.append(key)
+                results.append(result)
+                if result is None:
+                    misses.append((name, data))
+
+            future = executor.submit(_analyse_chunk_in_worker, misses) if misses else None
+            pending.append((keys, results, future))
+
+            # yield finished chunks from the front, keeping results in input order. Wait for the oldest
+            # chunk before reading more images once max_pending chunks are in flight
+            while pending and (len(pending) >= max_pending or pending[0][2] is None or pending[0][2].done()):
+                yield from collect_oldest()
+
+        while pending:
+            yield from collect_oldest()
+
+
+def analyse_images(images, params, mm_per_pix, n_workers=1, chunksize=None, cache=None, n_threads=0):
+    '''
+    Detect and measure blood spots in many encoded images
+
+    images: iterable of (name, encoded image bytes), consumed lazily
+    params: detection parameters, see analyse_image
+    mm_per_pix: mm per pixel used to convert the metrics to mm
+    n_workers: number of worker processes. 1 runs in the current process, None uses all cores
+    chunksize: number of images submitted to a worker at a time (default DEFAULT_CHUNKSIZE)
+    cache: optional result_cache.ResultCache. Images found in the cache are not decoded or analysed,
+           and new results are added to it
+    n_threads: number of analysis threads when n_workers is 1. 0 analyses images in the calling thread,
+               otherwise images are decoded in a separate thread ahead of the analysis threads
+               (see _iter_threaded_pixel_results). None uses one thread per core
+
+    Yields (name, spot_metrics, image width, error) for each image in the same order as images,
+    regardless of the order in which workers finish. At most CHUNKS_PER_WORKER chunks per worker
+    are in flight, so memory use does not grow with the number of images
+    '''
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+
+    if n_threads is None:
+        n_threads = os.cpu_count() or 1
+
+    if chunksize is None:
+        chunksize = DEFAULT_CHUNKSIZE
+
+    pixel_results = _iter_pixel_results(images, params, n_workers, chunksize, cache, n_threads=n_threads)
+
+    for name, spot_met_pixels, width, error in pixel_results:
+        yield name, scale_spot_metrics(spot_met_pixels, mm_per_pix), width, error
+
+
+def _is_image_name(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def _iter_zip_image_members(archive):
+    # skip folders and macOS resource forks
+    members = [info for info in archive.infolist() if not info.is_dir()
+               and not os.path.basename(info.filename).startswith('._') and _is_image_name(info.filename)]
+
+    # members are named by their base name, unless members in different folders share it (e.g. day1/X.jpg
+    # and day2/X.jpg), which keep their path in the archive so their results can be told apart
+    base_names = Counter(os.path.basename(info.filename) for info in members)
+
+    for info in members:
+        name = os.path.basename(info.filename)
+        yield (info.filename if base_names[name] > 1 else name), info
+
+
+def iter_zip_images(zip_file):
+    '''
+    Yield (file name, encoded image bytes) for each image in a zip archive
+
+    zip_file: path or seekable binary file object (e.g. a Streamlit UploadedFile) of the archive.
+              Members are decompressed one at a time as they are consumed, nothing is extracted to disk.
+              File names are the base names of the members, or their paths in the archive where
+              members in different folders have the same base name
+    '''
+
+    with zipfile.ZipFile(zip_file) as archive:
+        for name, info in _iter_zip_image_members(archive):
+            yield name, archive.read(info)
+
+
+# JPEG start of frame markers, which hold the image size. C4 (DHT), C8 (JPG) and CC (DAC) are not frames
+_JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# JPEG markers without a length field
+_JPEG_STANDALONE_MARKERS = frozenset(range(0xD0, 0xD8)) | {0x01}
+
+
+def _jpeg_size(data):
+    # walk the marker segments up to the first start of frame
+    pos = 2
+    n = len(data)
+
+    while pos + 4 <= n:
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # fill byte
+            pos += 1
+            continue
+        if marker in _JPEG_STANDALONE_MARKERS:
+            pos += 2
+            continue
+        if marker in (0xD9, 0xDA):
+            # end of image or start of scan before any frame header
+            return None
+
+        if marker in _JPEG_SOF_MARKERS:
+            if pos + 9 > n:
+                return None
+            height, width = struct.unpack_from('>HH', data, pos + 5)
+            return width, height
+
+        length, = struct.unpack_from('>H', data, pos + 2)
+        pos += 2 + length
+
+    return None
+
+
+def image_size_from_header(data):
+    '''
+    (width, height) of an encoded JPEG or PNG image read from its header, without decoding it
+
+    data: bytes-like object (bytes, memoryview, mmap...) of the encoded image, it is not copied.
+    Returns None if the size cannot be read from the header, e.g. for other formats
+    '''
+
+    if len(data) >= 24 and data[:8] == b'\x89PNG\r\n\x1a\n' and data[12:16] == b'IHDR':
+        return struct.unpack_from('>II', data, 16)
+
+    if len(data) >= 4 and data[:2] == b'\xff\xd8':
+        return _jpeg_size(data)
+
+    return None
+
+
+def image_size(data):
+    '''
+    (width, height) of an encoded image, read from the header where possible
+
+    Falls back to PIL, which also only reads the header, for formats image_size_from_header does not handle
+    '''
+
+    size = image_size_from_header(data)
+    if size is not None:
+        return size
+
+    with Image.open(io.BytesIO(data)) as img:
+        return img.size
+
+
+def _is_zip_name(name):
+    return name.lower().endswith('.zip')
+
+
+def _uploaded_bytes(uploaded_file):
+    # contents of an uploaded file. getvalue() returns the buffer of a Streamlit UploadedFile (or BytesIO)
+    # without copying it, and does not depend on the current file position
+    if hasattr(uploaded_file, 'getvalue'):
+        return uploaded_file.getvalue()
+    uploaded_file.seek(0)
+    return uploaded_file.read()
+
+
+def iter_uploaded_images(uploaded_files):
+    '''
+    Yield (file name, encoded image bytes) from uploaded files, read one at a time
+
+    Uploaded zip archives are read member by member without extraction. Other files are
+    included if they have an image extension, their bytes are not copied
+    '''
+
+    for uploaded_file in uploaded_files:
+        if _is_zip_name(uploaded_file.name):
+            uploaded_file.seek(0)
+            yield from iter_zip_images(uploaded_file)
+
+        elif _is_image_name(uploaded_file.name):
+            yield uploaded_file.name, _uploaded_bytes(uploaded_file)
+
+
+def iter_image_files(sources):
+    '''
+    Yield (file name, encoded image bytes) for images from a list of sources, read one at a time
+
+    Each source may be a zip archive, a directory (images directly inside it, in name order),
+    a glob pattern or a single image file
+    '''
+
+    for source in sources:
+        if os.path.isfile(source) and zipfile.is_zipfile(source):
+            yield from iter_zip_images(source)
+            continue
+
+        if os.path.isdir(source):
+            paths = sorted(os.path.join(source, name) for name in os.listdir(source))
+        elif os.path.isfile(source):
+            paths = [source]
+        else:
+            paths = sorted(glob.glob(source))
+
+        for path in paths:
+            if os.path.isfile(path) and _is_image_name(path):
+                with open(path, 'rb') as f:
+                    yield os.path.basename(path), f.read()
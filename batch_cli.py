@@ -0,0 +1,144 @@
+'''
+Headless batch processing of Panthera images, without the Streamlit app
+
+Writes the same columns as the Multiple Image Analysis page, e.g.
+
+    python batch_cli.py data/example_dbs.zip --mm-per-pixel 0.0589 --profile "1440 x 920" -o spot_metrics.csv
+
+Inputs may be zip archives, directories, glob patterns (quote them so the shell does not expand them)
+or individual image files.
+'''
+
+import os
+import sys
+import time
+import argparse
+
+from functions import iter_spot_metrics, multi_image_results, DETECTION_MODES
+from profiles import PROFILES, get_profile
+from batch import iter_image_files
+from result_cache import ResultCache, DEFAULT_CACHE_PATH
+from summary_store import SummaryStore, DEFAULT_STORE_PATH, file_key, ADDED, ALREADY_ADDED
+from model_registry import get_multispot_model
+from profiling import capture, TimingSummary, TraceRecorder
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Calculate DBS metrics for a batch of Panthera images")
+    parser.add_argument('inputs', nargs='+',
+                        help="zip archive(s), image directories, glob patterns or image files")
+    parser.add_argument('--mm-per-pixel', type=float, required=True,
+                        help="instrument specific mm per pixel (see the Configuration page)")
+    parser.add_argument('--profile', required=True, choices=list(PROFILES),
+                        help="instrument profile (image size)")
+    parser.add_argument('-o', '--output', default='spot_metrics.csv',
+                        help="output CSV file (default: spot_metrics.csv)")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="number of worker processes (default: all cores)")
+    parser.add_argument('--threads', type=int, default=0,
+                        help="with --workers 1, number of analysis threads. Images are decoded in a separate "
+                             "thread while others are analysed (default: 0, no threads)")
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help="number of images sent to a worker at a time")
+    parser.add_argument('--mode', default='reference', choices=DETECTION_MODES,
+                        help="detection mode (default: reference). window only processes the area around the "
+                             "search circle and gives the same results. coarse_to_fine is faster but approximate, "
+                             "see compare_modes.py")
+    parser.add_argument('--cache', nargs='?', const=DEFAULT_CACHE_PATH, default=None, metavar='PATH',
+                        help=f"reuse results of previously analysed images, stored in PATH (default: {DEFAULT_CACHE_PATH})")
+    parser.add_argument('--trace', default=None, metavar='PATH',
+                        help="write a Chrome trace of the pipeline stages to PATH (open in chrome://tracing or "
+                             "Perfetto) and print a per-stage timing summary")
+    parser.add_argument('--summary-store', nargs='?', const=DEFAULT_STORE_PATH, default=None, metavar='PATH',
+                        help="add the results to the Time Series Analysis summary store in PATH "
+                             f"(default: {DEFAULT_STORE_PATH}). Identical output files are only added once, and "
+                             "results whose dates overlap stored results of the same instrument are not added")
+    parser.add_argument('--allow-overlap', action='store_true',
+                        help="with --summary-store, add the results even if their dates overlap stored results")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    profile = get_profile(args.profile)
+    x_min, x_max, y_min, y_max = profile.roi
+
+    if profile.mm_per_pixel_range is not None:
+        lower, upper = profile.mm_per_pixel_range
+        if not (lower <= args.mm_per_pixel <= upper):
+            print(f"Warning: mm per pixel is out of the expected range for {profile.name} images "
+                  f"({lower:.2f}-{upper:.2f}). DBS diameter may be inaccurate.", file=sys.stderr)
+
+    log_model = get_multispot_model()
+
+    cache = ResultCache(args.cache) if args.cache else None
+
+    sinks = (TimingSummary(), TraceRecorder()) if args.trace else ()
+
+    rows = []
+    n_images = 0
+    n_warnings = 0
+    start = time.perf_counter()
+
+    with capture(*sinks):
+        image_results = iter_spot_metrics(iter_image_files(args.inputs), x_min, x_max, y_min, y_max,
+                                          args.mm_per_pixel, profile.center, profile.radius, profile,
+                                          select_punched=True, n_workers=args.workers, chunksize=args.chunksize,
+                                          cache=cache, mode=args.mode, n_threads=args.threads)
+
+        for name, image_rows, warning in image_results:
+            n_images += 1
+
+            if warning is not None:
+                print(warning, file=sys.stderr)
+                n_warnings += 1
+
+            rows.extend(image_rows)
+
+        elapsed = time.perf_counter() - start
+
+        if not rows:
+            print("No blood spots found", file=sys.stderr)
+            return 1
+
+        df = multi_image_results(rows, args.mm_per_pixel, None, log_model)
+
+    df.to_csv(args.output, index=False)
+
+    rate = n_images / elapsed if elapsed > 0 else float('inf')
+    print(f"Processed {n_images} images ({n_warnings} with warnings) in {elapsed:.1f} s: {rate:.1f} images/second")
+    print(f"Wrote {len(df)} rows to {args.output}")
+
+    if cache is not None:
+        print(f"Result cache: {cache.hits} hits, {cache.misses} misses")
+
+    if args.summary_store:
+        store = SummaryStore(args.summary_store)
+        outcome, overlapping = store.add(df, key=file_key(args.output), name=os.path.basename(args.output),
+                                         skip_overlapping=not args.allow_overlap)
+        store.close()
+
+        overlaps = ', '.join(f"{name} (id {batch})" for batch, name in zip(overlapping['id'], overlapping['name']))
+        if outcome == ADDED:
+            print(f"Added {len(df)} rows to the summary store {args.summary_store}")
+            if overlaps:
+                print(f"Warning: the dates of these results overlap {overlaps} in the summary store. Remove "
+                      "files counted twice with python summary_store.py --remove ID", file=sys.stderr)
+        elif outcome == ALREADY_ADDED:
+            print(f"{args.output} is already in the summary store {args.summary_store}")
+        else:
+            print(f"Not added to the summary store: the dates of these results overlap {overlaps}. "
+                  "Use --allow-overlap to add them anyway", file=sys.stderr)
+
+    if sinks:
+        summary, trace = sinks
+        print(summary.to_dataframe().to_string(index=False, float_format='{:.3f}'.format))
+        trace.write(args.trace)
+        print(f"Wrote trace to {args.trace}")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
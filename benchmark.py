@@ -0,0 +1,307 @@
+'''
+Per-stage benchmark of the blood spot pipeline over the example images
+
+Runs every image in data/example_dbs.zip through both instrument paths (752 x 480 images are made by
+resizing the 1440 x 920 examples) and reports, for each stage, the median wall time and the memory
+allocated by NumPy/OpenCV arrays per image. The stages are the profiling spans recorded by the pipeline
+itself (see profiling.py), so they measure the code that is deployed. End-to-end images/second of spot_metrics_multi_uploaded
+is also reported. Results are saved as JSON, and can be compared with the results of an earlier run:
+
+    python benchmark.py -o baseline.json                # record a baseline on this machine
+    python benchmark.py --baseline baseline.json        # run again and compare
+
+With --baseline, the exit status is 1 if any stage is slower than the baseline by more than --tolerance.
+Timings depend on the machine, so only compare against a baseline recorded on the same hardware.
+'''
+
+import io
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import datetime
+import statistics
+import tracemalloc
+import warnings
+
+import numpy as np
+import pandas as pd
+import cv2
+
+from functions import (
+    spot_metrics_image_pixels,
+    scale_spot_metrics,
+    calc_multispot_prob_multi,
+    spot_metrics_multi_uploaded,
+    SPOT_METRICS_COLUMNS,
+    ML_COLUMNS
+)
+from profiles import PROFILES
+from batch import iter_zip_images
+from model_registry import get_multispot_model
+from profiling import capture, TimingSummary
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+EXAMPLES_PATH = os.path.join(APP_DIR, 'data', 'example_dbs.zip')
+
+# Profiling spans of the pipeline reported as stages. detect contains the detect.* stages
+STAGES = ['decode', 'detect.blur', 'detect.threshold', 'detect.morphology', 'detect.contours', 'detect.green_mask',
+          'detect', 'spot_metrics', 'inference']
+
+# mm per pixel used for the metrics stage (does not affect timings)
+MM_PER_PIXEL = {'752 x 480': 0.1161, '1440 x 920': 0.0589}
+
+
+def example_images(path, profile):
+    ''' Encoded example images at the size of profile, as a list of (name, bytes)
+    '''
+
+    images = []
+    for name, data in iter_zip_images(path):
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if img.shape[1] != profile.width:
+            img = cv2.resize(img, profile.image_size, interpolation=cv2.INTER_AREA)
+            data = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 95])[1].tobytes()
+        images.append((name, data))
+
+    return images
+
+
+def run_image(data, profile, model):
+    '''
+    Run one encoded image through the pipeline, as the Multiple Image Analysis page does: decode, detect
+    and measure (functions.spot_metrics_image_pixels), then score the spots with the multispot model.
+    The stages are timed by the profiling spans of the pipeline itself
+    '''
+
+    x_min, x_max, y_min, y_max = profile.roi
+    rows, _ = spot_metrics_image_pixels(data, x_min, x_max, y_min, y_max, profile.center, profile.radius, profile,
+                                        select_punched=True)
+
+    df = pd.DataFrame([['image'] + row for row in scale_spot_metrics(rows, MM_PER_PIXEL[profile.name])],
+                      columns=SPOT_METRICS_COLUMNS)
+    calc_multispot_prob_multi(df, ML_COLUMNS, None, model)
+
+
+class AllocationSummary:
+    '''
+    Profiling sink measuring, with tracemalloc, the bytes allocated by each span and its peak above the
+    memory in use when it started. tracemalloc must be tracing while the spans are recorded
+    '''
+
+    def __init__(self):
+        self.allocated = {}
+        self.peak = {}
+        # [memory in use at the start, peak so far] of each span that has started and not finished
+        self._open = []
+
+    def _update_peaks(self):
+        # tracemalloc keeps a single peak, so it is reset at each span boundary and added to every open span
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        for span_memory in self._open:
+            span_memory[1] = max(span_memory[1], peak)
+        return current
+
+    def span_started(self, name):
+        current = self._update_peaks()
+        self._open.append([current, current])
+
+    def __call__(self, event):
+        current = self._update_peaks()
+        start, peak = self._open.pop()
+        self.allocated[event.name] = self.allocated.get(event.name, 0) + max(current - start, 0)
+        self.peak[event.name] = max(self.peak.get(event.name, 0), peak - start)
+
+
+def time_stages(images, profile, model, repeats):
+    ''' Median wall time (ms) per image of each stage
+    '''
+
+    times = {stage: [] for stage in STAGES}
+
+    for _, data in images:
+        per_run = []
+        for _ in range(repeats):
+            summary = TimingSummary()
+            with capture(summary):
+                run_image(data, profile, model)
+            per_run.append({stage: summary.stats.get(stage, (0, 0, 0))[1] / 1e6 for stage in STAGES})
+
+        for stage in STAGES:
+            times[stage].append(statistics.median(run[stage] for run in per_run))
+
+    return {stage: sum(values) / len(values) for stage, values in times.items()}
+
+
+def measure_allocations(images, profile, model):
+    '''
+    Bytes allocated (total, and peak above the starting point) per image for each stage
+
+    Counts NumPy arrays, including OpenCV outputs, and Python objects. OpenCV's internal
+    temporary buffers are not visible to tracemalloc
+    '''
+
+    allocations = AllocationSummary()
+
+    tracemalloc.start()
+    try:
+        with capture(allocations):
+            for _, data in images:
+                run_image(data, profile, model)
+    finally:
+        tracemalloc.stop()
+
+    return ({stage: allocations.allocated.get(stage, 0) / len(images) for stage in STAGES},
+            {stage: allocations.peak.get(stage, 0) for stage in STAGES})
+
+
+class _Upload(io.BytesIO):
+    ''' In-memory stand-in for a Streamlit UploadedFile '''
+
+    def __init__(self, name, data):
+        super().__init__(data)
+        self.name = name
+
+
+def end_to_end(images, profile, n_workers):
+    ''' Images per second of spot_metrics_multi_uploaded (without a result cache)
+    '''
+
+    uploads = [_Upload(name, data) for name, data in images]
+    x_min, x_max, y_min, y_max = profile.roi
+
+    start = time.perf_counter()
+    spot_metrics_multi_uploaded(uploads, x_min, x_max, y_min, y_max, MM_PER_PIXEL[profile.name],
+                                profile.center, profile.radius, profile, select_punched=True, n_workers=n_workers)
+    elapsed = time.perf_counter() - start
+
+    return len(images) / elapsed
+
+
+def run_benchmarks(path, repeats, n_workers):
+    model = get_multispot_model()
+    results = {}
+
+    for profile in PROFILES.values():
+        images = example_images(path, profile)
+
+        # warm up caches (masks, kernels, model) so they are not counted in the first stage
+        run_image(images[0][1], profile, model)
+
+        times = time_stages(images, profile, model, repeats)
+        allocated, peak = measure_allocations(images, profile, model)
+
+        results[profile.name] = {
+            'images': len(images),
+            'stages': {stage: {'ms_per_image': times[stage],
+                               'allocated_kb_per_image': allocated[stage] / 1024,
+                               'peak_kb': peak[stage] / 1024} for stage in STAGES},
+            'images_per_second': end_to_end(images, profile, n_workers),
+        }
+
+    return {
+        'meta': {
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+            'repeats': repeats,
+            'workers': n_workers,
+        },
+        'profiles': results,
+    }
+
+
+def print_results(results, baseline=None):
+    for name, result in results['profiles'].items():
+        base = baseline['profiles'].get(name) if baseline else None
+
+        print(f"\n{name} ({result['images']} images)")
+        print(f"{'stage':<18}{'ms/image':>10}{'alloc KB':>10}{'peak KB':>10}" + (f"{'baseline':>10}{'change':>9}" if base else ''))
+
+        for stage, values in result['stages'].items():
+            line = f"{stage:<18}{values['ms_per_image']:>10.2f}{values['allocated_kb_per_image']:>10.0f}{values['peak_kb']:>10.0f}"
+            if base and stage in base['stages']:
+                old = base['stages'][stage]['ms_per_image']
+                line += f"{old:>10.2f}{(values['ms_per_image'] / old - 1) * 100 if old else 0:>8.0f}%"
+            print(line)
+
+        line = f"end to end: {result['images_per_second']:.1f} images/second"
+        if base:
+            line += f" (baseline {base['images_per_second']:.1f})"
+        print(line)
+
+
+def regressions(results, baseline, tolerance, min_ms=0.5):
+    '''
+    Stages that are slower than the baseline by more than tolerance (a fraction), and end-to-end
+    throughput drops of more than tolerance. Stages faster than min_ms in both runs are ignored
+    as their timings are dominated by noise
+    '''
+
+    found = []
+
+    for name, result in results['profiles'].items():
+        base = baseline['profiles'].get(name)
+        if base is None:
+            continue
+
+        for stage, values in result['stages'].items():
+            old = base['stages'].get(stage, {}).get('ms_per_image')
+            new = values['ms_per_image']
+            if old is not None and max(old, new) >= min_ms and new > old * (1 + tolerance):
+                found.append(f"{name} {stage}: {old:.2f} -> {new:.2f} ms/image")
+
+        if result['images_per_second'] < base['images_per_second'] * (1 - tolerance):
+            found.append(f"{name} end to end: {base['images_per_second']:.1f} -> "
+                         f"{result['images_per_second']:.1f} images/second")
+
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the DBS pipeline stages on the example images")
+    parser.add_argument('--examples', default=EXAMPLES_PATH, help="zip archive of example images")
+    parser.add_argument('--repeats', type=int, default=3, help="runs per image, the median is used (default: 3)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="worker processes for the end-to-end measurement (default: 1)")
+    parser.add_argument('-o', '--output', default='benchmark_results.json', help="results file")
+    parser.add_argument('--baseline', default=None, metavar='PATH',
+                        help="results of an earlier run on the same machine to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed slow-down before a stage counts as a regression (default: 0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    # models were saved with an older version of scikit-learn
+    warnings.simplefilter('ignore')
+
+    results = run_benchmarks(args.examples, args.repeats, args.workers)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print_results(results, baseline)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(f"\nResults written to {args.output}")
+
+    if baseline is None:
+        return 0
+
+    found = regressions(results, baseline, args.tolerance)
+    for line in found:
+        print(f"REGRESSION {line}")
+
+    return 1 if found else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
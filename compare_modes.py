@@ -0,0 +1,175 @@
+'''
+Report how far a faster detection mode deviates from the reference mode, e.g.
+
+    python compare_modes.py data/example_dbs.zip --mode coarse_to_fine --profile "1440 x 920"
+
+Blood spots found by both modes are matched on their centres. For each image the report gives the
+number of spots found by each mode, and for matched spots the difference in equivalent diameter (mm)
+and multispot probability. A summary with the largest deviations and the detection speed-up follows.
+'''
+
+import sys
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+import cv2
+
+from functions import (
+    bs_detect_profile,
+    spot_metrics,
+    calc_multispot_prob,
+    DETECTION_MODES,
+    SPOT_METRICS_COLUMNS,
+    ML_COLUMNS
+)
+from profiles import PROFILES, get_profile
+from batch import iter_image_files
+from model_registry import get_multispot_model
+
+# Spot metrics rows do not include the file name
+METRIC_COLUMNS = SPOT_METRICS_COLUMNS[1:]
+
+# Largest distance (pixels) between the centres of spots matched across modes
+MATCH_DISTANCE = 10
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compare a detection mode against the reference mode")
+    parser.add_argument('inputs', nargs='*', default=['data/example_dbs.zip'],
+                        help="zip archive(s), image directories, glob patterns or image files "
+                             "(default: data/example_dbs.zip)")
+    parser.add_argument('--mode', default='coarse_to_fine', choices=[m for m in DETECTION_MODES if m != 'reference'],
+                        help="detection mode to compare (default: coarse_to_fine)")
+    parser.add_argument('--profile', default='1440 x 920', choices=list(PROFILES),
+                        help="instrument profile (default: 1440 x 920)")
+    parser.add_argument('--mm-per-pixel', type=float, default=0.0589,
+                        help="mm per pixel used for diameters (default: 0.0589)")
+    parser.add_argument('--all-spots', action='store_true',
+                        help="compare all blood spots rather than only punched spots")
+    parser.add_argument('-o', '--output', default=None,
+                        help="optional CSV file with one row per matched spot")
+
+    return parser.parse_args(argv)
+
+
+def analyse(img, profile, mode, select_punched, mm_per_pixel, model):
+    ''' Detect and measure blood spots in a cropped image with one detection mode
+
+    Returns (detection time in seconds, list of (centroid, equivalent diameter, multispot probability))
+    '''
+
+    start = time.perf_counter()
+    detection = bs_detect_profile(img, profile, select_punched=select_punched, mode=mode)
+    elapsed = time.perf_counter() - start
+
+    rows = spot_metrics(detection, detection.hierarchy, mm_per_pixel, profile.center, profile.radius,
+                        select_punched=select_punched)
+    probs = dict(calc_multispot_prob(rows, METRIC_COLUMNS, ML_COLUMNS, None, model))
+
+    diam_col = METRIC_COLUMNS.index('equiv_diam_mm')
+    spots = [(detection.centroid(row[0]), row[diam_col], probs[row[0]]) for row in rows]
+
+    return elapsed, spots
+
+
+def match_spots(reference, candidate):
+    ''' Pair spots from two modes whose centres are within MATCH_DISTANCE pixels (closest first)
+    '''
+
+    pairs = []
+    unused = list(range(len(candidate)))
+
+    for ref in reference:
+        best = None
+        for k in unused:
+            dist = np.hypot(ref[0][0] - candidate[k][0][0], ref[0][1] - candidate[k][0][1])
+            if dist <= MATCH_DISTANCE and (best is None or dist < best[0]):
+                best = (dist, k)
+        if best is not None:
+            unused.remove(best[1])
+            pairs.append((ref, candidate[best[1]]))
+
+    return pairs
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    profile = get_profile(args.profile)
+    select_punched = not args.all_spots
+    model = get_multispot_model()
+
+    matched = []
+    summary = []
+
+    for name, data in iter_image_files(args.inputs):
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if img is None or img.shape[1] != profile.width:
+            print(f"Skipping {name}: not a {profile.name} image", file=sys.stderr)
+            continue
+        img = profile.crop_image(img)
+
+        ref_time, reference = analyse(img, profile, 'reference', select_punched, args.mm_per_pixel, model)
+        mode_time, candidate = analyse(img, profile, args.mode, select_punched, args.mm_per_pixel, model)
+        pairs = match_spots(reference, candidate)
+
+        for ref, cand in pairs:
+            matched.append({
+                'file': name,
+                'centroid': ref[0],
+                'equiv_diam_mm': ref[1],
+                'equiv_diam_mm_' + args.mode: cand[1],
+                'diam_diff_mm': cand[1] - ref[1],
+                'prob_multi': ref[2],
+                'prob_multi_' + args.mode: cand[2],
+                'prob_diff': cand[2] - ref[2],
+                'pred_changed': (ref[2] > 0.5) != (cand[2] > 0.5),
+            })
+
+        summary.append({
+            'file': name,
+            'spots_reference': len(reference),
+            'spots_' + args.mode: len(candidate),
+            'unmatched': len(reference) + len(candidate) - 2 * len(pairs),
+            'max_abs_diam_diff_mm': max((abs(c[1] - r[1]) for r, c in pairs), default=0.0),
+            'max_abs_prob_diff': max((abs(c[2] - r[2]) for r, c in pairs), default=0.0),
+            'time_reference_ms': 1000 * ref_time,
+            'time_' + args.mode + '_ms': 1000 * mode_time,
+        })
+
+    if not summary:
+        print("No images to compare", file=sys.stderr)
+        return 1
+
+    summary = pd.DataFrame(summary)
+    matched = pd.DataFrame(matched)
+
+    with pd.option_context('display.max_rows', None, 'display.width', 200, 'display.float_format', '{:.4f}'.format):
+        print(summary.to_string(index=False))
+
+    print()
+    print(f"Mode: {args.mode}, profile {profile.name}, {len(summary)} images")
+    print(f"Spots: {summary['spots_reference'].sum()} reference, {summary['spots_' + args.mode].sum()} {args.mode}, "
+          f"{summary['unmatched'].sum()} unmatched")
+
+    if len(matched):
+        diam = matched['diam_diff_mm'].abs()
+        prob = matched['prob_diff'].abs()
+        print(f"Equivalent diameter deviation (mm): mean {diam.mean():.4f}, max {diam.max():.4f}")
+        print(f"Multispot probability deviation: mean {prob.mean():.4f}, max {prob.max():.4f}")
+        print(f"Multispot predictions changed: {int(matched['pred_changed'].sum())} of {len(matched)}")
+
+    ref_total = summary['time_reference_ms'].sum()
+    mode_total = summary['time_' + args.mode + '_ms'].sum()
+    print(f"Detection time: reference {ref_total / len(summary):.1f} ms/image, "
+          f"{args.mode} {mode_total / len(summary):.1f} ms/image ({ref_total / mode_total:.2f}x)")
+
+    if args.output:
+        matched.to_csv(args.output, index=False)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
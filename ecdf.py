@@ -0,0 +1,156 @@
+'''
+Empirical cumulative distribution functions (ECDFs) of DBS diameters, for plotting
+
+An ECDF holds the distinct values in order and how often each occurs, so ECDFs built from the diameter
+counts of analysis.MonthlyAggregates are small however many results they describe, and can be merged.
+
+Plots use a step curve with a fixed number of points, so their cost does not depend on the number
+of values. The curve is exact at the 8 mm threshold, at the reported percentiles and at every grid
+point. Between grid points it can lag by the proportion of values between the neighbouring points:
+
+    e = ECDF(df['equiv_diam_mm'])
+    e(8)                        # proportion of DBS <= 8 mm
+    plot_ecdf(ax, e, label='All DBS')
+'''
+
+import math
+
+import numpy as np
+
+from analysis import MIN_DIAMETER_MM
+
+# Points in the plotted step curve, enough for the width of a Streamlit chart
+CURVE_POINTS = 512
+
+# Percentiles reported on the analysis pages, where curves are exact
+REPORTED_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+
+def _split(x):
+    # high and low halves of float64 values, each with at most 26 significant bits, so products of
+    # halves are exact (Dekker's splitting)
+    scaled = x * 134217729.0
+    high = scaled - (scaled - x)
+    return high, x - high
+
+
+def _exact_dot(values, counts):
+    '''
+    Sum of values * counts, correctly rounded. Each product is split into its rounded value and its exact
+    rounding error, and all of them are summed with math.fsum, so the mean of the counts is the mean pandas
+    computes from the values they count
+    '''
+
+    values = np.asarray(values, dtype=float)
+    counts = np.asarray(counts, dtype=float)
+    products = values * counts
+
+    values_high, values_low = _split(values)
+    counts_high, counts_low = _split(counts)
+    errors = ((values_high * counts_high - products) + values_high * counts_low + values_low * counts_high
+              + values_low * counts_low)
+
+    return math.fsum(np.concatenate([products, errors]))
+
+
+class ECDF:
+    '''
+    ECDF of a set of values, held as the distinct values and the number of times each occurs.
+    NaN values are left out
+
+    values: array-like of values, or of distinct values if counts is given
+    counts: optional number of times each of values occurs
+    '''
+
+    def __init__(self, values, counts=None):
+        values = np.asarray(values, dtype=float)
+
+        if counts is None:
+            values, counts = np.unique(values[~np.isnan(values)], return_counts=True)
+        else:
+            order = np.argsort(values, kind='stable')
+            values, counts = values[order], np.asarray(counts, dtype=np.int64)[order]
+
+        self.values = values
+        self.counts = counts
+        self.cumcounts = np.cumsum(counts)
+
+    def __len__(self):
+        return int(self.cumcounts[-1]) if len(self.cumcounts) else 0
+
+    def __call__(self, x):
+        ''' Proportion of values <= x (x may be an array)
+        '''
+        if not len(self):
+            return np.zeros_like(np.asarray(x, dtype=float))
+        idx = np.searchsorted(self.values, x, side='right')
+        return np.where(idx > 0, self.cumcounts[np.maximum(idx - 1, 0)], 0) / len(self)
+
+    def _ranked(self, rank):
+        # value(s) at 0-based rank(s) in the sorted values
+        return self.values[np.searchsorted(self.cumcounts, rank, side='right')]
+
+    def mean(self):
+        return _exact_dot(self.values, self.counts) / len(self) if len(self) else np.nan
+
+    def median(self):
+        ''' Median, computed as pandas.Series.median
+        '''
+        n = len(self)
+        if not n:
+            return np.nan
+        return np.mean(self._ranked([(n - 1) // 2, n // 2]))
+
+    def quantile(self, q):
+        '''
+        Quantile(s) with linear interpolation, computed as pandas.Series.quantile (numpy's linear method)
+        '''
+        q = np.asarray(q, dtype=float)
+        n = len(self)
+        if not n:
+            return np.full(q.shape, np.nan)[()]
+
+        position = q * (n - 1)
+        below = np.floor(position)
+        gamma = position - below
+        a = self._ranked(below.astype(np.int64))
+        b = self._ranked(np.minimum(below.astype(np.int64) + 1, n - 1))
+
+        # interpolate from the nearer end, as numpy does
+        diff = b - a
+        # [()] gives a scalar for a scalar q
+        return np.where(gamma >= 0.5, b - diff * (1 - gamma), a + diff * gamma)[()]
+
+    def merge(self, other):
+        ''' ECDF of the values of both ECDFs
+        '''
+        values, inverse = np.unique(np.concatenate([self.values, other.values]), return_inverse=True)
+        counts = np.bincount(inverse.reshape(-1), weights=np.concatenate([self.counts, other.counts]))
+        return ECDF(values, counts.astype(np.int64))
+
+    def curve(self, points=CURVE_POINTS, at=(MIN_DIAMETER_MM,)):
+        '''
+        (x, y) of a step curve (draw with drawstyle='steps-post') with about points points
+
+        The curve starts at (minimum, 0) and ends at (maximum, 1). It includes the x values in at
+        (within the range of the values) and the REPORTED_QUANTILES
+        '''
+
+        if not len(self):
+            return np.zeros(0), np.zeros(0)
+
+        lo, hi = self.values[0], self.values[-1]
+        x = np.concatenate([np.linspace(lo, hi, points), np.asarray(at, dtype=float),
+                            self.quantile(REPORTED_QUANTILES)])
+        x = np.unique(x[(x >= lo) & (x <= hi)])
+
+        return np.r_[lo, x], np.r_[0.0, self(x)]
+
+
+def plot_ecdf(ax, ecdf, points=CURVE_POINTS, at=(MIN_DIAMETER_MM,), **kwargs):
+    '''
+    Plot the step curve of an ECDF on matplotlib axes. kwargs are passed to ax.plot (e.g. color, label)
+    '''
+
+    x, y = ecdf.curve(points, at=at)
+    return ax.plot(x, y, drawstyle='steps-post', **kwargs)
@@ -5,6 +5,14 @@ import matplotlib.pyplot as plt
 import cv2
 import math
 
+from profiles import get_profile, circular_mask, square_kernel
+from inference import as_logistic_inference
+from profiling import span, traced
+
+# Version of the detection and metrics algorithm. Increase when a change alters detected contours or
+# pixel metrics, so that results stored by result_cache are not reused
+ALGORITHM_VERSION = 1
+
 def contour_in_roi(contours, i, center, radius):
     ''' Function to determine if area is in ROI
     '''
@@ -37,23 +45,194 @@ def all_contour_in_roi(contours,i, x_min, x_max, y_min, y_max):
             
     return point_in_roi
 
+def _contour_points(contours):
+    ''' Stack the points of all contours into one (N, 2) array
+    
+    Also returns the index of the first point of each contour, for use with np.ufunc.reduceat
+    '''
+    
+    lengths = np.fromiter((len(cnt) for cnt in contours), dtype=np.intp, count=len(contours))
+    points = np.concatenate(contours).reshape(-1, 2).astype(np.int64)
+    starts = np.zeros(len(contours), dtype=np.intp)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    
+    return points, starts
+
+def contours_in_roi(contours, center, radius):
+    ''' Vectorised version of contour_in_roi
+    
+    Returns a boolean array with one entry per contour, True if any point of the contour
+    lies within (or on) the circle defined by center and radius
+    '''
+    
+    if len(contours) == 0:
+        return np.zeros(0, dtype=bool)
+    
+    points, starts = _contour_points(contours)
+    cx, cy = center
+    
+    dist = np.sqrt(((points[:, 0] - cx)**2 + (points[:, 1] - cy)**2).astype(np.float64))
+    
+    return np.logical_or.reduceat(dist <= radius, starts)
+
+def all_contours_in_roi(contours, x_min, x_max, y_min, y_max):
+    ''' Vectorised version of all_contour_in_roi
+    
+    Returns a boolean array with one entry per contour, True if every point of the contour
+    lies strictly inside the rectangle bounded by (x_min, y_min) to (x_max, y_max)
+    '''
+    
+    if len(contours) == 0:
+        return np.zeros(0, dtype=bool)
+    
+    points, starts = _contour_points(contours)
+    x = points[:, 0]
+    y = points[:, 1]
+    
+    inside = (x_min < x) & (x < x_max) & (y_min < y) & (y < y_max)
+    
+    return np.logical_and.reduceat(inside, starts)
+
+def hierarchy_children(hierarchy):
+    '''
+    Index of child contours from a cv2.findContours hierarchy
+    
+    Returns a list with one entry per contour, where children[i] is an array of the indices of the contours
+    whose parent is contour i (e.g. the punches in a blood spot), in ascending order
+    '''
+    
+    if hierarchy is None:
+        return []
+    
+    parents = hierarchy[0][:, 3]
+    n = len(parents)
+    
+    # stable sort keeps children of each parent in contour order; top level contours (parent -1) sort first
+    order = np.argsort(parents, kind='stable')
+    counts = np.bincount(parents[parents >= 0], minlength=n)
+    n_top_level = n - counts.sum()
+    
+    return np.split(order[n_top_level:], np.cumsum(counts)[:-1])
+
+class DetectionResult(tuple):
+    '''
+    Contours and hierarchy of detected blood spots, returned by detect_blood_spots
+    
+    Unpacks like the (contours, hierarchy) pair returned by cv2.findContours. Per-contour values used by
+    spot_metrics, draw_bs_contours and draw_bounding_box (ROI membership, selection flags, moments,
+    centroids, convex hulls and bounding rectangles) are computed on first use and memoised, so passing
+    the same DetectionResult to each of them does the work once.
+    '''
+    
+    def __new__(cls, contours, hierarchy):
+        self = super().__new__(cls, (contours, hierarchy))
+        self._in_roi = {}
+        self._selected = {}
+        self._moments = {}
+        self._hulls = {}
+        self._bounding_rects = {}
+        self._children = None
+        return self
+    
+    def __getnewargs__(self):
+        return tuple(self)
+    
+    @property
+    def contours(self):
+        return self[0]
+    
+    @property
+    def hierarchy(self):
+        return self[1]
+    
+    def in_roi(self, center, radius):
+        ''' Boolean array, True for contours with a point in the circular search area (see contours_in_roi)
+        '''
+        key = (tuple(center), radius)
+        if key not in self._in_roi:
+            self._in_roi[key] = contours_in_roi(self.contours, center, radius)
+        return self._in_roi[key]
+    
+    def selected(self, select_punched):
+        '''
+        Boolean array, True for contours that are blood spots
+        
+        If select_punched, blood spots are contours with a child contour (punch), otherwise
+        external contours (no parent)
+        '''
+        select_punched = bool(select_punched)
+        if select_punched not in self._selected:
+            if self.hierarchy is None:
+                flags = np.zeros(0, dtype=bool)
+            elif select_punched:
+                # third column in the array is -1 if it does not have a child contour
+                flags = self.hierarchy[0][:, 2] != -1
+            else:
+                # last column in the array is -1 if an external contour (no contours inside of it)
+                flags = self.hierarchy[0][:, 3] == -1
+            self._selected[select_punched] = flags
+        return self._selected[select_punched]
+    
+    def spot_indices(self, center, radius, select_punched):
+        ''' Indices of the blood spots in the circular search area, in contour order
+        '''
+        return np.flatnonzero(self.in_roi(center, radius) & self.selected(select_punched)).tolist()
+    
+    @property
+    def children(self):
+        ''' Child contours (punches) of each contour, see hierarchy_children
+        '''
+        if self._children is None:
+            self._children = hierarchy_children(self.hierarchy)
+        return self._children
+    
+    def moments(self, i):
+        if i not in self._moments:
+            self._moments[i] = cv2.moments(self.contours[i])
+        return self._moments[i]
+    
+    def centroid(self, i):
+        ''' Integer (x, y) co-ordinates of the center of contour i
+        '''
+        M = self.moments(i)
+        return int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"])
+    
+    def convex_hull(self, i):
+        if i not in self._hulls:
+            self._hulls[i] = cv2.convexHull(self.contours[i], False)
+        return self._hulls[i]
+    
+    def bounding_rect(self, i):
+        if i not in self._bounding_rects:
+            self._bounding_rects[i] = cv2.boundingRect(self.contours[i])
+        return self._bounding_rects[i]
+
+def as_detection_result(contours, hierarchy):
+    '''
+    Return contours if it is already a DetectionResult (reusing its memoised values), otherwise
+    wrap contours and hierarchy in a new one
+    '''
+    
+    if isinstance(contours, DetectionResult):
+        return contours
+    
+    return DetectionResult(contours, hierarchy)
+
 def calibrate_mm_per_pixel_circle(contours,hierarchy, center, radius, cal_radius):
     '''
     Calculate the mm per pixel from calibration image
+    
+    contours may also be a DetectionResult (hierarchy is then ignored)
     '''
+    detection = as_detection_result(contours, hierarchy)
     spot_list = []
     
-    for i in range(len(contours)):
+    # contours in the search area with a child contour
+    for i in detection.spot_indices(center, radius, select_punched=True):
+        area = cv2.contourArea(detection.contours[i])
         
-        if not contour_in_roi(contours,i,center,radius):
-            continue
-                
-        # last column in the array is -1 if an external contour (no contours inside of it)
-        if hierarchy[0][i][2] != -1:
-            area = cv2.contourArea(contours[i])
-            
-            # add area of blood spot, number of punches and average punch area to list
-            spot_list.append([i,area])
+        # add area of blood spot, number of punches and average punch area to list
+        spot_list.append([i,area])
     
     if len(spot_list) == 1:
         calibrant_area = spot_list[0][1]
@@ -65,7 +244,8 @@ def calibrate_mm_per_pixel_circle(contours,hierarchy, center, radius, cal_radius
     else:
         raise Exception("More than one blood spot detected")
 
-def bs_detect(img, x_min, x_max, y_min, y_max, select_punched=False):
+@traced('detect')
+def detect_blood_spots(img, x_min, x_max, y_min, y_max, select_punched=False, median_ksize=3, green_median_ksize=7):
     '''
     Detect blood spots in an image using threshold and contours.
     
@@ -74,165 +254,477 @@ def bs_detect(img, x_min, x_max, y_min, y_max, select_punched=False):
     If select_punched = True, then only blood spots with green punch annotations are selected.
     
     Parameters:
-        img (np.ndarray): Input image.
+        img (np.ndarray): Input image (already cropped to the detection window).
         x_min, x_max, y_min, y_max (int): ROI bounds.
         select_punched (bool): Whether to filter by green punch marks.
+        median_ksize (int): Median blur kernel size used before thresholding.
+        green_median_ksize (int): Median blur kernel size used before green mask generation.
     
     Returns:
-        contours, hierarchy: Contours and hierarchy of detected blood spots.
+        DetectionResult: Contours and hierarchy of detected blood spots (unpacks as contours, hierarchy).
+    '''
+    
+    contours, hierarchy = _detect_in_window(img, x_min, x_max, y_min, y_max, select_punched=select_punched,
+                                            median_ksize=median_ksize, green_median_ksize=green_median_ksize)
+    
+    return DetectionResult(contours, hierarchy)
+
+def _detect_in_window(img, x_min, x_max, y_min, y_max, select_punched=False, median_ksize=3, green_median_ksize=7,
+                      window=None, threshold=None, gray=None, stages=None, masks=None):
+    '''
+    Blood spot detection pipeline (see detect_blood_spots), run over the whole image or one window of it
+    
+    window: optional (x0, y0, x1, y1) region of img to process. Returned contours are in img co-ordinates
+    threshold: fixed grey level threshold, or None to use Otsu's threshold of the processed region
+    gray: optional median blurred grey version of the whole img, if already computed
+    stages: optional list, the contours found at each intermediate step are appended to it
+    masks: optional dict, a copy of the mask produced by each step is stored in it under the step name
+    
+    Returns (contours, hierarchy) as cv2.findContours
     '''
+    
+    h, w = img.shape[:2]
+    x0, y0, x1, y1 = window if window is not None else (0, 0, w, h)
+    offset = (x0, y0)
+    draw_offset = (-x0, -y0)
+    img = img[y0:y1, x0:x1]
 
     # Basic blood spot detection algorithm
-    blurred_img = cv2.medianBlur(img, 3)
-    gray = cv2.cvtColor(blurred_img, cv2.COLOR_RGB2GRAY)
-    _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
-
-    # Add circular background mask to remove enclosing artefacts
-    h, w = thresh.shape
-    background = np.zeros((h, w), dtype=np.uint8)
-    x, y = int(w / 2), int(h / 2)
-    rad = int(w / 2)
-    background = cv2.circle(background, (x, y), rad, 255, -1)
-    thresh = cv2.bitwise_and(background, thresh)
-
-    # Foreground noise reduction
-    kernel = np.ones((3, 3), np.uint8)
-    closing = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel, iterations=1)
+    with span('detect.blur'):
+        if gray is None:
+            blurred_img = cv2.medianBlur(img, median_ksize)
+            gray = cv2.cvtColor(blurred_img, cv2.COLOR_RGB2GRAY)
+        else:
+            gray = gray[y0:y1, x0:x1]
 
-    # Find internal contours
-    s_contour_image = closing.copy()
-    s_contours, s_hierarchy = cv2.findContours(s_contour_image, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+    with span('detect.threshold'):
+        if threshold is None:
+            _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+        else:
+            _, thresh = cv2.threshold(gray, threshold, 255, cv2.THRESH_BINARY_INV)
 
-    # Fill valid internal contours
-    for i in range(len(s_contours)):
-        if not all_contour_in_roi(s_contours, i, x_min, x_max, y_min, y_max):
-            continue
-        if s_hierarchy[0][i][3] != -1:  # has a parent contour
-            if cv2.contourArea(s_contours[i]) > 100:
-                cv2.drawContours(closing, s_contours, i, (255, 255, 255), thickness=cv2.FILLED)
+        # Add circular background mask to remove enclosing artefacts (cached per frame shape)
+        thresh = cv2.bitwise_and(circular_mask(h, w)[y0:y1, x0:x1], thresh, dst=thresh)
+    if masks is not None:
+        masks['threshold'] = thresh.copy()
 
-    # Noise removal after contour filling
-    kernel = np.ones((3, 3), np.uint8)
-    opening = cv2.morphologyEx(closing, cv2.MORPH_OPEN, kernel, iterations=5)
+    # Foreground noise reduction (the later steps all work in this one buffer)
+    with span('detect.morphology'):
+        closing = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, square_kernel(3), dst=thresh)
+    if masks is not None:
+        masks['closing'] = closing.copy()
+
+    # Find internal contours
+    with span('detect.contours'):
+        s_contours, s_hierarchy = cv2.findContours(closing, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
+    if stages is not None:
+        stages.append(s_contours)
+
+    with span('detect.morphology'):
+        # Fill valid internal contours (in the ROI and with a parent contour)
+        if s_hierarchy is not None:
+            internal = all_contours_in_roi(s_contours, x_min, x_max, y_min, y_max) & (s_hierarchy[0][:, 3] != -1)
+            for i in np.flatnonzero(internal):
+                # fill only if contour is large enough to be a punch
+                if cv2.contourArea(s_contours[i]) > 100:
+                    cv2.drawContours(closing, s_contours, i, 255, thickness=cv2.FILLED, offset=draw_offset)
+        if masks is not None:
+            masks['filled'] = closing.copy()
+
+        # Noise removal after contour filling. Five iterations of a 3x3 opening are the same as
+        # one opening with an 11x11 square, which is a single (separable) erode and dilate
+        opening = cv2.morphologyEx(closing, cv2.MORPH_OPEN, square_kernel(11), dst=closing)
+    if masks is not None:
+        masks['opening'] = opening.copy()
 
     # Final contour detection
-    contour_image = opening.copy()
-    contours, hierarchy = cv2.findContours(contour_image, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+    contour_image = opening
+    with span('detect.contours'):
+        contours, hierarchy = cv2.findContours(contour_image, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
+    if stages is not None:
+        stages.append(contours)
 
     if not select_punched:
         return contours, hierarchy
 
     # --- Punched Spot Selection ---
-    img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-
-    # Fill detected contours
-    for i in range(len(contours)):
-        cv2.drawContours(contour_image, contours, i, (255, 255, 255), thickness=cv2.FILLED)
 
-    # Blur for green mask generation
-    blurred_img_gm = cv2.medianBlur(img_rgb, 7)
-    hsv = cv2.cvtColor(blurred_img_gm, cv2.COLOR_RGB2HSV)
-    mask = cv2.inRange(hsv, (36, 25, 25), (86, 255, 255))
-
-    # Refine green mask
-    kernel = np.ones((9, 9), np.uint8)
-    mask_erode = cv2.erode(mask, kernel, iterations=2)
-    mask_erode = cv2.medianBlur(mask_erode, 3)
+    # Fill detected contours. Filling an external contour also fills the holes inside it
+    spot_boxes = []
+    if hierarchy is not None:
+        for i in np.flatnonzero(hierarchy[0][:, 3] == -1):
+            cv2.drawContours(contour_image, contours, i, 255, thickness=cv2.FILLED, offset=draw_offset)
+            x, y, bw, bh = cv2.boundingRect(contours[i])
+            spot_boxes.append((x - x0, y - y0, x - x0 + bw, y - y0 + bh))
+    if masks is not None:
+        masks['filled_spots'] = contour_image.copy()
+
+    # The green mask only matters inside the filled spots, so it is only computed around them
+    with span('detect.green_mask'):
+        mask_erode = green_punch_mask(img, green_median_ksize, boxes=spot_boxes)
+    if masks is not None:
+        masks['green'] = mask_erode.copy()
 
     # Subtract mask from contour image to leave only punched spots
-    add_punch = cv2.subtract(contour_image, mask_erode)
+    add_punch = cv2.subtract(contour_image, mask_erode, dst=contour_image)
+    if masks is not None:
+        masks['punched'] = add_punch.copy()
 
     # Find contours of punched spots
-    p_contour_image = add_punch.copy()
-    p_contours, p_hierarchy = cv2.findContours(p_contour_image, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+    with span('detect.contours'):
+        return cv2.findContours(add_punch, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
 
-    return p_contours, p_hierarchy
+# Green punch annotation colour range (HSV)
+GREEN_LOWER = (36, 25, 25)
+GREEN_UPPER = (86, 255, 255)
 
-def bs_detect_newPanthera(img, x_min, x_max, y_min, y_max, select_punched = False):
+def _green_mask(img, green_median_ksize):
+    # Blur for green mask generation. Median blur works on each channel separately, so the BGR image
+    # can be blurred and converted to HSV directly rather than first converting to RGB
+    blurred_img_gm = cv2.medianBlur(img, green_median_ksize)
+    hsv = cv2.cvtColor(blurred_img_gm, cv2.COLOR_BGR2HSV)
+    mask = cv2.inRange(hsv, GREEN_LOWER, GREEN_UPPER)
+
+    # Refine green mask. Two 9x9 erosions are the same as one 17x17 erosion
+    mask = cv2.erode(mask, square_kernel(17), dst=mask)
+    return cv2.medianBlur(mask, 3)
+
+def green_punch_mask(img, green_median_ksize=7, boxes=None):
     '''
-    Detect blood spots in an image using threshold and contours
+    Mask of green punch annotations in a BGR image, eroded and smoothed
     
-    Internal contours that lie completely within rectangle bounded by (x_min,y_min) to (x_max,y_max) are filled
+    boxes: optional list of (x0, y0, x1, y1) regions. The mask is then only computed around these regions
+           and is zero elsewhere. Inside the regions it is identical to the mask of the whole image
+    '''
     
-    If select_punched = True then only blood spots with green punch annotations are selected
+    h, w = img.shape[:2]
     
-    img --> contours, hierarchy
+    if boxes is None:
+        return _green_mask(img, green_median_ksize)
     
-    ''' 
+    # distance over which the blur, erosion and smoothing steps depend on neighbouring pixels
+    pad = green_median_ksize // 2 + 17 // 2 + 1
+    regions = _merge_boxes(_box_grow(box, pad, w, h) for box in boxes)
+    
+    # with large or many spots it is cheaper to process the whole image once
+    if sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in regions) >= h * w:
+        return _green_mask(img, green_median_ksize)
     
+    mask = np.zeros((h, w), dtype=np.uint8)
     
-    ## basic blood spot algorithm (change kernel size from 3 to 13 as this shows best agreement with old Panthera)
+    for x0, y0, x1, y1 in regions:
+        local = _green_mask(img[y0:y1, x0:x1], green_median_ksize)
+        
+        # keep the part of the region that is at least pad from any edge inside the image
+        ix0, iy0 = (x0 + pad if x0 > 0 else 0), (y0 + pad if y0 > 0 else 0)
+        ix1, iy1 = (x1 - pad if x1 < w else w), (y1 - pad if y1 < h else h)
+        mask[iy0:iy1, ix0:ix1] = local[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0]
+    
+    return mask
+
+def detection_masks(img, x_min, x_max, y_min, y_max, select_punched=False, median_ksize=3, green_median_ksize=7):
+    '''
+    Intermediate masks of detect_blood_spots, for checking changes to the pipeline (see golden_masks.py)
+    
+    Returns a dict of binary masks keyed by step: 'threshold', 'closing', 'filled', 'opening' and,
+    if select_punched, 'filled_spots', 'green' (only computed around the filled spots, see green_punch_mask)
+    and 'punched'
+    '''
+    
+    masks = {}
+    _detect_in_window(img, x_min, x_max, y_min, y_max, select_punched=select_punched,
+                      median_ksize=median_ksize, green_median_ksize=green_median_ksize, masks=masks)
     
-    blurred_img = cv2.medianBlur(img,13)      
-    gray = cv2.cvtColor(blurred_img,cv2.COLOR_RGB2GRAY)
-    ret, thresh = cv2.threshold(gray,0,255,cv2.THRESH_BINARY_INV+cv2.THRESH_OTSU)
+    return masks
 
-    # add background to remove enclosing artefacts
-    h, w = thresh.shape
-    background = np.zeros((h,w),dtype=np.uint8)
-    x = int(w/2)
-    rad = int(w/2)
-    y = int(h/2)
-    background = cv2.circle(background,(x,y),rad,255,-1)
-    thresh = cv2.bitwise_and(background,thresh)
+def _merge_boxes(boxes):
+    ''' Merge overlapping (x0, y0, x1, y1) boxes until no two boxes overlap
+    '''
     
-    # foreground noise reduction
-    kernel = np.ones((3,3),np.uint8)
-    closing = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel, iterations=1)
+    boxes = list(boxes)
+    merged = True
+    
+    while merged:
+        merged = False
+        out = []
+        for box in boxes:
+            for k, other in enumerate(out):
+                if box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3]:
+                    out[k] = (min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]), max(box[3], other[3]))
+                    merged = True
+                    break
+            else:
+                out.append(box)
+        boxes = out
     
-    # find internal contours without noise reduction
-    s_contours, s_hierarchy = cv2.findContours(closing, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+    return sorted(boxes)
 
-    # fill internal contours on thresholded image
-    for i in range(len(s_contours)):
-        # skip if contour is outside region of interest
-        if not all_contour_in_roi(s_contours,i,x_min,x_max,y_min,y_max):
+def _concat_detections(parts):
+    '''
+    Join (contours, hierarchy) pairs found in separate windows into one pair, re-indexing the hierarchy
+    
+    Parent and child links are kept. Sibling (next / previous) links are not joined across windows
+    '''
+    
+    contours = []
+    hierarchies = []
+    
+    for part_contours, part_hierarchy in parts:
+        if part_hierarchy is None:
             continue
-        ## last field in heirarchy is -1 if the contour has no parent - so select only those with parent
-        if s_hierarchy[0][i][3] != -1: 
-            # fill contours on threshold image, only if contour is large enough to be a punch
-            if cv2.contourArea(s_contours[i]) > 100:
-                cv2.drawContours(closing, s_contours, i, (255,255,255),thickness=cv2.FILLED)
-        
-    # noise removal on amended thresholded image
-    kernel = np.ones((3,3),np.uint8)
-    opening = cv2.morphologyEx(closing,cv2.MORPH_OPEN,kernel, iterations = 5)
+        part_hierarchy = part_hierarchy[0].copy()
+        part_hierarchy[part_hierarchy >= 0] += len(contours)
+        contours.extend(part_contours)
+        hierarchies.append(part_hierarchy)
     
-    # find contours --> blood spots
-    contour_image = opening.copy()
-    contours, hierarchy = cv2.findContours(opening, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+    if not hierarchies:
+        return (), None
     
-    if not select_punched:
-        return contours, hierarchy
+    return tuple(contours), np.concatenate(hierarchies)[np.newaxis]
+
+# Downsampling factor and full resolution padding (pixels) of the regions used by coarse_to_fine detection
+COARSE_SCALE = 4
+COARSE_PAD = 32
+
+def locate_spot_regions(img, center, radius, median_ksize=3, scale=COARSE_SCALE, pad=COARSE_PAD):
+    '''
+    Locate blood spots that touch the circular search area on a downsampled copy of an image
     
-    elif select_punched:
-        
-        img_rgb = cv2.cvtColor(img,cv2.COLOR_BGR2RGB)
+    Returns:
+        threshold: Otsu threshold estimated at the coarse level
+        regions: list of padded (x0, y0, x1, y1) boxes in full resolution co-ordinates, merged so none overlap
+    '''
+    
+    h, w = img.shape[:2]
+    small = cv2.resize(img, (w // scale, h // scale), interpolation=cv2.INTER_AREA)
+    ksize = max(3, (median_ksize // scale) | 1)
+    
+    gray = cv2.cvtColor(cv2.medianBlur(small, ksize), cv2.COLOR_RGB2GRAY)
+    threshold, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    thresh = cv2.bitwise_and(circular_mask(*thresh.shape), thresh)
+    
+    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    cx, cy = center
+    near = contours_in_roi(contours, (cx / scale, cy / scale), radius / scale + 1)
+    
+    boxes = []
+    for i in np.flatnonzero(near):
+        x, y, bw, bh = cv2.boundingRect(contours[i])
+        boxes.append((max(x * scale - pad, 0), max(y * scale - pad, 0),
+                      min((x + bw) * scale + pad, w), min((y + bh) * scale + pad, h)))
+    
+    return threshold, _merge_boxes(boxes)
+
+@traced('detect')
+def detect_blood_spots_coarse_to_fine(img, x_min, x_max, y_min, y_max, center, radius, select_punched=False,
+                                      median_ksize=3, green_median_ksize=7, scale=COARSE_SCALE, pad=COARSE_PAD):
+    '''
+    Approximate, faster version of detect_blood_spots
+    
+    Blood spots touching the search circle (center, radius) are located on an image downsampled by scale
+    (see locate_spot_regions). The full resolution pipeline then runs only inside those regions, using the
+    threshold estimated at the coarse level, and the contours are mapped back to image co-ordinates.
+    Spots outside the search circle are not returned, and diameters and multispot probabilities can
+    differ slightly from detect_blood_spots (see compare_modes.py)
+    '''
+    
+    with span('detect.coarse'):
+        threshold, regions = locate_spot_regions(img, center, radius, median_ksize=median_ksize, scale=scale, pad=pad)
+    
+    parts = [_detect_in_window(img, x_min, x_max, y_min, y_max, select_punched=select_punched,
+                               median_ksize=median_ksize, green_median_ksize=green_median_ksize,
+                               window=region, threshold=threshold)
+             for region in regions]
+    
+    return DetectionResult(*_concat_detections(parts))
+
+# Width (pixels) of the band inside the edge of a processing window where results may differ from
+# full frame processing. Covers the reach of the blur, morphology and green mask steps
+WINDOW_MARGIN = 32
+
+def _box_union(a, b):
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+def _box_overlaps(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
 
-        for i in range(len(contours)):
-            # fill external contours
-            cv2.drawContours(contour_image, contours, i, (255,255,255), thickness=cv2.FILLED)               
+def _box_inside(a, b):
+    return b[0] <= a[0] and b[1] <= a[1] and a[2] <= b[2] and a[3] <= b[3]
 
-        # blur image for green mask (change kernel size from 7 to 15 for new Panthera)  
-        blurred_img_gm = cv2.medianBlur(img_rgb,15)
+def _box_grow(box, pad, w, h):
+    return (max(box[0] - pad, 0), max(box[1] - pad, 0), min(box[2] + pad, w), min(box[3] + pad, h))
 
-        ## convert to hsv and mask of green (36,25,25) ~ (86, 255,255)
-        hsv = cv2.cvtColor(blurred_img_gm, cv2.COLOR_RGB2HSV)
-        mask = cv2.inRange(hsv, (36, 25, 25), (86, 255,255))
+def _contour_boxes(contours):
+    boxes = []
+    for cnt in contours:
+        x, y, bw, bh = cv2.boundingRect(cnt)
+        boxes.append((x, y, x + bw, y + bh))
+    return boxes
 
-        # mask erosion
-        kernel = np.ones((9,9),np.uint8)
-        mask_erode = cv2.erode(mask,kernel,iterations = 2)
-        mask_erode = cv2.medianBlur(mask_erode,3)
+def _window_needed(detection, stages, window, center, radius, margin, w, h):
+    '''
+    Region that must lie inside the trusted part of a processing window for window detection to match
+    full frame detection, or None if it already does
+    
+    The trusted part is the window less a band of width margin along edges that are not frame edges.
+    The region covers the search circle and every detected contour touching it. Contours from any
+    pipeline step that reach the untrusted band and come within margin of the region are added to it,
+    as filling them at full frame may change the spots in the search circle
+    '''
+    
+    x0, y0, x1, y1 = window
+    trusted = (x0 + margin if x0 > 0 else 0, y0 + margin if y0 > 0 else 0,
+               x1 - margin if x1 < w else w, y1 - margin if y1 < h else h)
+    
+    cx, cy = center
+    region = (cx - radius, cy - radius, cx + radius + 1, cy + radius + 1)
+    
+    contours = detection.contours
+    for i in np.flatnonzero(detection.in_roi(center, radius)):
+        x, y, bw, bh = detection.bounding_rect(i)
+        region = _box_union(region, (x, y, x + bw, y + bh))
+    
+    edge_boxes = [box for stage in stages + [contours] for box in _contour_boxes(stage) if not _box_inside(box, trusted)]
+    
+    # add contours reaching the edge band until none are near the region
+    added = True
+    while added:
+        added = False
+        near = _box_grow(region, margin, w, h)
+        for box in edge_boxes:
+            if _box_overlaps(box, near) and not _box_inside(box, region):
+                region = _box_union(region, box)
+                added = True
+    
+    if _box_inside(region, trusted):
+        return None
+    
+    return region
+
+@traced('detect')
+def detect_blood_spots_window(img, x_min, x_max, y_min, y_max, center, radius, select_punched=False,
+                              median_ksize=3, green_median_ksize=7, pad=None, margin=WINDOW_MARGIN):
+    '''
+    Version of detect_blood_spots that only processes a window around the search circle (center, radius)
+    
+    The window is the search circle padded by pad pixels (default radius / 2 plus margin), clipped to the ROI
+    rectangle plus margin. The threshold is still Otsu's threshold of the whole frame, but every later step,
+    including the green mask, runs inside the window. If a contour touching the search circle, or anything
+    that could change it, comes within margin pixels of a window edge the window is enlarged and detection
+    repeated, up to the whole frame.
+    
+    The blood spots touching the search circle, their punches and their metrics are identical to those
+    from detect_blood_spots. Spots outside the window are not returned, so contour indices differ
+    '''
+    
+    h, w = img.shape[:2]
+    
+    # Otsu's threshold depends on the whole frame, so the first blur runs at full size
+    with span('detect.blur'):
+        gray = cv2.cvtColor(cv2.medianBlur(img, median_ksize), cv2.COLOR_RGB2GRAY)
+    with span('detect.threshold'):
+        threshold, _ = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    
+    if pad is None:
+        pad = radius // 2 + margin
+    
+    cx, cy = center
+    window = _box_grow((cx - radius, cy - radius, cx + radius + 1, cy + radius + 1), pad, w, h)
+    
+    # internal contours are only filled inside the ROI rectangle
+    roi = _box_grow((x_min, y_min, x_max + 1, y_max + 1), margin, w, h)
+    window = (max(window[0], roi[0]), max(window[1], roi[1]), min(window[2], roi[2]), min(window[3], roi[3]))
+    
+    while True:
+        stages = []
+        detection = DetectionResult(*_detect_in_window(img, x_min, x_max, y_min, y_max, select_punched=select_punched,
+                                                       median_ksize=median_ksize,
+                                                       green_median_ksize=green_median_ksize,
+                                                       window=window, threshold=threshold, gray=gray,
+                                                       stages=stages))
+        
+        if window == (0, 0, w, h):
+            return detection
+        
+        needed = _window_needed(detection, stages, window, center, radius, margin, w, h)
+        if needed is None:
+            return detection
+        
+        window = _box_union(window, _box_grow(needed, 2 * margin, w, h))
 
-        # add mask to grayscale image (so that punches appear as white)
-        add_punch = cv2.subtract(contour_image,mask_erode)
+# Detection modes accepted by detect_blood_spots_mode
+DETECTION_MODES = ('reference', 'coarse_to_fine', 'window')
 
-        ## detect contours of punched spot
-        p_contours, p_hierarchy = cv2.findContours(add_punch, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+def detect_blood_spots_mode(img, x_min, x_max, y_min, y_max, center, radius, select_punched=False,
+                            median_ksize=3, green_median_ksize=7, mode='reference'):
+    '''
+    Detect blood spots with the chosen detection mode
+    
+    Modes:
+        'reference' - detect_blood_spots over the whole cropped image
+        'coarse_to_fine' - detect_blood_spots_coarse_to_fine (faster, approximate)
+        'window' - detect_blood_spots_window (faster, same blood spots in the search circle)
+    '''
+    
+    if mode == 'reference':
+        return detect_blood_spots(img, x_min, x_max, y_min, y_max, select_punched=select_punched,
+                                  median_ksize=median_ksize, green_median_ksize=green_median_ksize)
+    
+    elif mode == 'coarse_to_fine':
+        return detect_blood_spots_coarse_to_fine(img, x_min, x_max, y_min, y_max, center, radius,
+                                                 select_punched=select_punched, median_ksize=median_ksize,
+                                                 green_median_ksize=green_median_ksize)
+    
+    elif mode == 'window':
+        return detect_blood_spots_window(img, x_min, x_max, y_min, y_max, center, radius,
+                                         select_punched=select_punched, median_ksize=median_ksize,
+                                         green_median_ksize=green_median_ksize)
+    
+    else:
+        raise ValueError("Detection mode must be one of " + ", ".join(DETECTION_MODES))
 
-        return p_contours, p_hierarchy    
+def bs_detect_profile(img, profile, select_punched=False, mode='reference'):
+    '''
+    Detect blood spots in a cropped image using the ROI and kernel sizes of an instrument profile
     
+    profile may be an InstrumentProfile or the name of a registered profile (e.g. '1440 x 920')
+    mode: detection mode, see detect_blood_spots_mode
+    '''
+    
+    profile = get_profile(profile)
+    x_min, x_max, y_min, y_max = profile.roi
+    
+    return detect_blood_spots_mode(img, x_min, x_max, y_min, y_max, profile.center, profile.radius,
+                                   select_punched=select_punched, median_ksize=profile.median_ksize,
+                                   green_median_ksize=profile.green_median_ksize, mode=mode)
+
+def bs_detect(img, x_min, x_max, y_min, y_max, select_punched=False):
+    '''
+    Detect blood spots in a 752 x 480 image (cropped) using threshold and contours
+    
+    See detect_blood_spots
+    '''
+    
+    profile = get_profile('752 x 480')
+    
+    return detect_blood_spots(img, x_min, x_max, y_min, y_max, select_punched=select_punched,
+                              median_ksize=profile.median_ksize, green_median_ksize=profile.green_median_ksize)
+
+def bs_detect_newPanthera(img, x_min, x_max, y_min, y_max, select_punched = False):
+    '''
+    Detect blood spots in a 1440 x 920 image (cropped) using threshold and contours
+    
+    Uses larger median kernels (13 and 15 rather than 3 and 7) as this shows best agreement with old Panthera
+    
+    See detect_blood_spots
+    ''' 
+    
+    profile = get_profile('1440 x 920')
+    
+    return detect_blood_spots(img, x_min, x_max, y_min, y_max, select_punched=select_punched,
+                              median_ksize=profile.median_ksize, green_median_ksize=profile.green_median_ksize)
+    
+@traced('draw_contours')
 def draw_bs_contours(img,contours,hierarchy, center, radius, label_contours=False, select_punched=False, punch_mode='center'):
     '''
     draw all detected blood spot contours in circular region of interest
@@ -246,272 +738,416 @@ def draw_bs_contours(img,contours,hierarchy, center, radius, label_contours=Fals
         'outline' - draw the outline of the punch contour
         'center' - draw a point at the center of the punch contour
     
+    contours may also be a DetectionResult (hierarchy is then ignored)
     '''
     
-    # define critera for selecting blood spots based on image type
-    if select_punched:
-        # third column in the array is -1 if it does not have a child contour
-        criteria = 'hierarchy[0][i][2] != -1'
-    else:
-        # last column in the array is -1 if an external contour (no contours inside of it)
-        criteria = 'hierarchy[0][i][3] == -1'
+    detection = as_detection_result(contours, hierarchy)
+    contours = detection.contours
     
-    for i in range(len(contours)):
+    # blood spots in the search area, selected based on image type (see DetectionResult.selected)
+    for i in detection.spot_indices(center, radius, select_punched):
         
-        # skip if contour is outside region of interest
-        if not contour_in_roi(contours,i,center,radius):
-            continue
+        # Draw the external contours from the list of contours
+        cv2.drawContours(img, contours, i, (0,0,255), 2)
+        
+        if label_contours:
+            cx, cy = detection.centroid(i)
+            cv2.putText(img,text=str(i),org=(cx-60,cy-60),
+                fontFace=cv2.FONT_HERSHEY_SIMPLEX,
+                fontScale=1,
+                color=(0,0,255),
+                thickness=2,lineType=cv2.LINE_AA)
+
+        # Draw the punch contours
+        if select_punched:
+            for j in detection.children[i]:
+                    
+                if punch_mode == 'outline':
+                    cv2.drawContours(img, contours, j, (255,0,0), 2)
                 
-        # last column in the array is -1 if an external contour (no contours inside of it)
-        if eval(criteria): 
-            # Draw the external contours from the list of contours
-            cv2.drawContours(img, contours, i, (0,0,255), 2)
-            
-            if label_contours:
-                M=cv2.moments(contours[i])
-                cx=int(M['m10']/M['m00'])
-                cy=int(M['m01']/M['m00'])
-                cv2.putText(img,text=str(i),org=(cx-60,cy-60),
-                    fontFace=cv2.FONT_HERSHEY_SIMPLEX,
-                    fontScale=1,
-                    color=(0,0,255),
-                    thickness=2,lineType=cv2.LINE_AA)
-
-            # Draw the punch contours
-            if select_punched:
-                for j in range(len(contours)):
-                    if hierarchy[0][j][3] == i:
-                        
-                        if punch_mode == 'outline':
-                            cv2.drawContours(img, contours, j, (255,0,0), 2)
-                        
-                        elif punch_mode == 'center':
-                            # Calculate the co-ordinates of the center of the punch
-                            M_punch = cv2.moments(contours[j])
-                            punch_cX = int(M_punch["m10"] / M_punch["m00"])
-                            punch_cY = int(M_punch["m01"] / M_punch["m00"])
-
-                            # Draw the center of the punch on the image
-                            cv2.circle(img, (punch_cX, punch_cY), 5, (255, 0, 0), -1)
-                            
-                        else:
-                            raise Exception("Punch mode must be equal to 'outline' or 'center'")
+                elif punch_mode == 'center':
+                    # Calculate the co-ordinates of the center of the punch
+                    punch_cX, punch_cY = detection.centroid(j)
+
+                    # Draw the center of the punch on the image
+                    cv2.circle(img, (punch_cX, punch_cY), 5, (255, 0, 0), -1)
+                    
+                else:
+                    raise Exception("Punch mode must be equal to 'outline' or 'center'")
                         
     return img
 
-def spot_metrics(contours,hierarchy,mm_per_pixel, center, radius, select_punched = False):
+@traced('spot_metrics')
+def spot_metrics_pixels(contours, hierarchy, center, radius, select_punched = False):
+    '''
+    Blood spot metrics in pixel units
+    
+    Rows have the same layout as spot_metrics, but perimeter, equivalent diameter, long and short sides
+    and average punch distance from center are in pixels, and the average punch distance proportion is
+    relative to the equivalent diameter in pixels. Convert with scale_spot_metrics.
+    
+    contours may also be a DetectionResult (hierarchy is then ignored)
+    '''
+    
+    detection = as_detection_result(contours, hierarchy)
+    contours = detection.contours
     
     spot_list = []
-    hull = []
+    
+    # blood spots in the search area, selected based on image type (see DetectionResult.selected)
+    for i in detection.spot_indices(center, radius, select_punched):
+        number_punches = 0
+        punch_area_list = []
+        punch_distance_list = []
+        average_punch_area=False
+        average_punch_pixel_dist_from_center=False
+        average_punch_dist_from_center_prop=False
+        
+        ## BLOOD SPOT METRICS
+        
+        area = cv2.contourArea(contours[i])
+        perimeter = cv2.arcLength(contours[i],True)
 
+        # calculate circumference and diameter of circle with area the same size as contour            
+        equiv_diam = np.sqrt(4*area/np.pi)
+        equiv_circ = np.sqrt(4*np.pi*area)
 
-    # define critera for selecting blood spots based on image type
-    if select_punched:
-        # third column in the array is -1 if it does not have a child contour
-        criteria = 'hierarchy[0][i][2] != -1'
-    else:
-        # last column in the array is -1 if an external contour (no contours inside of it)
-        criteria = 'hierarchy[0][i][3] == -1'
-    
-    for i in range(len(contours)):
+        # calculate ratio of circumference of theoretical circle to perimeter
+        # values close to 1 indicate a round bloodspot. values close to 0 indicate very irregular blood spot
+        roundness = equiv_circ/perimeter
+
+        # calculate minimum area bounding rectangle
+        (x,y),(w,h),angle = cv2.minAreaRect(contours[i])
+
+        if w>h:
+            long=w
+            short=h
+        else:
+            long=h
+            short=w
+        elongation=short/long
+
+        # calculate minimum enclosing circle
+        (x,y),min_circ_rad = cv2.minEnclosingCircle(contours[i])
+        min_circle_area = np.pi*min_circ_rad*min_circ_rad
+        circular_extent=area/min_circle_area
+
+        # convex hull properties
+        hull = detection.convex_hull(i)
+        hull_area = cv2.contourArea(hull)
+        solidity = area/hull_area
+        hull_perimeter = cv2.arcLength(hull,True)
+        convexity = hull_perimeter/perimeter
+
+        # Calculate the co-ordinates of the center of the blood spot
+        spot_cX, spot_cY = detection.centroid(i)
         
-        hull.append(cv2.convexHull(contours[i], False))
+        ### PUNCH METRICS
         
-        if not contour_in_roi(contours,i,center,radius):
-            continue
+        if select_punched:
+            # child contours (punches) of blood spot
+            for j in detection.children[i]:
+                # count number of punches for each spot
+                number_punches += 1
+
+                # calculate area of each punch and append to a list
+                punch_area = cv2.contourArea(contours[j])
+                punch_area_list.append(punch_area)
+
+                # Calculate the co-ordinates of the center of the punch
+                punch_cX, punch_cY = detection.centroid(j)
+
+                # Calculate the distance between the center of the blood spot and punch and append to list
+                punch_pixel_dist_from_center = math.sqrt((punch_cX-spot_cX)**2 + (punch_cY-spot_cY)**2)
+                punch_distance_list.append(punch_pixel_dist_from_center)
+
+            if number_punches > 0:
+                # calculate averages
+                average_punch_area = sum(punch_area_list)/len(punch_area_list)       
+                average_punch_pixel_dist_from_center = sum(punch_distance_list)/len(punch_distance_list)                                
                 
-        # last column in the array is -1 if an external contour (no contours inside of it)
-        if eval(criteria):
-            number_punches = 0
-            punch_area_list = []
-            punch_distance_list = []
-            average_punch_area=False
-            average_punch_mm_dist_from_center=False
-            average_punch_dist_from_center_prop=False
+                average_punch_dist_from_center_prop = average_punch_pixel_dist_from_center/equiv_diam
             
-            ## BLOOD SPOT METRICS
-            
-            area = cv2.contourArea(contours[i])
-            perimeter = cv2.arcLength(contours[i],True)
-            perimeter_mm = perimeter*mm_per_pixel
+        # add area of blood spot, number of punches and average punch area to list
+        spot_list.append([i,area,perimeter,roundness, equiv_diam, long,short,
+                        elongation, circular_extent, hull_area, solidity, hull_perimeter, convexity,
+                          number_punches, average_punch_area,average_punch_pixel_dist_from_center,
+                         average_punch_dist_from_center_prop])
+
+    return spot_list
+
+def scale_spot_metrics(spot_met_pixels, mm_per_pixel):
+    '''
+    Convert rows from spot_metrics_pixels to mm (returns new rows, see spot_metrics)
+    '''
+    
+    spot_list = []
+    
+    for row in spot_met_pixels:
+        (i, area, perimeter, roundness, equiv_diam, long, short, elongation, circular_extent,
+         hull_area, solidity, hull_perimeter, convexity, number_punches, average_punch_area,
+         average_punch_pixel_dist_from_center, average_punch_dist_from_center_prop) = row
+        
+        perimeter_mm = perimeter*mm_per_pixel
+        equiv_diam_mm = equiv_diam*mm_per_pixel
+        long_mm = long*mm_per_pixel
+        short_mm = short*mm_per_pixel
+        
+        # average punch distance is False if the spot has no punches
+        average_punch_mm_dist_from_center = average_punch_pixel_dist_from_center
+        if average_punch_pixel_dist_from_center is not False:
+            average_punch_mm_dist_from_center = average_punch_pixel_dist_from_center*mm_per_pixel
+            average_punch_dist_from_center_prop = average_punch_mm_dist_from_center/equiv_diam_mm
+        
+        spot_list.append([i,area,perimeter_mm,roundness, equiv_diam_mm, long_mm,short_mm,
+                          elongation, circular_extent, hull_area, solidity, hull_perimeter, convexity,
+                          number_punches, average_punch_area,average_punch_mm_dist_from_center,
+                          average_punch_dist_from_center_prop])
+    
+    return spot_list
 
-            # calculate circumference and diameter of circle with area the same size as contour            
-            equiv_diam = np.sqrt(4*area/np.pi)
-            equiv_diam_mm = equiv_diam*mm_per_pixel
-            equiv_circ = np.sqrt(4*np.pi*area)
+def spot_metrics(contours,hierarchy,mm_per_pixel, center, radius, select_punched = False):
+    '''
+    Blood spot (and punch) metrics for the selected contours in the circular search area
+    
+    Returns a list with one row per blood spot:
+    [contour_index, area, perimeter_mm, roundness, equiv_diam_mm, long_mm, short_mm, elongation,
+     circular_extent, hull_area, solidity, hull_perimeter, convexity, number_punches, average_punch_area,
+     average_punch_dist_from_center_mm, average_punch_dist_from_center_prop]
+    '''
+    
+    spot_met_pixels = spot_metrics_pixels(contours, hierarchy, center, radius, select_punched=select_punched)
+    
+    return scale_spot_metrics(spot_met_pixels, mm_per_pixel)
 
-            # calculate ratio of circumference of theoretical circle to perimeter
-            # values close to 1 indicate a round bloodspot. values close to 0 indicate very irregular blood spot
-            roundness = equiv_circ/perimeter
+SPOT_METRICS_COLUMNS = ['file', 'contour_index', 'area', 'perimeter_mm', 'roundness', 'equiv_diam_mm',
+                        'long_mm', 'short_mm', 'elongation', 'circular_extent',
+                        'hull_area', 'solidity', 'hull_perimeter', 'convexity',
+                        'number_punches', 'average_punch_area',
+                        'average_punch_dist_from_center_mm', 'average_punch_dist_from_center_prop']
 
-            # calculate minimum area bounding rectangle
-            (x,y),(w,h),angle = cv2.minAreaRect(contours[i])
+IMAGE_EXTENSIONS = ('.jpg', '.png', '.jpeg')
 
-            if w>h:
-                long=w
-                short=h
-            else:
-                long=h
-                short=w
-            long_mm=long*mm_per_pixel
-            short_mm=short*mm_per_pixel
-            elongation=short/long
-
-            # calculate minimum enclosing circle
-            (x,y),min_circ_rad = cv2.minEnclosingCircle(contours[i])
-            min_circle_area = np.pi*min_circ_rad*min_circ_rad
-            circular_extent=area/min_circle_area
-
-            # convex hull properties
-            hull_area = cv2.contourArea(hull[i])
-            solidity = area/hull_area
-            hull_perimeter = cv2.arcLength(hull[i],True)
-            convexity = hull_perimeter/perimeter
-
-            # Calculate the co-ordinates of the center of the blood spot
-        
-            M_spot = cv2.moments(contours[i])
-            spot_cX = int(M_spot["m10"] / M_spot["m00"])
-            spot_cY = int(M_spot["m01"] / M_spot["m00"])
-            
-            ### PUNCH METRICS
-            
-            if select_punched:
-                # find child contours (punches) of blood spot
-                for j in range(len(contours)):
-                    if hierarchy[0][j][3] == i:
-                        # count number of punches for each spot
-                        number_punches += 1
-
-                        # calculate area of each punch and append to a list
-                        punch_area = cv2.contourArea(contours[j])
-                        punch_area_list.append(punch_area)
-
-                        # Calculate the co-ordinates of the center of the punch
-                        M_punch = cv2.moments(contours[j])
-                        punch_cX = int(M_punch["m10"] / M_punch["m00"])
-                        punch_cY = int(M_punch["m01"] / M_punch["m00"])
-
-                        # Calculate the distance between the center of the blood spot and punch and append to list
-                        punch_pixel_dist_from_center = math.sqrt((punch_cX-spot_cX)**2 + (punch_cY-spot_cY)**2)
-                        punch_distance_list.append(punch_pixel_dist_from_center)
-
-                        # calculate averages
-                        average_punch_area = sum(punch_area_list)/len(punch_area_list)       
-                        average_punch_pixel_dist_from_center = sum(punch_distance_list)/len(punch_distance_list)                                
-                        average_punch_mm_dist_from_center = average_punch_pixel_dist_from_center*mm_per_pixel
-                        
-                        average_punch_dist_from_center_prop = average_punch_mm_dist_from_center/equiv_diam_mm
-                
-            # add area of blood spot, number of punches and average punch area to list
-            spot_list.append([i,area,perimeter_mm,roundness, equiv_diam_mm, long_mm,short_mm,
-                            elongation, circular_extent, hull_area, solidity, hull_perimeter, convexity,
-                              number_punches, average_punch_area,average_punch_mm_dist_from_center,
-                             average_punch_dist_from_center_prop])
+# Columns used by the multispot model, and columns exported by multiple image analysis
+ML_COLUMNS = ['roundness', 'elongation', 'circular_extent', 'solidity', 'convexity']
+RESULT_COLUMNS = ['file', 'sample_id', 'datetime', 'equiv_diam_mm', 'number_punches', 'pred_multi', 'prob_multi',
+                  'mm_per_pixel']
 
-    return spot_list
+def decode_image(file_bytes):
+    '''
+    Decode an encoded (jpg/png) image to a BGR array. The encoded bytes are not copied
+    '''
 
-def spot_metrics_multi_uploaded(uploaded_files, x_min, x_max, y_min, y_max,
-                                mm_per_pix, center, radius, image_size, select_punched=False):
+    with span('decode'):
+        img = cv2.imdecode(np.frombuffer(file_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    if img is None:
+        raise ValueError("Image could not be decoded")
+
+    return img
+
+def spot_metrics_decoded_pixels(img, x_min, x_max, y_min, y_max, center, radius, profile,
+                                select_punched=False, mode='reference'):
     '''
-    Calculate metrics on multiple uploaded images
+    Detect and measure blood spots in a decoded (uncropped) image using an instrument profile
 
-    Parameters:
-    - uploaded_files: list of Streamlit UploadedFile objects
+    Returns (spot_met_pixels, width), see spot_metrics_image_pixels
     '''
-    spot_list = []
-    cols = ['file', 'contour_index', 'area', 'perimeter_mm', 'roundness', 'equiv_diam_mm',
-            'long_mm', 'short_mm', 'elongation', 'circular_extent',
-            'hull_area', 'solidity', 'hull_perimeter', 'convexity',
-            'number_punches', 'average_punch_area',
-            'average_punch_dist_from_center_mm', 'average_punch_dist_from_center_prop']
-
-    for uploaded_file in uploaded_files:
-        if not uploaded_file.name.lower().endswith(('.jpg', '.png', '.jpeg')):
-            continue
 
-        # Read image from upload
-        file_bytes = np.asarray(bytearray(uploaded_file.read()), dtype=np.uint8)
-        img = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
+    width = img.shape[1]
+    
+    # Apply crop and detect DBS
+    img = profile.crop_image(img)
+    detection = detect_blood_spots_mode(img, x_min, x_max, y_min, y_max, center, radius,
+                                        select_punched=select_punched, median_ksize=profile.median_ksize,
+                                        green_median_ksize=profile.green_median_ksize, mode=mode)
+
+    # Calculate metrics
+    spot_met_pixels = spot_metrics_pixels(detection, detection.hierarchy, center, radius, select_punched=select_punched)
+    
+    return spot_met_pixels, width
 
+def spot_metrics_image_pixels(file_bytes, x_min, x_max, y_min, y_max, center, radius, profile,
+                              select_punched=False, mode='reference'):
+    '''
+    Decode an encoded (jpg/png) image, then detect and measure blood spots using an instrument profile
+    
+    mode: detection mode, see detect_blood_spots_mode
+    
+    Returns:
+        spot_met_pixels: list of spot metrics in pixel units (see spot_metrics_pixels)
+        width: width of the decoded image, so callers can check it against the profile
+    '''
+    
+    img = decode_image(file_bytes)
+
+    return spot_metrics_decoded_pixels(img, x_min, x_max, y_min, y_max, center, radius, profile,
+                                       select_punched=select_punched, mode=mode)
+
+def iter_spot_metrics(images, x_min, x_max, y_min, y_max, mm_per_pix, center, radius, image_size,
+                      select_punched=False, n_workers=1, chunksize=None, cache=None, mode='reference',
+                      n_threads=0):
+    '''
+    Calculate metrics on a stream of encoded images
+    
+    images is an iterable of (file name, encoded image bytes), consumed lazily. For each image (in input order) yields:
+        name: file name
+        rows: spot metrics rows for the image, with the file name as the first column (see SPOT_METRICS_COLUMNS)
+        warning: message describing a problem with the image, or None
+    
+    If cache is a result_cache.ResultCache, images that have already been analysed with the same
+    detection parameters are not decoded or analysed again
+    
+    mode: detection mode, see detect_blood_spots_mode
+    n_threads: number of analysis threads used when n_workers is 1, see batch.analyse_images
+    '''
+    # imported here as batch depends on this module
+    from batch import analyse_images
+
+    # Crop window and kernel sizes depend on the instrument profile
+    profile = get_profile(image_size)
+    params = dict(x_min=x_min, x_max=x_max, y_min=y_min, y_max=y_max,
+                  center=center, radius=radius, profile=profile, select_punched=select_punched, mode=mode)
+
+    image_results = analyse_images(images, params, mm_per_pix, n_workers=n_workers, chunksize=chunksize, cache=cache,
+                                   n_threads=n_threads)
+
+    for name, spot_met, width, error in image_results:
+        
+        if error is not None:
+            yield name, [], "⚠️ Could not process image " + str(name.lower()) + ": " + error
+            continue
+
+        for row in spot_met:
+            row.insert(0, name)
+        
         # Check image matches expected image size
-        if ((image_size == '752 x 480' and img.shape[1] != 752) or (image_size == '1440 x 920' and img.shape[1] != 1440)):
-            st.warning("⚠️ Unexpected image size for image  " + str(uploaded_file.name.lower()))
-        
-        # Apply crop and detect DBS (algorithm based on image type)
-        if image_size == '752 x 480':
-            img = img[0:300, 150:610]
-            contours, hierarchy = bs_detect(img, x_min, x_max, y_min, y_max, select_punched=select_punched)
-        elif image_size == '1440 x 920':
-            img = img[0:580, 250:1160]
-            contours, hierarchy = bs_detect_newPanthera(img, x_min, x_max, y_min, y_max, select_punched=select_punched)
+        if width != profile.width:
+            yield name, spot_met, "⚠️ Unexpected image size for image  " + str(name.lower())
         else:
-            raise ValueError("Image size not supported")
+            yield name, spot_met, None
 
-        # Calculate metrics
-        spot_met = spot_metrics(contours, hierarchy, mm_per_pix, center, radius, select_punched=select_punched)
+def iter_spot_metrics_uploaded(uploaded_files, x_min, x_max, y_min, y_max,
+                               mm_per_pix, center, radius, image_size, select_punched=False,
+                               n_workers=1, chunksize=None, cache=None, mode='reference', n_threads=0):
+    '''
+    Streaming version of spot_metrics_multi_uploaded
+    
+    Files are read lazily and results are yielded per image, see iter_spot_metrics.
+    Uploaded zip archives are read one image at a time, without extraction
+    '''
+    # imported here as batch depends on this module
+    from batch import iter_uploaded_images
 
-        for row in spot_met:
-            row.insert(0, uploaded_file.name)
+    images = iter_uploaded_images(uploaded_files)
+
+    yield from iter_spot_metrics(images, x_min, x_max, y_min, y_max, mm_per_pix, center, radius, image_size,
+                                 select_punched=select_punched, n_workers=n_workers, chunksize=chunksize,
+                                 cache=cache, mode=mode, n_threads=n_threads)
 
-        spot_list.extend(spot_met)
+def spot_metrics_multi_uploaded(uploaded_files, x_min, x_max, y_min, y_max,
+                                mm_per_pix, center, radius, image_size, select_punched=False,
+                                n_workers=1, chunksize=None, cache=None, mode='reference', n_threads=0):
+    '''
+    Calculate metrics on multiple uploaded images
+
+    Parameters:
+    - uploaded_files: list of Streamlit UploadedFile objects (images or zip archives of images)
+    - image_size: name of a registered instrument profile (e.g. '752 x 480' or '1440 x 920') or an InstrumentProfile
+    - n_workers: number of worker processes (1 processes images in this process, None uses all cores)
+    - chunksize: number of images sent to a worker at a time (see batch.analyse_images)
+    - cache: optional result_cache.ResultCache of previously analysed images
+    - mode: detection mode, see detect_blood_spots_mode
+    - n_threads: number of analysis threads when n_workers is 1 (0 analyses images in this thread,
+      None uses one thread per core). Decoding overlaps with analysis in a separate thread
+    
+    Images that cannot be processed are skipped with a warning rather than aborting the run
+    '''
+    spot_list = []
+
+    for name, rows, warning in iter_spot_metrics_uploaded(uploaded_files, x_min, x_max, y_min, y_max,
+                                                          mm_per_pix, center, radius, image_size,
+                                                          select_punched=select_punched,
+                                                          n_workers=n_workers, chunksize=chunksize,
+                                                          cache=cache, mode=mode, n_threads=n_threads):
+        if warning is not None:
+            st.warning(warning)
+
+        spot_list.extend(rows)
 
-    df = pd.DataFrame(spot_list, columns=cols)
+    df = pd.DataFrame(spot_list, columns=SPOT_METRICS_COLUMNS)
     return df
 
+def add_file_metadata(df, mm_per_pix):
+    '''
+    Add sample_id and datetime columns parsed from Panthera file names (<sample id>-<yyyymmdd>-<hhmmss>.jpg),
+    and the mm_per_pixel used for the analysis. Folders in the name (e.g. of images in a zip archive) are ignored
+    '''
+    
+    # Extract using regex
+    df[['sample_id', 'date_str', 'time_str']] = df['file'].str.extract(
+        r'^(?:.*/)?(.*)-(\d{8})-(\d{6})'
+    )
+
+    # Combine and convert to datetime
+    df['datetime'] = pd.to_datetime(df['date_str'] + df['time_str'], format='%Y%m%d%H%M%S')
+    df['mm_per_pixel'] = mm_per_pix
+    
+    return df
+
+def multi_image_results(rows, mm_per_pix, scaler, model):
+    '''
+    Build the Multiple Image Analysis results table (RESULT_COLUMNS) from spot metrics rows (SPOT_METRICS_COLUMNS)
+    '''
+    
+    df = pd.DataFrame(rows, columns=SPOT_METRICS_COLUMNS)
+    df = calc_multispot_prob_multi(df, ML_COLUMNS, scaler, model=model, scale=True)
+    df = add_file_metadata(df, mm_per_pix)
+    
+    return df[RESULT_COLUMNS]
+
+@traced('inference')
 def calc_multispot_prob(spot_metrics,columns,ml_columns,scaler,model,scale=True):
     '''
     return multispot probability from spot metrics (list of lists)
     
+    scaler, model: fitted StandardScaler and LogisticRegression, or scaler=None and an
+                   inference.LogisticInference. All spots are scored in one matrix operation
     '''
     
-    ms_prob_list = []
+    if len(spot_metrics) == 0:
+        return []
+    
+    engine = as_logistic_inference(scaler, model)
     
-    for cnt in spot_metrics:
     # punched spot metrics returns a list within a list
+    contour_col = columns.index('contour_index')
+    ml_idx = [columns.index(item) for item in ml_columns]
+    
+    contour_indices = [cnt[contour_col] for cnt in spot_metrics]
+    X = np.array([[cnt[i] for i in ml_idx] for cnt in spot_metrics], dtype=np.float64)
 
-        values = cnt
-        dictionary = dict(zip(columns,values))
-        contour_index = dictionary['contour_index']
-        ml_values = []
-
-        for item in ml_columns:
-            ml_values.append(dictionary[item])
-
-        # reshape X (necessary for machine learning model)
-        X = [ml_values]
-
-        # scale
-        if scale:
-            scaled_X = scaler.transform(X)
-        else:
-            scaled_X = X
-
-        # predict probability
-        prob_multi = round(model.predict_proba(scaled_X)[0][0],4)
-
-        ms_prob_list.append((contour_index, prob_multi))
+    # predict probability
+    prob_multi = engine.predict_proba(X, scale=scale)[:, 0]
     
-    return ms_prob_list
+    return [(contour_index, round(prob, 4)) for contour_index, prob in zip(contour_indices, prob_multi)]
 
+@traced('inference')
 def calc_multispot_prob_multi(spot_metrics_df,ml_columns,scaler,model,scale=True):
     '''
     adds columns for multispot prediction and probability from spot metrics dataframe
     
+    scaler, model: as for calc_multispot_prob
     '''
     
-    X = spot_metrics_df[ml_columns]
-    
-    if scale:
-        scaled_X = scaler.transform(X)
-    else:
-        scaled_X = X
+    engine = as_logistic_inference(scaler, model)
+    X = spot_metrics_df[ml_columns].to_numpy(dtype=np.float64)
     
     # calculate predictions and convert to dataframe
-    pred_multi = model.predict(scaled_X)
+    pred_multi = engine.predict(X, scale=scale)
     pred_multi_df = pd.DataFrame(pred_multi,columns=['pred_multi'])
 
-    prob_multi = model.predict_proba(scaled_X)
+    prob_multi = engine.predict_proba(X, scale=scale)
     prob_multi_df = pd.DataFrame(prob_multi,columns=['prob_multi','prob_control'])
 
     joined_multi = pred_multi_df.join(prob_multi_df)
@@ -519,93 +1155,80 @@ def calc_multispot_prob_multi(spot_metrics_df,ml_columns,scaler,model,scale=True
     
     return joined_df
 
+@traced('draw_bounding_box')
 def draw_bounding_box(img,contours,hierarchy, center, radius, spot_metrics, multispot_prob_list, select_punched, 
                       diam_range = (8,14), prob_multi_limit = 0.50, prob_multi_borderline = 0.25, 
                     green = (0,128,0), amber = (179,98,0), red = (255,0,0)):
     '''
     Draw colour coded bounding box around blood spots on the 'img'
+    
+    contours may also be a DetectionResult (hierarchy is then ignored)
     '''
     
-    # define critera for selecting blood spots based on image type
-    if select_punched:
-        # third column in the array is -1 if it does not have a child contour
-        criteria = 'hierarchy[0][i][2] != -1'
-    else:
-        # last column in the array is -1 if an external contour (no contours inside of it)
-        criteria = 'hierarchy[0][i][3] == -1'
-        
+    detection = as_detection_result(contours, hierarchy)
     
-    # loop through all contours to select contour of interest (i.e. blood spot)
+    # diameter and multispot probability of each blood spot, by contour index
+    diameters = {cnt[0]: cnt[4] for cnt in spot_metrics}
+    multispot_probs = {cnt[0]: cnt[1] for cnt in multispot_prob_list}
     
-    for i in range(len(contours)):
+    # blood spots in the search area, selected based on image type (see DetectionResult.selected)
+    for i in detection.spot_indices(center, radius, select_punched):
+        
+        #find input variables
+        diameter = diameters[i]
+        prob_multi = multispot_probs[i]
+        
+        # set outputs
+        small=False
+        large=False
+        multispotted=False
     
-        # skip if contour is outside region of interest
-        if not contour_in_roi(contours,i,center,radius):
-            continue
+        # use parameters to determine if blood spot is unsuitable
+        
+        # small
+        if diameter < diam_range[0]:
+            small=True
+        
+        if diameter > diam_range[1]:
+            large=True
+        
+        if prob_multi >= prob_multi_limit:
+            multispotted='+'
+        elif prob_multi >= prob_multi_borderline:
+            multispotted='b'  
+        else:
+            multispotted='0' 
         
-        # use criteria to select correct blood spots based on image type
-        if eval(criteria):
-            
-            #find input variables
-            for cnt in spot_metrics:
-                if cnt[0] == i:
-                    diameter = cnt[4]
-
-            for cnt in multispot_prob_list:
-                if cnt[0] == i:
-                    prob_multi = cnt[1]
-            
-            # set outputs
-            small=False
-            large=False
-            multispotted=False
         
-            # use parameters to determine if blood spot is unsuitable
-            
-            # small
-            if diameter < diam_range[0]:
-                small=True
-            
-            if diameter > diam_range[1]:
-                large=True
-            
-            if prob_multi >= prob_multi_limit:
-                multispotted='+'
-            elif prob_multi >= prob_multi_borderline:
-                multispotted='b'  
-            else:
-                multispotted='0' 
-            
-            
 
-            
-            # define colour for bounding boxes
-            box_colour = green
-            diam_colour = green
-            multiprob_colour = green
-            
-            if small or large:
-                diam_colour = red
+        
+        # define colour for bounding boxes
+        box_colour = green
+        diam_colour = green
+        multiprob_colour = green
+        
+        if small or large:
+            diam_colour = red
 
-            if multispotted == '+':
-                multiprob_colour = red
-                
-            if multispotted == 'b':
-                multiprob_colour = amber
-                box_colour = amber
-                
-            if small or large or (multispotted == '+'):
-                box_colour = red
+        if multispotted == '+':
+            multiprob_colour = red
             
-            # draw bounding box
-            x,y,w,h = cv2.boundingRect(contours[i])
-            img = cv2.rectangle(img,(x,y),(x+w,y+h),box_colour,2)
+        if multispotted == 'b':
+            multiprob_colour = amber
+            box_colour = amber
+            
+        if small or large or (multispotted == '+'):
+            box_colour = red
+        
+        # draw bounding box
+        x,y,w,h = detection.bounding_rect(i)
+        img = cv2.rectangle(img,(x,y),(x+w,y+h),box_colour,2)
 
-            # write blood spot diameter
-            img = cv2.putText(img, text=str(round(diameter,1)), org=(x-25,y-10), fontFace=cv2.FONT_HERSHEY_SIMPLEX,
-                                      fontScale=1, color=diam_colour, thickness=2, lineType=cv2.LINE_AA)  
+        # write blood spot diameter
+        img = cv2.putText(img, text=str(round(diameter,1)), org=(x-25,y-10), fontFace=cv2.FONT_HERSHEY_SIMPLEX,
+                                  fontScale=1, color=diam_colour, thickness=2, lineType=cv2.LINE_AA)  
 
-            img = cv2.putText(img, text=str(round(prob_multi,3)), org=(x+w-25,y+h+25), fontFace=cv2.FONT_HERSHEY_SIMPLEX,
-                                      fontScale=1, color=multiprob_colour, thickness=2, lineType=cv2.LINE_AA)  
-            
+        img = cv2.putText(img, text=str(round(prob_multi,3)), org=(x+w-25,y+h+25), fontFace=cv2.FONT_HERSHEY_SIMPLEX,
+                                  fontScale=1, color=multiprob_colour, thickness=2, lineType=cv2.LINE_AA)  
+        
     return img
\ No newline at end of file
@@ -0,0 +1,125 @@
+'''
+Golden mask regression check for the blood spot detection pipeline
+
+Every intermediate mask of detect_blood_spots (see functions.detection_masks) and the final contours
+are hashed for each example image, at both instrument sizes, and compared with the hashes stored in
+data/golden_masks.json. Any change to the output of the pipeline is reported:
+
+    python golden_masks.py              # check, exits with status 1 on any difference
+    python golden_masks.py --update     # regenerate data/golden_masks.json
+
+752 x 480 images are made by resizing the 1440 x 920 examples. JPEG decoding and resizing can differ
+between OpenCV builds, so only regenerate the golden file from a known good version of the pipeline.
+'''
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+
+import numpy as np
+import cv2
+
+from functions import detection_masks, bs_detect_profile
+from profiles import PROFILES
+from batch import iter_image_files
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+EXAMPLES_PATH = os.path.join(APP_DIR, 'data', 'example_dbs.zip')
+GOLDEN_PATH = os.path.join(APP_DIR, 'data', 'golden_masks.json')
+
+
+def _digest(*arrays):
+    h = hashlib.sha256()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(str(a.shape).encode('ascii'))
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+
+def image_hashes(img, profile):
+    ''' Hashes of the intermediate masks and final contours for one cropped image
+    '''
+
+    x_min, x_max, y_min, y_max = profile.roi
+    hashes = {}
+
+    for select_punched in (False, True):
+        masks = detection_masks(img, x_min, x_max, y_min, y_max, select_punched=select_punched,
+                                median_ksize=profile.median_ksize, green_median_ksize=profile.green_median_ksize)
+        contours, hierarchy = bs_detect_profile(img, profile, select_punched=select_punched)
+
+        prefix = 'punched' if select_punched else 'all'
+        for step, mask in masks.items():
+            hashes[f'{prefix}/{step}'] = _digest(mask)
+        hashes[f'{prefix}/contours'] = _digest(*contours, np.zeros(0) if hierarchy is None else hierarchy)
+
+    return hashes
+
+
+def golden_hashes(sources):
+    ''' Hashes for every example image at every registered instrument size
+    '''
+
+    results = {}
+    reference = max(PROFILES.values(), key=lambda p: p.width)
+
+    for name, data in iter_image_files(sources):
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+        for profile in PROFILES.values():
+            if img.shape[1] == profile.width:
+                sized = img
+            elif img.shape[1] == reference.width:
+                sized = cv2.resize(img, profile.image_size, interpolation=cv2.INTER_AREA)
+            else:
+                continue
+            results[f'{name} [{profile.name}]'] = image_hashes(profile.crop_image(sized), profile)
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check detection masks against the golden hashes")
+    parser.add_argument('inputs', nargs='*', default=[EXAMPLES_PATH],
+                        help="example images (default: data/example_dbs.zip)")
+    parser.add_argument('--golden', default=GOLDEN_PATH, help="golden hash file (default: data/golden_masks.json)")
+    parser.add_argument('--update', action='store_true', help="write the current hashes to the golden file")
+    args = parser.parse_args(argv)
+
+    current = golden_hashes(args.inputs)
+
+    if args.update:
+        with open(args.golden, 'w') as f:
+            json.dump({'opencv_version': cv2.__version__, 'images': current}, f, indent=1, sort_keys=True)
+        print(f"Wrote hashes for {len(current)} images to {args.golden}")
+        return 0
+
+    with open(args.golden) as f:
+        golden = json.load(f)
+
+    if golden['opencv_version'] != cv2.__version__:
+        print(f"Note: golden hashes were made with OpenCV {golden['opencv_version']}, "
+              f"running {cv2.__version__}", file=sys.stderr)
+
+    failures = 0
+    for key, expected in golden['images'].items():
+        actual = current.get(key)
+        if actual is None:
+            print(f"MISSING {key}")
+            failures += 1
+            continue
+        changed = sorted(step for step in expected if actual.get(step) != expected[step])
+        if changed:
+            print(f"CHANGED {key}: {', '.join(changed)}")
+            failures += 1
+
+    print(f"{len(golden['images']) - failures} of {len(golden['images'])} images match the golden masks")
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+import numpy as np
+
+
+class LogisticInference:
+    '''
+    Multispot classifier evaluated with plain NumPy arrays
+
+    Holds the parameters of a fitted StandardScaler and binary LogisticRegression, so any number of
+    spots can be scored in one matrix operation without scikit-learn's per-call validation.
+    Results match scaler.transform followed by model.predict / model.predict_proba
+
+    mean, scale: scaler mean_ and scale_ (None if the scaler did not centre / scale)
+    coef, intercept: logistic regression coef_ (1, n_features) and intercept_ (1,)
+    classes: class labels, ordered as model.classes_
+    '''
+
+    def __init__(self, mean, scale, coef, intercept, classes):
+        self.mean = None if mean is None else np.asarray(mean, dtype=np.float64)
+        self.scale = None if scale is None else np.asarray(scale, dtype=np.float64)
+        self.coef = np.asarray(coef, dtype=np.float64).reshape(1, -1)
+        self.intercept = np.asarray(intercept, dtype=np.float64).reshape(1)
+        self.classes = np.asarray(classes)
+
+        if len(self.classes) != 2:
+            raise ValueError("Only binary logistic models are supported")
+
+    @classmethod
+    def from_estimators(cls, scaler, model):
+        '''
+        Extract the parameters of fitted scikit-learn estimators
+
+        scaler: StandardScaler, or None if features are passed to the model unscaled
+        model: binary LogisticRegression
+        '''
+
+        mean = scale = None
+        if scaler is not None:
+            mean = scaler.mean_ if getattr(scaler, 'with_mean', True) else None
+            scale = scaler.scale_ if getattr(scaler, 'with_std', True) else None
+
+        return cls(mean, scale, model.coef_, model.intercept_, model.classes_)
+
+    @property
+    def n_features(self):
+        return self.coef.shape[1]
+
+    def transform(self, X):
+        ''' Standardise features (n_spots, n_features) as the scaler would
+        '''
+
+        X = np.array(X, dtype=np.float64, ndmin=2)
+
+        if X.shape[1] != self.n_features:
+            raise ValueError(f"Expected {self.n_features} features, got {X.shape[1]}")
+
+        if self.mean is not None:
+            X -= self.mean
+        if self.scale is not None:
+            X /= self.scale
+
+        return X
+
+    def decision_function(self, X, scale=True):
+        ''' Log-odds of the second class for each spot
+        '''
+
+        X = self.transform(X) if scale else np.array(X, dtype=np.float64, ndmin=2)
+        return (X @ self.coef.T + self.intercept).ravel()
+
+    def predict_proba(self, X, scale=True):
+        '''
+        Class probabilities (n_spots, 2), columns ordered as classes
+        '''
+
+        d = self.decision_function(X, scale=scale)
+
+        # logistic function, written so exp never overflows
+        e = np.exp(-np.abs(d))
+        p = np.where(d >= 0, 1 / (1 + e), e / (1 + e))
+
+        return np.stack([1 - p, p], axis=1)
+
+    def predict(self, X, scale=True):
+        ''' Predicted class label for each spot
+        '''
+
+        d = self.decision_function(X, scale=scale)
+        return self.classes[(d > 0).astype(int)]
+
+
+def as_logistic_inference(scaler, model):
+    '''
+    Return model if it is already a LogisticInference, otherwise extract one from
+    scikit-learn estimators (see LogisticInference.from_estimators)
+    '''
+
+    if isinstance(model, LogisticInference):
+        return model
+
+    return LogisticInference.from_estimators(scaler, model)
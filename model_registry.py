@@ -0,0 +1,113 @@
+import io
+import os
+import hashlib
+import threading
+import warnings
+
+from joblib import load
+
+from inference import LogisticInference
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+SCALER_PATH = os.path.join(APP_DIR, 'log_model_scaler_220828.joblib')
+MODEL_PATH = os.path.join(APP_DIR, 'log_model_final_220828.joblib')
+
+
+class ModelRegistry:
+    '''
+    Loads each model artifact once per process and shares it between sessions and threads
+
+    Entries are keyed on the absolute file path and validated against the file's size and
+    modification time on every lookup. If the file has changed it is hashed again and reloaded,
+    so a replaced model is never served from the cache. Objects returned are shared, so callers
+    must not modify them.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # path -> (stat signature, sha256, object)
+        self._artifacts = {}
+        # (scaler sha256, model sha256) -> LogisticInference
+        self._engines = {}
+        self.loads = 0
+
+    @staticmethod
+    def _signature(path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+
+    def _load_artifact(self, path, expected_sha256=None):
+        # caller holds the lock
+        path = os.path.abspath(path)
+        signature = self._signature(path)
+        entry = self._artifacts.get(path)
+
+        if entry is None or entry[0] != signature:
+            with open(path, 'rb') as f:
+                data = f.read()
+            sha256 = hashlib.sha256(data).hexdigest()
+
+            # the file may have been touched without changing its contents
+            if entry is not None and entry[1] == sha256:
+                entry = (signature, sha256, entry[2])
+            else:
+                # models were saved with an older version of scikit-learn
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    obj = load(io.BytesIO(data))
+                entry = (signature, sha256, obj)
+                self.loads += 1
+
+            self._artifacts[path] = entry
+
+        if expected_sha256 is not None and entry[1] != expected_sha256:
+            raise ValueError(f"{os.path.basename(path)} does not match the expected SHA-256 hash")
+
+        return entry[1], entry[2]
+
+    def get(self, path, expected_sha256=None):
+        '''
+        Return the deserialised joblib artifact at path
+
+        expected_sha256: optional hex digest the file must match, otherwise ValueError is raised
+        '''
+        with self._lock:
+            return self._load_artifact(path, expected_sha256)[1]
+
+    def sha256(self, path):
+        ''' SHA-256 hex digest of the artifact currently loaded from path
+        '''
+        with self._lock:
+            return self._load_artifact(path)[0]
+
+    def multispot_model(self, scaler_path=SCALER_PATH, model_path=MODEL_PATH):
+        '''
+        Return the multispot classifier as an inference.LogisticInference, built once per
+        version of the scaler and model files
+        '''
+        with self._lock:
+            scaler_sha, scaler = self._load_artifact(scaler_path)
+            model_sha, model = self._load_artifact(model_path)
+
+            engine = self._engines.get((scaler_sha, model_sha))
+            if engine is None:
+                engine = LogisticInference.from_estimators(scaler, model)
+                self._engines[(scaler_sha, model_sha)] = engine
+
+            return engine
+
+    def clear(self):
+        with self._lock:
+            self._artifacts.clear()
+            self._engines.clear()
+
+
+# Registry shared by everything in this process (all Streamlit sessions and pages)
+MODELS = ModelRegistry()
+
+
+def get_multispot_model(scaler_path=SCALER_PATH, model_path=MODEL_PATH):
+    '''
+    Multispot classifier from the process-wide registry, see ModelRegistry.multispot_model
+    '''
+    return MODELS.multispot_model(scaler_path, model_path)
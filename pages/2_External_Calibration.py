@@ -7,10 +7,10 @@ st.set_page_config(page_title="Calibration | DBS Vision App", page_icon="🩸",
 st.title("External calibration")
 
 from functions import (
-    bs_detect,
-    bs_detect_newPanthera,
+    bs_detect_profile,
     calibrate_mm_per_pixel_circle,
     draw_bs_contours)
+from profiles import profile_for_size, supported_sizes
 
 st.markdown(
 "On this page you can calculate the mm_per_pixel parameter for a Panthera puncher. \n \n" \
@@ -41,52 +41,30 @@ if uploaded_file:
 
     image_shape = img.shape
     image_width = image_shape[1]
-    if image_width == 752:
+    # Select crop window, ROI and search area for this camera format
+    profile = profile_for_size(image_width)
 
-        # Default coordinates for outer rectangle:
-        x_min=1
-        x_max=459
-        y_min=50
-        y_max=299
+    if profile is None:
+        st.warning(f"Incorrect image width, expect {supported_sizes()}, got {image_width}")
+        st.stop()
 
-        # Default coordinates and radius for search area
+    # Coordinates and radius for search area - these may need tweaking depending on the configuration of the Panthera puncher
+    center = profile.center
+    radius = profile.radius
 
-        center = (209,139)
-        radius = 68
+    img = profile.crop_image(img)
 
-        img = img[0:300, 150:610]
- 
-        # Run processing pipeline
-        contours, hierarchy = bs_detect(img, x_min, x_max, y_min, y_max, select_punched=True)
-    
-    elif image_width == 1440:
-
-         # Default coordinates for outer rectangle
-        # This rectangle defines the region that the blood spot must fall completely within
-        x_min=5
-        x_max=900
-        y_min=50
-        y_max=575
-
-        # Default coordinates and radius for search area - these may need tweaking depending on the configuration of the Panthera puncher
-        center = (461,226)
-        radius = 130
-    
-        img = img[0:580, 250:1160]
-
-        contours, hierarchy = bs_detect_newPanthera(img, x_min, x_max, y_min, y_max, select_punched=True)
-
-    else:
-        st.warning(f"Incorrect image width, expect 1440 or 752, got {image_width}")
+    # Run processing pipeline. Per-contour values are computed once and shared by the metric and drawing functions
+    detection = bs_detect_profile(img, profile, select_punched=True)
 
     img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
     # draw contours
-    contour_img = draw_bs_contours(img_rgb.copy(),contours,hierarchy, center, radius, select_punched=True)
+    contour_img = draw_bs_contours(img_rgb.copy(), detection, detection.hierarchy, center, radius, select_punched=True)
 
     st.image(contour_img, channels="RGB", use_container_width=True)
 
-    mm_per_pixel = round(calibrate_mm_per_pixel_circle(contours,hierarchy, center, radius, cal_radius),4)
+    mm_per_pixel = round(calibrate_mm_per_pixel_circle(detection, detection.hierarchy, center, radius, cal_radius),4)
 
     st.markdown(
     "Make a note of the following parameter, which should be entered when analysing images from this Panthera using the algorithm")
@@ -1,16 +1,16 @@
 import streamlit as st
 import numpy as np
 import cv2
-from joblib import load
 
 from functions import (
-    bs_detect,
-    bs_detect_newPanthera,
+    bs_detect_profile,
     spot_metrics,
     calc_multispot_prob,
     draw_bs_contours,
     draw_bounding_box
 )
+from profiles import profile_for_size, supported_sizes
+from model_registry import get_multispot_model
 
 st.set_page_config(page_title="Single Image Analysis | DBS Vision App", page_icon="🩸", layout="wide")
 
@@ -31,9 +31,8 @@ if uploaded_file:
     file_bytes = np.asarray(bytearray(uploaded_file.read()), dtype=np.uint8)
     img = cv2.imdecode(file_bytes, 1)
 
-    # Load models
-    scaler = load('log_model_scaler_220828.joblib')
-    log_model = load('log_model_final_220828.joblib')
+    # Multispot model, loaded once per process and shared between sessions
+    log_model = get_multispot_model()
 
     # Define columns
     cols = ['contour_index','area','perimeter_mm','roundness','equiv_diam_mm', 
@@ -44,52 +43,30 @@ if uploaded_file:
 
     image_shape = img.shape
     image_width = image_shape[1]
-    if image_width == 752:
+    # Select crop window, ROI and search area for this camera format
+    profile = profile_for_size(image_width)
 
-        # Default coordinates for outer rectangle:
-        x_min=1
-        x_max=459
-        y_min=50
-        y_max=299
+    if profile is None:
+        st.warning(f"Incorrect image width, expect {supported_sizes()}, got {image_width}")
+        st.stop()
 
-        # Default coordinates and radius for search area
+    # Coordinates and radius for search area - these may need tweaking depending on the configuration of the Panthera puncher
+    center = profile.center
+    radius = profile.radius
 
-        center = (209,139)
-        radius = 68
+    img = profile.crop_image(img)
 
-        img = img[0:300, 150:610]
- 
-        # Run processing pipeline
-        contours, hierarchy = bs_detect(img, x_min, x_max, y_min, y_max, select_punched=True)
-    
-    elif image_width == 1440:
-
-         # Default coordinates for outer rectangle
-        # This rectangle defines the region that the blood spot must fall completely within
-        x_min=5
-        x_max=900
-        y_min=50
-        y_max=575
-
-        # Default coordinates and radius for search area - these may need tweaking depending on the configuration of the Panthera puncher
-        center = (461,226)
-        radius = 130
-    
-        img = img[0:580, 250:1160]
-
-        contours, hierarchy = bs_detect_newPanthera(img, x_min, x_max, y_min, y_max, select_punched=True)
-
-    else:
-        st.warning(f"Incorrect image width, expect 1440 or 752, got {image_width}")
+    # Run processing pipeline. Per-contour values are computed once and shared by the metric and drawing functions
+    detection = bs_detect_profile(img, profile, select_punched=True)
 
     img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    spot_met = spot_metrics(contours, hierarchy, mm_per_pixel, center, radius, select_punched=True)
-    prob_ms_list = calc_multispot_prob(spot_met, cols, ml_cols, scaler, log_model)
-    contour_img = draw_bs_contours(img_rgb.copy(), contours, hierarchy, center, radius, select_punched=True)
+    spot_met = spot_metrics(detection, detection.hierarchy, mm_per_pixel, center, radius, select_punched=True)
+    prob_ms_list = calc_multispot_prob(spot_met, cols, ml_cols, None, log_model)
+    contour_img = draw_bs_contours(img_rgb.copy(), detection, detection.hierarchy, center, radius, select_punched=True)
     bounding_box_img = draw_bounding_box(
         contour_img.copy(),
-        contours,
-        hierarchy,
+        detection,
+        detection.hierarchy,
         center,
         radius,
         spot_met,
@@ -100,13 +77,8 @@ if uploaded_file:
     )
 
     # Show warning if mm_per_pixel is outside expected range
-    expected_ranges = {
-        752: (0.11, 0.13),
-        1440: (0.05, 0.07)
-    }
-
-    if image_width in expected_ranges:
-        lower, upper = expected_ranges[image_width]
+    if profile.mm_per_pixel_range is not None:
+        lower, upper = profile.mm_per_pixel_range
         if not (lower <= mm_per_pixel <= upper):
             st.warning("""
             ⚠️ mm per pixel is out of the expected range.  
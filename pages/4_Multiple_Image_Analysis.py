@@ -1,21 +1,42 @@
 import streamlit as st
 import pandas as pd
-import io
-from PIL import Image
+import time
 
 st.set_page_config(page_title="Multiple Image Analysis | DBS Vision App", page_icon="🩸", layout="wide")
 
 st.title("Multiple image analysis")
 
-from functions import spot_metrics_multi_uploaded, calc_multispot_prob_multi
-from joblib import load
+# not part of the public Streamlit API, only used to free uploads early (see release_uploaded_files)
+try:
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+except ImportError:
+    get_script_run_ctx = None
 
-scaler = load('log_model_scaler_220828.joblib')
-log_model = load('log_model_final_220828.joblib') 
+from functions import (
+    iter_spot_metrics,
+    multi_image_results,
+    RESULT_COLUMNS
+)
+from profiles import profile_for_size, supported_sizes
+from batch import PARALLEL_MIN_IMAGES
+from result_cache import ResultCache
+from model_registry import get_multispot_model
+from profiling import capture, TimingSummary, TraceRecorder
+from staging import StagingArea
+from results_io import results_to_parquet
+
+# Multispot model, loaded once per process and shared between sessions
+log_model = get_multispot_model()
+
+# Minimum time between updates of the partial results table
+REFRESH_SECONDS = 0.5
+
+# Results of previously analysed images, shared by all sessions
+@st.cache_resource
+def get_result_cache():
+    return ResultCache()
 
-### Define columns
-ml_cols = ['roundness','elongation','circular_extent','solidity','convexity']
-cols_to_show = ['file','sample_id','datetime','equiv_diam_mm','number_punches','pred_multi','prob_multi','mm_per_pixel']
+result_cache = get_result_cache()
 
 st.markdown(
     "On this page you can analysis multiple image files. \n \n"
@@ -26,33 +47,75 @@ st.markdown(
 # Main page input FIRST
 mm_per_pix = st.number_input("🔧 mm per pixel", value=0.1161, format="%.4f")
 
+show_timings = st.checkbox("Show per-stage timing breakdown", value=False,
+                           help="Record how long each stage of the analysis takes")
+
+def release_uploaded_files(uploaded_files):
+    # Streamlit keeps uploaded files in memory until the session ends. Once they are staged the uploader
+    # is replaced by an empty one, and the files are removed early where this Streamlit version allows it
+    ctx = get_script_run_ctx() if get_script_run_ctx is not None else None
+    remove_file = getattr(getattr(ctx, 'uploaded_file_mgr', None), 'remove_file', None)
+    session_id = getattr(ctx, 'session_id', None)
+
+    if remove_file is not None and session_id is not None:
+        for file in uploaded_files:
+            file_id = getattr(file, 'file_id', None)
+            if file_id is None:
+                continue
+            try:
+                remove_file(session_id, file_id)
+            except Exception:
+                # freeing memory early is optional, the files are released with the session
+                pass
+
+    st.session_state['uploader_key'] = st.session_state.get('uploader_key', 0) + 1
+
+
 uploaded_files = st.file_uploader(
-    "Upload one or more image files from the Panthera puncher. All images must have the same size",
-    type=["jpg", "jpeg", "png"],
-    accept_multiple_files=True
+    "Upload one or more image files from the Panthera puncher, or zip archives of images. All images must have the same size",
+    type=["jpg", "jpeg", "png", "zip"],
+    accept_multiple_files=True,
+    key=f"uploaded_files_{st.session_state.get('uploader_key', 0)}"
 )
 
-# Helper class to preserve file name on BytesIO
-class NamedBytesIO(io.BytesIO):
-    def __init__(self, data, name):
-        super().__init__(data)
-        self.name = name
+if uploaded_files:
+    with st.spinner("Staging uploaded images..."):
+        # images are kept in memory up to a budget shared by all sessions (DBSVISION_STAGING_MEMORY_MB), the
+        # rest is spilled to disk. Images in zip archives are staged one at a time, without extraction
+        if 'staged_images' in st.session_state:
+            st.session_state.pop('staged_images').close()
 
+        staging = StagingArea()
+        staging.add_uploaded_files(uploaded_files)
+        st.session_state['staged_images'] = staging
+
+    release_uploaded_files(uploaded_files)
+    st.rerun()
+
+staging = st.session_state.get('staged_images')
+
+if staging is not None:
+    st.caption(f"{len(staging)} images staged ({staging.memory_bytes / 1e6:.0f} MB in memory, "
+               f"{staging.spilled_bytes / 1e6:.0f} MB on disk)")
+
+    if st.button("Clear images"):
+        st.session_state.pop('staged_images').close()
+        st.rerun()
 
-if uploaded_files:
     with st.spinner("Checking image sizes..."):
-        sizes = []
-        file_buffers = []
+        # sizes were read from the image headers when staging, images are only decoded once during processing
+        sizes = staging.sizes
 
-        for file in uploaded_files:
-            data = file.read()
-            buffer = NamedBytesIO(data, file.name)  # keep filename
-            file_buffers.append(buffer)
+        # files that are not readable images have no size, they are reported when processed
+        unique_sizes = set(size for size in sizes if size is not None)
 
-            img = Image.open(io.BytesIO(data))
-            sizes.append(img.size)
+        if not sizes:
+            st.error("❌ No images found in the uploaded files.")
+            st.stop()
 
-        unique_sizes = set(sizes)
+        if not unique_sizes:
+            st.error("❌ None of the uploaded files could be read as an image.")
+            st.stop()
 
         if len(unique_sizes) > 1:
             st.error(f"❌ Images have mixed sizes: {unique_sizes}. Please upload only one size at a time.")
@@ -63,25 +126,18 @@ if uploaded_files:
         image_width = image_size[0]
 
         # Parameter sets
-        if image_size == (752, 480):
-            x_min, x_max, y_min, y_max = 1, 459, 50, 299
-            center, radius = (209,139), 68
-
-        elif image_size == (1440, 920):
-            x_min, x_max, y_min, y_max = 5, 900, 50, 575
-            center, radius = (461,226), 130
+        profile = profile_for_size(*image_size)
 
-        else:
-            st.error(f"❌ Unsupported image size: {image_size}. Only 752x480 or 1440x920 supported.")
+        if profile is None:
+            st.error(f"❌ Unsupported image size: {image_size}. Only {supported_sizes()} supported.")
             st.stop()
 
+        x_min, x_max, y_min, y_max = profile.roi
+        center, radius = profile.center, profile.radius
+
         # --- Check mm_per_pixel range ---
-        expected_ranges = {
-            752: (0.11, 0.13),
-            1440: (0.05, 0.07)
-        }
-        if image_width in expected_ranges:
-            lower, upper = expected_ranges[image_width]
+        if profile.mm_per_pixel_range is not None:
+            lower, upper = profile.mm_per_pixel_range
             if not (lower <= mm_per_pix <= upper):
                 st.warning(f"""
                 ⚠️ mm per pixel is out of the expected range for {image_width}px images ({lower:.2f}–{upper:.2f}).  
@@ -89,34 +145,91 @@ if uploaded_files:
                 Please check and review the [Configuration page](Configuration).
                 """)
 
-    # Now process
-    with st.spinner("Processing images..."):
-        df = spot_metrics_multi_uploaded(
-            file_buffers, x_min, x_max, y_min, y_max,
-            mm_per_pix, center, radius, image_size=f"{image_size[0]} x {image_size[1]}", select_punched=True
+    # Now process, showing results as they are produced
+    n_files = len(sizes)
+    progress_bar = st.progress(0.0, text="Processing images...")
+    results_table = st.empty()
+
+    result_parts = []
+    pending_rows = []
+    last_refresh = 0.0
+    cache_hits, cache_misses = result_cache.hits, result_cache.misses
+
+    def add_pending_rows():
+        # score and format rows produced since the last refresh
+        if pending_rows:
+            result_parts.append(multi_image_results(pending_rows, mm_per_pix, None, log_model))
+            pending_rows.clear()
+
+    # profiling sinks, only when the timing breakdown is requested
+    sinks = (TimingSummary(), TraceRecorder()) if show_timings else ()
+    run_start = time.monotonic()
+
+    with capture(*sinks):
+        # staged images are read one at a time. Images kept in memory are moved to disk once analysed, so
+        # the session only keeps them on disk for later reruns
+        image_results = iter_spot_metrics(
+            staging, x_min, x_max, y_min, y_max,
+            mm_per_pix, center, radius, image_size=profile, select_punched=True,
+            n_workers=None if n_files >= PARALLEL_MIN_IMAGES else 1,
+            n_threads=None,  # smaller batches are decoded and analysed in threads of this process
+            cache=result_cache
         )
 
-        df = calc_multispot_prob_multi(df, ml_cols, scaler, model=log_model, scale=True)
+        for n_done, (name, rows, warning) in enumerate(image_results, start=1):
+            if warning is not None:
+                st.warning(warning)
 
-        # Extract using regex
-        df[['sample_id', 'date_str', 'time_str']] = df['file'].str.extract(
-            r'^(.*)-(\d{8})-(\d{6})'
-        )
+            pending_rows.extend(rows)
 
-        # Combine and convert to datetime
-        df['datetime'] = pd.to_datetime(df['date_str'] + df['time_str'], format='%Y%m%d%H%M%S')
-        df['mm_per_pixel'] = mm_per_pix
-        df = df[cols_to_show]
-    
-    st.success(f"✅ Metrics calculated for {len(df)} images (size {image_size[0]}x{image_size[1]})!")
-    st.dataframe(df)
+            # refresh the partial results table at most every REFRESH_SECONDS
+            if time.monotonic() - last_refresh >= REFRESH_SECONDS or n_done == n_files:
+                add_pending_rows()
+                if result_parts:
+                    results_table.dataframe(pd.concat(result_parts, ignore_index=True))
+                progress_bar.progress(n_done / n_files, text=f"Processed {n_done} of {n_files} images")
+                last_refresh = time.monotonic()
+
+        add_pending_rows()
+
+    progress_bar.empty()
 
-    # Optional: CSV download
+    if sinks:
+        # keep the breakdown of the last run for this session
+        summary, trace = sinks
+        st.session_state['last_run_timings'] = (summary.to_dataframe(), trace.to_json(),
+                                                time.monotonic() - run_start, n_files)
+
+    if result_parts:
+        df = pd.concat(result_parts, ignore_index=True)
+    else:
+        df = pd.DataFrame(columns=RESULT_COLUMNS)
+
+    st.success(f"✅ Metrics calculated for {len(df)} images (size {image_size[0]}x{image_size[1]})!")
+    st.caption(f"Result cache: {result_cache.hits - cache_hits} hits, {result_cache.misses - cache_misses} misses "
+               f"({len(result_cache)} images cached)")
+    results_table.dataframe(df)
+
+    if show_timings and 'last_run_timings' in st.session_state:
+        timings, trace_json, run_seconds, run_images = st.session_state['last_run_timings']
+        with st.expander("⏱️ Per-stage timing breakdown of the last run", expanded=True):
+            st.caption(f"{run_images} images in {run_seconds:.1f} s. Stages nest (e.g. detect contains detect.blur), "
+                       "so totals do not add up to the run time. Results found in the result cache are not timed.")
+            st.dataframe(timings, hide_index=True)
+            st.download_button("Download trace (open in Perfetto or chrome://tracing)", data=trace_json,
+                               file_name="dbsvision_trace.json", mime='application/json')
+
+    # Optional: CSV or Parquet download. Parquet keeps the column types and is faster to load on the analysis pages
     csv = df.to_csv(index=False).encode('utf-8')
-    st.download_button("Download results as CSV", data=csv, file_name="spot_metrics.csv", mime='text/csv')
+    col_csv, col_parquet = st.columns(2)
+    with col_csv:
+        st.download_button("Download results as CSV", data=csv, file_name="spot_metrics.csv", mime='text/csv')
+    with col_parquet:
+        st.download_button("Download results as Parquet", data=results_to_parquet(df), file_name="spot_metrics.parquet",
+                           mime='application/vnd.apache.parquet')
 
     st.markdown(
-    "To analyse data in the .csv file, visit the [Data Analysis page](./Data_Analysis)."
+    "To analyse data in the .csv or .parquet file, visit the [Data Analysis page](./Data_Analysis)."
     )
 
 else:
@@ -1,8 +1,11 @@
 import streamlit as st
 import pandas as pd
-import seaborn as sns
 import matplotlib.pyplot as plt
 
+from results_io import iter_results_chunks, date_range_bounds
+from analysis import aggregate_results
+from ecdf import plot_ecdf
+
 st.set_page_config(page_title="Data Analysis | DBS Vision App", page_icon="🩸", layout="wide")
 
 st.title("Data analysis")
@@ -14,36 +17,40 @@ st.markdown(
 # --- Upload CSV(s) ---
 st.subheader("Data Upload")
 uploaded_files = st.file_uploader(
-    "Upload one or more CSV files",
-    type=["csv"],
+    "Upload one or more CSV or Parquet files",
+    type=["csv", "parquet"],
     accept_multiple_files=True
 )
 
+# Files are read in chunks into monthly totals and diameter counts, so histories larger than memory
+# can be analysed. The totals are kept between reruns, so changing a widget does not read the files again
+@st.cache_resource(show_spinner="Reading results...", max_entries=4)
+def load_aggregates(files, filter_option, start, end):
+    return aggregate_results(iter_results_chunks(files, start=start, end=end),
+                             first_punch=filter_option == "First punch for each sample ID")
+
 filter_option = st.radio(
     "Select which data to include:",
     ["All rows", "First punch for each sample ID"],
     horizontal=True
 )
 
-if uploaded_files:
-    # Read and concatenate all uploaded CSVs
-    df_list = []
-    for file in uploaded_files:
-        temp_df = pd.read_csv(file)
-        df_list.append(temp_df)
+# Parquet files are only read for the selected dates
+date_range = st.date_input("Only include results between these dates (optional):", value=[])
+start, end = date_range_bounds(date_range)
 
-    df = pd.concat(df_list, ignore_index=True)
-    df['datetime'] = pd.to_datetime(df['datetime'], errors='coerce')
-
-    if filter_option == "First punch for each sample ID":
-        df = df.sort_values(['sample_id', 'datetime']).drop_duplicates('sample_id', keep='first')
+if uploaded_files:
+    # Read and summarise all uploaded files
+    aggregates = load_aggregates(uploaded_files, filter_option, start, end)
+    totals = aggregates.totals()
+    diameters = aggregates.distribution()
 
     # DBS Classification
     st.subheader("DBS classification")
-    total_count = len(df)
-    acceptable_count = len(df[(df['pred_multi'] == 'controls') & (df['equiv_diam_mm'] >= 8)])
-    insufficient_count = len(df[(df['equiv_diam_mm'] < 8)])
-    multispotted_count = len(df[(df['pred_multi'] == '0304') & (df['equiv_diam_mm'] >= 8)])
+    total_count = totals['total']
+    acceptable_count = totals['acceptable']
+    insufficient_count = totals['small']
+    multispotted_count = totals['multispotted']
 
     acceptable_pct = round((acceptable_count/total_count)*100,2)
     insufficient_pct = round((insufficient_count/total_count)*100,2)
@@ -69,12 +76,12 @@ if uploaded_files:
     # DBS diameter
     st.subheader("DBS diameter distribution")
 
-    DBS_mean = round(df['equiv_diam_mm'].mean(), 2)
-    DBS_median = round(df['equiv_diam_mm'].median(), 2)
-    DBS_p25 = round(df['equiv_diam_mm'].quantile(0.25), 2)
-    DBS_p75 = round(df['equiv_diam_mm'].quantile(0.75), 2)
-    DBS_p5 = round(df['equiv_diam_mm'].quantile(0.05), 2)
-    DBS_p95 = round(df['equiv_diam_mm'].quantile(0.95), 2)
+    DBS_mean = round(diameters.mean(), 2)
+    DBS_median = round(diameters.median(), 2)
+    DBS_p25 = round(diameters.quantile(0.25), 2)
+    DBS_p75 = round(diameters.quantile(0.75), 2)
+    DBS_p5 = round(diameters.quantile(0.05), 2)
+    DBS_p95 = round(diameters.quantile(0.95), 2)
 
     colA, colB = st.columns(2)
 
@@ -87,7 +94,8 @@ if uploaded_files:
 
     fig, ax = plt.subplots()
     
-    sns.ecdfplot(data=df, x='equiv_diam_mm', ax=ax)
+    # step curve with a fixed number of points, exact at 8 mm and the percentiles above
+    plot_ecdf(ax, diameters)
 
     ax.axvline(x=8, color='red', linestyle='--', linewidth=1.5)
     ax.text(8, 0.05, '8 mm', color='red', rotation=90, va='bottom', ha='right')
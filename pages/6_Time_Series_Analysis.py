@@ -1,8 +1,12 @@
 import streamlit as st
-import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 
+from results_io import iter_results_chunks, date_range_bounds
+from analysis import PeriodSummary, aggregate_results
+from summary_store import SummaryStore, UNKNOWN_INSTRUMENT, ADDED, ALREADY_ADDED
+from ecdf import plot_ecdf
+
 st.set_page_config(page_title="Time Series Analysis, DBS Vision App", page_icon="🩸", layout="wide")
 
 st.title("Time Series Analysis")
@@ -17,29 +21,119 @@ and compare diameter distributions between time periods.
 # --- Upload CSV(s) ---
 st.subheader("Data Upload")
 uploaded_files = st.file_uploader(
-    "Upload one or more CSV files",
-    type=["csv"],
+    "Upload one or more CSV or Parquet files",
+    type=["csv", "parquet"],
     accept_multiple_files=True
 )
 
+# Files are read in chunks into monthly totals and diameter counts, so histories larger than memory
+# can be analysed. The summary groups the months for the sections below and is kept between reruns,
+# so changing a widget does not read the files again
+@st.cache_resource(show_spinner="Reading results...", max_entries=4)
+def load_summary(files, filter_option, start, end):
+    aggregates = aggregate_results(iter_results_chunks(files, start=start, end=end),
+                                   first_punch=filter_option == "First punch for each sample ID")
+    return PeriodSummary(aggregates)
+
+# Counts of previously added files by instrument and month, shared between sessions. Loading them reads
+# one row per month and distinct diameter, so it grows with the number of months, not of results
+@st.cache_resource
+def get_summary_store():
+    return SummaryStore()
+
+# A store written by another version of the app cannot be read, but uploaded files can still be summarised
+try:
+    summary_store = get_summary_store()
+except ValueError as error:
+    summary_store = None
+    summary_store_error = str(error)
+
 filter_option = st.radio(
     "Select which data to include:",
     ["All rows", "First punch for each sample ID"],
     horizontal=True
 )
 
-if uploaded_files:
-    # Read and concatenate all uploaded CSVs
-    df_list = []
-    for file in uploaded_files:
-        temp_df = pd.read_csv(file)
-        df_list.append(temp_df)
+source = st.radio(
+    "Summarise:",
+    ["Uploaded files", "Summary store"],
+    horizontal=True,
+    help="The summary store keeps the monthly counts of every file added to it, so long histories can be "
+         "summarised without uploading them again"
+)
+
+if uploaded_files and summary_store is not None:
+    add_overlapping = st.checkbox(
+        "Also add files whose dates overlap files already in the summary store",
+        value=False,
+        help="Results in both files would be counted twice, e.g. when an export repeats earlier days"
+    )
 
-    df = pd.concat(df_list, ignore_index=True)
-    df['datetime'] = pd.to_datetime(df['datetime'], errors='coerce')
+    if st.button("Add uploaded files to the summary store"):
+        with st.spinner("Adding results..."):
+            outcomes = summary_store.add_files(uploaded_files, skip_overlapping=not add_overlapping)
+
+        for name, outcome, overlapping in outcomes:
+            overlaps = ", ".join(overlapping['name'].fillna("unnamed").astype(str))
+            if outcome == ADDED:
+                st.success(f"Added {name} to the summary store")
+                if overlaps:
+                    st.warning(f"⚠️ The dates of {name} overlap {overlaps}. Results in both are counted twice, "
+                               "remove one of them under Files in the summary store if this was a mistake")
+            elif outcome == ALREADY_ADDED:
+                st.info(f"{name} is already in the summary store")
+            else:
+                st.warning(f"⚠️ {name} was not added: its dates overlap {overlaps} for the same instrument. "
+                           "Tick the box above to add it anyway")
+
+summary = None
+
+if source == "Summary store" and summary_store is None:
+    st.error(f"⚠️ {summary_store_error}")
+
+elif source == "Summary store":
+    st.caption(f"Summary store: {len(summary_store)} results from {summary_store.n_batches} file(s)")
+
+    with st.expander("Files in the summary store"):
+        stored = summary_store.batches()
+        st.dataframe(stored.drop(columns='key'), hide_index=True)
+
+        remove_ids = st.multiselect(
+            "Select files to remove:",
+            options=list(stored['id']),
+            format_func=lambda i: f"{i}: {stored.loc[stored['id'] == i, 'name'].iloc[0]}",
+            key="remove_batches"
+        )
+        if remove_ids and st.button("Remove selected files from the summary store"):
+            for batch in remove_ids:
+                summary_store.remove_batch(batch)
+            st.rerun()
 
     if filter_option == "First punch for each sample ID":
-        df = df.sort_values(['sample_id', 'datetime']).drop_duplicates('sample_id', keep='first')
+        st.info("The summary store counts every row. Upload the files to include only the first punch of each sample ID")
+
+    instruments = list(summary_store.instruments()['mm_per_pixel'])
+    selected_instruments = st.multiselect(
+        "Select instruments (mm per pixel):",
+        options=instruments,
+        default=instruments,
+        format_func=lambda x: "Unknown" if x == UNKNOWN_INSTRUMENT else f"{x:g}",
+        key="instruments"
+    )
+
+    if selected_instruments:
+        summary = PeriodSummary(summary_store.aggregates(selected_instruments))
+
+else:
+    # Parquet files are only read for the selected dates
+    date_range = st.date_input("Only include results between these dates (optional):", value=[])
+    start, end = date_range_bounds(date_range)
+
+    if uploaded_files:
+        # Read and summarise all uploaded files
+        summary = load_summary(uploaded_files, filter_option, start, end)
+
+if summary is not None:
 
     # --- CLASSIFICATION TRENDS ---
     st.header("Classification trends")
@@ -50,22 +144,7 @@ if uploaded_files:
         key="class_group"
     )
 
-    df_class = df.dropna(subset=['datetime']).copy()
-    if class_group == "Month":
-        df_class['period'] = df_class['datetime'].dt.to_period('M').dt.to_timestamp()
-    elif class_group == "Quarter":
-        df_class['period'] = df_class['datetime'].dt.to_period('Q').dt.to_timestamp()
-    else:
-        df_class['period'] = df_class['datetime'].dt.to_period('Y').dt.to_timestamp()
-
-    class_summary = df_class.groupby('period').apply(
-        lambda x: pd.Series({
-            'Total DBS': len(x),
-            'Acceptable DBS (%)': (len(x[(x['pred_multi'] == 'controls') & (x['equiv_diam_mm'] >= 8)]) / len(x)) * 100 if len(x) > 0 else 0,
-            'Small DBS (<8mm) (%)': (len(x[x['equiv_diam_mm'] < 8]) / len(x)) * 100 if len(x) > 0 else 0,
-            'Multispotted DBS (%)': (len(x[(x['pred_multi'] == '0304') & (x['equiv_diam_mm'] >= 8)]) / len(x)) * 100 if len(x) > 0 else 0
-        })
-    ).reset_index()
+    class_summary = summary.classification(class_group)
 
     st.dataframe(class_summary)
 
@@ -99,23 +178,7 @@ if uploaded_files:
         key="diam_group"
     )
 
-    df_diam = df.dropna(subset=['datetime']).copy()
-    if diam_group == "Month":
-        df_diam['period'] = df_diam['datetime'].dt.to_period('M').dt.to_timestamp()
-    elif diam_group == "Quarter":
-        df_diam['period'] = df_diam['datetime'].dt.to_period('Q').dt.to_timestamp()
-    else:
-        df_diam['period'] = df_diam['datetime'].dt.to_period('Y').dt.to_timestamp()
-
-    diam_summary = df_diam.groupby('period').apply(
-        lambda x: pd.Series({
-            'Mean Diameter (mm)': x['equiv_diam_mm'].mean(),
-            'Median Diameter (mm)': x['equiv_diam_mm'].median(),
-            '25th Percentile (mm)': x['equiv_diam_mm'].quantile(0.25),
-            '75th Percentile (mm)': x['equiv_diam_mm'].quantile(0.75),
-            'Count': len(x)
-        })
-    ).reset_index()
+    diam_summary = summary.diameter(diam_group)
 
     st.dataframe(diam_summary)
 
@@ -154,21 +217,14 @@ if uploaded_files:
         key="ecdf_group"
     )
 
-    df_ecdf = df.dropna(subset=['datetime']).copy()
-    if ecdf_group == "Month":
-        df_ecdf['period'] = df_ecdf['datetime'].dt.to_period('M').astype(str)
-    elif ecdf_group == "Quarter":
-        df_ecdf['period'] = df_ecdf['datetime'].dt.to_period('Q').astype(str)
-    else:
-        df_ecdf['period'] = df_ecdf['datetime'].dt.to_period('Y').astype(str)
+    # diameter counts of each period are combined once, curves are drawn with a fixed number of points
+    ecdfs = summary.ecdfs(ecdf_group)
 
     # Filter out sparse periods (<10 samples)
-    counts = df_ecdf['period'].value_counts()
-    valid_periods = counts[counts > 10].index
-    df_ecdf = df_ecdf[df_ecdf['period'].isin(valid_periods)]
+    ecdf_periods = summary.periods(ecdf_group)
+    unique_periods = list(ecdf_periods['label'][summary.counts(ecdf_group) > 10])
 
     # --- Default selection: first, middle, and last period ---
-    unique_periods = sorted(df_ecdf['period'].unique())
     if len(unique_periods) >= 3:
         mid_index = len(unique_periods) // 2
         default_periods = [unique_periods[0], unique_periods[mid_index], unique_periods[-1]]
@@ -182,23 +238,14 @@ if uploaded_files:
         key="ecdf_periods"
     )
 
-    df_ecdf_sel = df_ecdf[df_ecdf['period'].isin(selected_periods)]
-
     # --- ECDF plot ---
     fig_ecdf_time, ax_ecdf = plt.subplots(figsize=(10, 6))
-    if df_ecdf_sel.empty:
+    if not selected_periods:
         st.warning("No data available for selected periods.")
     else:
         palette = sns.color_palette("husl", len(selected_periods))
         for i, period in enumerate(selected_periods):
-            subset = df_ecdf_sel[df_ecdf_sel['period'] == period]
-            sns.ecdfplot(
-                data=subset,
-                x='equiv_diam_mm',
-                ax=ax_ecdf,
-                color=palette[i],
-                label=period
-            )
+            plot_ecdf(ax_ecdf, ecdfs[period], color=palette[i], label=period)
 
         # Add 8mm reference line
         ax_ecdf.axvline(x=8, color='red', linestyle='--', linewidth=1.5)
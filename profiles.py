@@ -0,0 +1,165 @@
+import functools
+from dataclasses import dataclass
+
+import numpy as np
+import cv2
+
+
+@functools.lru_cache(maxsize=None)
+def circular_mask(h, w):
+    '''
+    Circular background mask used to remove enclosing artefacts from a (h, w) frame
+
+    The mask is built once per frame shape and shared, so it is returned read-only
+    '''
+
+    background = np.zeros((h, w), dtype=np.uint8)
+    x, y = int(w / 2), int(h / 2)
+    rad = int(w / 2)
+    background = cv2.circle(background, (x, y), rad, 255, -1)
+    background.flags.writeable = False
+
+    return background
+
+
+@functools.lru_cache(maxsize=None)
+def square_kernel(size):
+    '''
+    Square structuring element of ones, shared between calls
+    '''
+
+    kernel = np.ones((size, size), np.uint8)
+    kernel.flags.writeable = False
+
+    return kernel
+
+
+@dataclass(frozen=True)
+class InstrumentProfile:
+    '''
+    Detection parameters for one Panthera camera format
+
+    name: profile name, also used for image_size in spot_metrics_multi_uploaded (e.g. '752 x 480')
+    image_size: (width, height) of the raw image
+    crop: (y_start, y_end, x_start, x_end) window applied to the raw image before detection
+    roi: (x_min, x_max, y_min, y_max) rectangle that filled internal contours must lie completely within
+    center, radius: circular search area, in cropped image coordinates
+    median_ksize: median blur kernel size used before thresholding
+    green_median_ksize: median blur kernel size used before green punch mask generation
+    mm_per_pixel_range: expected (lower, upper) range of mm per pixel for this camera
+    '''
+
+    name: str
+    image_size: tuple
+    crop: tuple
+    roi: tuple
+    center: tuple
+    radius: int
+    median_ksize: int
+    green_median_ksize: int
+    mm_per_pixel_range: tuple = None
+
+    @property
+    def width(self):
+        return self.image_size[0]
+
+    @property
+    def height(self):
+        return self.image_size[1]
+
+    @functools.cached_property
+    def crop_slices(self):
+        y_start, y_end, x_start, x_end = self.crop
+        return (slice(y_start, y_end), slice(x_start, x_end))
+
+    @functools.cached_property
+    def background_mask(self):
+        y_start, y_end, x_start, x_end = self.crop
+        return circular_mask(y_end - y_start, x_end - x_start)
+
+    def crop_image(self, img):
+        ''' Return the detection window of a raw image (a view, not a copy)
+        '''
+        return img[self.crop_slices]
+
+
+PROFILES = {}
+
+
+def register_profile(profile):
+    '''
+    Add an instrument profile to the registry (replacing any profile with the same name)
+    and precompute its shape-dependent assets
+    '''
+
+    PROFILES[profile.name] = profile
+
+    # build cached masks and kernels up front so the first image does not pay for them
+    profile.crop_slices
+    profile.background_mask
+    square_kernel(3)
+    square_kernel(11)
+    square_kernel(17)
+
+    return profile
+
+
+def get_profile(name):
+    '''
+    Look up a registered profile by name (e.g. '1440 x 920')
+    '''
+
+    if isinstance(name, InstrumentProfile):
+        return name
+
+    try:
+        return PROFILES[name]
+    except KeyError:
+        raise ValueError("Image size not supported") from None
+
+
+def profile_for_size(width, height=None):
+    '''
+    Find the registered profile matching an image size. If height is None only the width is compared.
+
+    Returns None if no profile matches
+    '''
+
+    for profile in PROFILES.values():
+        if profile.width == width and (height is None or profile.height == height):
+            return profile
+
+    return None
+
+
+def supported_sizes():
+    ''' Human readable list of supported image sizes, e.g. '752x480 or 1440x920'
+    '''
+    return ' or '.join(f"{p.width}x{p.height}" for p in PROFILES.values())
+
+
+# Original Panthera camera
+register_profile(InstrumentProfile(
+    name='752 x 480',
+    image_size=(752, 480),
+    crop=(0, 300, 150, 610),
+    roi=(1, 459, 50, 299),
+    center=(209, 139),
+    radius=68,
+    median_ksize=3,
+    green_median_ksize=7,
+    mm_per_pixel_range=(0.11, 0.13),
+))
+
+# New Panthera camera (larger median kernels show best agreement with old Panthera)
+register_profile(InstrumentProfile(
+    name='1440 x 920',
+    image_size=(1440, 920),
+    crop=(0, 580, 250, 1160),
+    roi=(5, 900, 50, 575),
+    center=(461, 226),
+    radius=130,
+    median_ksize=13,
+    green_median_ksize=15,
+    mm_per_pixel_range=(0.05, 0.07),
+))
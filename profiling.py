@@ -0,0 +1,190 @@
+'''
+Opt-in instrumentation of the detection pipeline
+
+Pipeline stages are wrapped in named spans. Spans are only recorded inside a capture() block, which
+sends each finished span to one or more sinks (any callable taking a SpanEvent). A sink may also have a
+span_started(name) method, called as each span starts (e.g. to measure memory from the start of a stage):
+
+    summary = TimingSummary()
+    trace = TraceRecorder()
+    with capture(summary, trace):
+        ...                                 # run the pipeline
+    print(summary.to_dataframe())
+    trace.write('trace.json')               # open in chrome://tracing, Perfetto or speedscope
+
+Captures are scoped to the current thread (and context), so concurrent Streamlit sessions do not see
+each other's spans. Outside a capture a span is a shared no-op object, so instrumentation costs one
+context variable lookup per stage.
+'''
+
+import os
+import json
+import time
+import threading
+import functools
+import contextlib
+import contextvars
+from collections import namedtuple
+
+import pandas as pd
+
+SpanEvent = namedtuple('SpanEvent', ['name', 'start_ns', 'end_ns', 'pid', 'tid', 'attrs'])
+SpanEvent.duration_ns = property(lambda self: self.end_ns - self.start_ns)
+
+# sinks receiving spans in the current context
+_sinks = contextvars.ContextVar('dbsvision_profiling_sinks', default=())
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('name', 'attrs', 'sinks', 'start_ns')
+
+    def __init__(self, name, attrs, sinks):
+        self.name = name
+        self.attrs = attrs
+        self.sinks = sinks
+
+    def __enter__(self):
+        for sink in self.sinks:
+            started = getattr(sink, 'span_started', None)
+            if started is not None:
+                started(self.name)
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        event = SpanEvent(self.name, self.start_ns, time.perf_counter_ns(), os.getpid(),
+                          threading.get_ident(), self.attrs)
+        for sink in self.sinks:
+            sink(event)
+        return False
+
+
+def span(name, **attrs):
+    '''
+    Context manager timing a named stage. attrs are stored with the span (e.g. file=name)
+    '''
+    sinks = _sinks.get()
+    if not sinks:
+        return _NULL_SPAN
+    return _Span(name, attrs, sinks)
+
+
+def traced(name):
+    ''' Decorator wrapping every call of a function in a span
+    '''
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            sinks = _sinks.get()
+            if not sinks:
+                return func(*args, **kwargs)
+            with _Span(name, {}, sinks):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def enabled():
+    ''' True inside a capture() block
+    '''
+    return bool(_sinks.get())
+
+
+@contextlib.contextmanager
+def capture(*sinks):
+    '''
+    Record spans finished in this context, sending them to sinks. Captures can be nested,
+    inner captures add to the sinks of outer ones
+    '''
+    token = _sinks.set(_sinks.get() + tuple(sinks))
+    try:
+        yield
+    finally:
+        _sinks.reset(token)
+
+
+def emit(events):
+    ''' Send spans recorded elsewhere (e.g. in a worker process) to the sinks of the current context
+    '''
+    for sink in _sinks.get():
+        for event in events:
+            sink(event)
+
+
+class TimingSummary:
+    '''
+    Sink aggregating the number of calls and the total, mean and longest duration of each span name
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {}
+        self.start_ns = None
+        self.end_ns = None
+
+    def __call__(self, event):
+        duration = event.duration_ns
+        with self._lock:
+            calls, total, longest = self.stats.get(event.name, (0, 0, 0))
+            self.stats[event.name] = (calls + 1, total + duration, max(longest, duration))
+            self.start_ns = event.start_ns if self.start_ns is None else min(self.start_ns, event.start_ns)
+            self.end_ns = event.end_ns if self.end_ns is None else max(self.end_ns, event.end_ns)
+
+    def to_dataframe(self):
+        '''
+        One row per span name, longest total time first. Spans nest (e.g. 'detect' contains
+        'detect.blur'), so totals do not add up to the run time
+        '''
+        rows = [{'stage': name, 'calls': calls, 'total_s': total / 1e9, 'mean_ms': total / calls / 1e6,
+                 'max_ms': longest / 1e6} for name, (calls, total, longest) in self.stats.items()]
+        df = pd.DataFrame(rows, columns=['stage', 'calls', 'total_s', 'mean_ms', 'max_ms'])
+        return df.sort_values('total_s', ascending=False, ignore_index=True)
+
+
+class TraceRecorder:
+    '''
+    Sink keeping every span, for export in the Chrome trace event format
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.events = []
+
+    def __call__(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def chrome_trace(self):
+        ''' Trace as a dict in the Chrome trace event format (complete events, times in microseconds)
+        '''
+        with self._lock:
+            events = list(self.events)
+
+        origin = min((e.start_ns for e in events), default=0)
+        trace_events = [{'name': e.name, 'ph': 'X', 'ts': (e.start_ns - origin) / 1000,
+                         'dur': e.duration_ns / 1000, 'pid': e.pid, 'tid': e.tid,
+                         'args': {k: str(v) for k, v in e.attrs.items()}} for e in events]
+
+        return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+    def to_json(self):
+        return json.dumps(self.chrome_trace())
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            f.write(self.to_json())
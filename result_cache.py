@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from functions import ALGORITHM_VERSION
+
+DEFAULT_CACHE_PATH = os.environ.get(
+    'DBSVISION_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'dbsvision', 'results.sqlite'))
+
+# Default limit on the total size of stored results
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+def params_fingerprint(params):
+    '''
+    Description of the detection parameters that affect pixel metrics, used as part of the cache key
+
+    params: detection parameters as passed to batch.analyse_image
+    '''
+
+    profile = params['profile']
+
+    return json.dumps({
+        'algorithm_version': ALGORITHM_VERSION,
+        'crop': list(profile.crop),
+        'median_ksize': profile.median_ksize,
+        'green_median_ksize': profile.green_median_ksize,
+        'roi': [params['x_min'], params['x_max'], params['y_min'], params['y_max']],
+        'center': list(params['center']),
+        'radius': params['radius'],
+        'select_punched': bool(params['select_punched']),
+        'mode': params.get('mode', 'reference'),
+    }, sort_keys=True)
+
+
+class ResultCache:
+    '''
+    Persistent cache of pixel-unit spot metrics, keyed on a hash of the image bytes and detection parameters
+
+    Results are stored in a SQLite database. When the stored results exceed max_bytes, the least
+    recently used entries are evicted. hits and misses count lookups since the cache was opened.
+    A single instance can be shared between threads.
+    '''
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    @staticmethod
+    def key(data, fingerprint):
+        ''' Cache key for encoded image bytes analysed with parameters described by fingerprint
+        '''
+        h = hashlib.sha256(fingerprint.encode('utf-8'))
+        h.update(data)
+        return h.hexdigest()
+
+    def get(self, key):
+        '''
+        Return (spot_met_pixels, width) stored for key, or None
+        '''
+
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._conn.execute("UPDATE results SET last_access = ? WHERE key = ?", (time.time(), key))
+
+        value = json.loads(row[0])
+        return value['rows'], value['width']
+
+    def put(self, key, spot_met_pixels, width):
+        '''
+        Store pixel-unit spot metrics (see functions.spot_metrics_pixels) and image width for key
+        '''
+
+        value = json.dumps({'rows': spot_met_pixels, 'width': width})
+        size = len(value)
+
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+            self._conn.execute("INSERT OR REPLACE INTO results (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                               (key, value, size, time.time()))
+            self._total_bytes += size - (old[0] if old else 0)
+
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # remove least recently used entries until the cache is within its size limit
+        evicted = []
+        excess = self._total_bytes - self.max_bytes
+
+        for key, size in self._conn.execute("SELECT key, size FROM results ORDER BY last_access"):
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= size
+            self._total_bytes -= size
+
+        self._conn.executemany("DELETE FROM results WHERE key = ?", evicted)
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM results")
+            self._total_bytes = 0
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,164 @@
+'''
+Reading and writing Multiple Image Analysis results (RESULT_COLUMNS) as CSV or Parquet
+
+Parquet files keep the column types: pred_multi is stored as a category and datetime as a timestamp,
+so they do not need parsing when read. CSV files are read with the same types, so both formats give
+the same DataFrames.
+
+Results are streamed in chunks of CHUNK_ROWS rows (e.g. into analysis.aggregate_results), so files
+too large to read at once can be analysed. Parquet rows are written in datetime order in row groups
+of ROW_GROUP_SIZE rows, so reads restricted to a time range skip the row groups outside it:
+
+    for chunk in iter_results_chunks(files, columns=ANALYSIS_COLUMNS, start='2024-01-01'):
+        ...
+'''
+
+import io
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Columns used by the Data Analysis and Time Series Analysis pages
+ANALYSIS_COLUMNS = ['sample_id', 'datetime', 'equiv_diam_mm', 'pred_multi']
+
+# Types of the result columns when read (datetime is parsed separately)
+RESULT_DTYPES = {
+    'file': 'str',
+    'sample_id': 'str',
+    'equiv_diam_mm': 'float64',
+    'pred_multi': 'category',
+    'prob_multi': 'float64',
+    'mm_per_pixel': 'float64',
+}
+
+# Rows per Parquet row group. Smaller groups allow finer filtering on datetime but compress less well
+ROW_GROUP_SIZE = 65536
+
+# Rows per chunk when results are streamed with iter_results_chunks
+CHUNK_ROWS = 262144
+
+
+def is_parquet_name(name):
+    return name.lower().endswith(('.parquet', '.pq'))
+
+
+def to_results_types(df):
+    '''
+    Copy of a results DataFrame with the column types used by the Parquet format
+    '''
+
+    df = df.copy()
+    if 'datetime' in df.columns:
+        df['datetime'] = pd.to_datetime(df['datetime'], errors='coerce')
+    for column, dtype in RESULT_DTYPES.items():
+        if column in df.columns:
+            df[column] = df[column].astype(dtype)
+
+    return df
+
+
+def results_to_parquet(df):
+    '''
+    Encode a results DataFrame as Parquet bytes (e.g. for st.download_button)
+    '''
+
+    df = to_results_types(df)
+    if 'datetime' in df.columns:
+        df = df.sort_values('datetime', kind='stable', na_position='last', ignore_index=True)
+
+    buffer = io.BytesIO()
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), buffer, row_group_size=ROW_GROUP_SIZE)
+
+    return buffer.getvalue()
+
+
+def _row_groups_in_range(parquet, start, end):
+    # row groups whose datetime statistics overlap [start, end). Groups without statistics are kept
+    groups = []
+    for i in range(parquet.metadata.num_row_groups):
+        row_group = parquet.metadata.row_group(i)
+        stats = next((row_group.column(j).statistics for j in range(row_group.num_columns)
+                      if row_group.column(j).path_in_schema == 'datetime'), None)
+
+        if stats is not None and stats.has_min_max:
+            if start is not None and pd.Timestamp(stats.max) < start:
+                continue
+            if end is not None and pd.Timestamp(stats.min) >= end:
+                continue
+        groups.append(i)
+
+    return groups
+
+
+def _in_range(df, start, end):
+    # rows of a chunk with a datetime in [start, end)
+    keep = df['datetime'].notna()
+    if start is not None:
+        keep &= df['datetime'] >= start
+    if end is not None:
+        keep &= df['datetime'] < end
+    return df[keep].reset_index(drop=True)
+
+
+def iter_results_chunks(files, columns=ANALYSIS_COLUMNS, chunksize=CHUNK_ROWS, start=None, end=None):
+    '''
+    Yield DataFrames of at most chunksize rows of results files (e.g. Streamlit UploadedFiles), in file
+    order, with the types of to_results_types. Only one chunk of each file is parsed at a time
+
+    columns: columns to read (default: ANALYSIS_COLUMNS). Other columns are not read from Parquet files
+    start, end: optional time range [start, end). Parquet row groups outside it are not read.
+                Rows with no datetime are dropped when a range is given
+    '''
+
+    filtered = start is not None or end is not None
+    start = None if start is None else pd.Timestamp(start)
+    end = None if end is None else pd.Timestamp(end)
+
+    # datetime is read to filter on, even if it is not one of the columns
+    read_columns = columns
+    if filtered and columns is not None and 'datetime' not in columns:
+        read_columns = list(columns) + ['datetime']
+    usecols = None if read_columns is None else lambda column: column in read_columns
+
+    for file in files:
+        # uploaded files may have been read before
+        if hasattr(file, 'seek'):
+            file.seek(0)
+
+        name = file if isinstance(file, str) else getattr(file, 'name', '')
+
+        if is_parquet_name(name):
+            parquet = pq.ParquetFile(file)
+            names = parquet.schema_arrow.names
+            row_groups = _row_groups_in_range(parquet, start, end) if filtered else None
+            if row_groups == []:
+                continue
+            batches = parquet.iter_batches(batch_size=chunksize, row_groups=row_groups,
+                                           columns=None if read_columns is None else
+                                           [column for column in read_columns if column in names])
+            chunks = (batch.to_pandas() for batch in batches)
+        else:
+            chunks = pd.read_csv(file, usecols=usecols, dtype=RESULT_DTYPES, chunksize=chunksize)
+
+        for chunk in chunks:
+            chunk = to_results_types(chunk)
+
+            if filtered:
+                chunk = _in_range(chunk, start, end)
+                if columns is not None:
+                    chunk = chunk[[column for column in chunk.columns if column in columns]]
+
+            yield chunk
+
+
+def date_range_bounds(dates):
+    '''
+    (start, end) timestamps for iter_results_chunks of a (first day, last day) range picked with
+    st.date_input. The last day is included. (None, None) until both days are picked
+    '''
+
+    if len(dates) != 2:
+        return None, None
+
+    return pd.Timestamp(dates[0]), pd.Timestamp(dates[1]) + pd.Timedelta(days=1)
@@ -0,0 +1,135 @@
+'''
+Equivalence check for the vectorised contour ROI tests
+
+contours_in_roi and all_contours_in_roi must give the same answer as the per-contour reference
+functions contour_in_roi and all_contour_in_roi. They are compared on the contours found in every
+detection mask of the example images, at both instrument sizes, and on synthetic edge cases (points
+exactly on the circle and rectangle boundaries, single point contours, an empty contour list and
+random contours):
+
+    python roi_check.py                 # exits with status 1 on any difference
+'''
+
+import sys
+import argparse
+
+import numpy as np
+import cv2
+
+from functions import (contour_in_roi, all_contour_in_roi, contours_in_roi, all_contours_in_roi,
+                       detection_masks)
+from profiles import PROFILES
+from batch import iter_image_files
+from golden_masks import EXAMPLES_PATH
+
+
+def _contour(points):
+    return np.array(points, dtype=np.int32).reshape(-1, 1, 2)
+
+
+def compare(contours, center, radius, x_min, x_max, y_min, y_max):
+    '''
+    Indices of the contours where the vectorised tests differ from the reference functions,
+    as (circle mismatches, rectangle mismatches)
+    '''
+
+    in_circle = contours_in_roi(contours, center, radius)
+    in_rect = all_contours_in_roi(contours, x_min, x_max, y_min, y_max)
+
+    if len(in_circle) != len(contours) or len(in_rect) != len(contours):
+        return [-1], [-1]
+
+    circle = [i for i in range(len(contours)) if bool(in_circle[i]) != contour_in_roi(contours, i, center, radius)]
+    rect = [i for i in range(len(contours))
+            if bool(in_rect[i]) != all_contour_in_roi(contours, i, x_min, x_max, y_min, y_max)]
+
+    return circle, rect
+
+
+def synthetic_cases():
+    '''
+    (name, contours, center, radius, (x_min, x_max, y_min, y_max)) edge cases
+    '''
+
+    roi = (50, 150, 50, 150)
+    center, radius = (100, 100), 50
+
+    # (130, 140) and (150, 100) are exactly radius from the center, (151, 100) is just outside
+    boundary = [_contour([[150, 100]]), _contour([[130, 140]]), _contour([[151, 100]]),
+                _contour([[151, 100], [150, 100]]), _contour([[200, 200], [300, 300], [130, 60]])]
+
+    # points on the rectangle edges are outside it
+    edges = [_contour([[50, 100]]), _contour([[149, 149]]), _contour([[60, 60], [150, 60]]),
+             _contour([[51, 51], [149, 51], [149, 149], [51, 149]]), _contour([[100, 50], [100, 100]])]
+
+    # the reference squares int32 coordinates, so points further than about 30000 pixels overflow it
+    far = [_contour([[-20000, -20000], [20000, 20000]]), _contour([[0, 0]])]
+
+    rng = np.random.default_rng(0)
+    random = [_contour(rng.integers(0, 200, (rng.integers(1, 40), 2))) for _ in range(500)]
+
+    return [
+        ('empty', [], center, radius, roi),
+        ('circle boundary', boundary, center, radius, roi),
+        ('non-integer radius', boundary, center, radius - 0.5, roi),
+        ('rectangle edges', edges, center, radius, roi),
+        ('far points', far, center, radius, roi),
+        ('random', random, center, radius, roi),
+        ('random, zero radius', random, (100, 100), 0, roi),
+    ]
+
+
+def example_cases(sources):
+    '''
+    Cases with the contours of every detection mask of the example images, at every instrument size
+    '''
+
+    reference = max(PROFILES.values(), key=lambda p: p.width)
+
+    for name, data in iter_image_files(sources):
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+        for profile in PROFILES.values():
+            if img.shape[1] == profile.width:
+                sized = img
+            elif img.shape[1] == reference.width:
+                sized = cv2.resize(img, profile.image_size, interpolation=cv2.INTER_AREA)
+            else:
+                continue
+
+            cropped = profile.crop_image(sized)
+            masks = detection_masks(cropped, *profile.roi, select_punched=True, median_ksize=profile.median_ksize,
+                                    green_median_ksize=profile.green_median_ksize)
+
+            for step, mask in masks.items():
+                contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+                yield f'{name} [{profile.name}] {step}', contours, profile.center, profile.radius, profile.roi
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the vectorised contour ROI tests against the reference")
+    parser.add_argument('inputs', nargs='*', default=[EXAMPLES_PATH],
+                        help="example images (default: data/example_dbs.zip)")
+    args = parser.parse_args(argv)
+
+    failures = 0
+    n_cases = 0
+    n_contours = 0
+
+    for case in [*synthetic_cases(), *example_cases(args.inputs)]:
+        name, contours, center, radius, roi = case
+        circle, rect = compare(contours, center, radius, *roi)
+        n_cases += 1
+        n_contours += len(contours)
+
+        if circle or rect:
+            print(f"DIFFERENT {name}: contours_in_roi {circle}, all_contours_in_roi {rect}")
+            failures += 1
+
+    print(f"{n_cases - failures} of {n_cases} cases ({n_contours} contours) match the reference functions")
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
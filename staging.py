@@ -0,0 +1,206 @@
+'''
+Staging area holding uploaded images within a memory budget
+
+Images are kept in memory until the memory budget is used up. Further images are written to a
+temporary spill file and read back, through a memory map, one at a time as they are processed:
+
+    staging = StagingArea()
+    staging.add_uploaded_files(uploaded_files)      # zip archives are staged member by member
+    for name, data in staging:                      # (file name, encoded image bytes)
+        ...
+
+The budget is shared by every staging area of the process (i.e. every session of the app), so together
+they hold at most DBSVISION_STAGING_MEMORY_MB in memory. An image kept in memory is moved to the spill
+file once it has been consumed, so after the first pass a staging area only holds its images on disk and
+they can be analysed again (e.g. with a new mm per pixel) without keeping them in RAM for the whole
+session. The spill file is deleted by close() or when the staging area is garbage collected.
+'''
+
+import os
+import mmap
+import tempfile
+import threading
+
+from batch import iter_uploaded_images, image_size
+
+# Bytes of images kept in memory by all staging areas together, the rest is spilled to disk
+DEFAULT_MEMORY_BUDGET = int(os.environ.get('DBSVISION_STAGING_MEMORY_MB', 256)) * 1024 * 1024
+
+
+class MemoryBudget:
+    '''
+    Number of bytes that may be held in memory, shared between the staging areas that use it
+    '''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, n_bytes):
+        ''' Reserve n_bytes if they fit the budget. Returns True if they were reserved
+        '''
+        with self._lock:
+            if self.used + n_bytes > self.limit:
+                return False
+            self.used += n_bytes
+            return True
+
+    def release(self, n_bytes):
+        with self._lock:
+            self.used -= n_bytes
+
+
+# Budget of the staging areas of all sessions
+SHARED_MEMORY_BUDGET = MemoryBudget(DEFAULT_MEMORY_BUDGET)
+
+
+class StagingArea:
+    '''
+    Ordered store of (file name, encoded image bytes), keeping images in memory within a memory budget
+
+    memory_budget: MemoryBudget shared with other staging areas (default: SHARED_MEMORY_BUDGET), or a
+                   number of bytes for a budget of this staging area only
+    directory: where the spill file is created (default: the system temporary directory)
+    The image size (width, height) of each image is read from its header when it is staged, see sizes.
+    Files that are not readable images are still staged, so the analysis reports them image by image
+    '''
+
+    def __init__(self, memory_budget=None, directory=None):
+        if memory_budget is None:
+            memory_budget = SHARED_MEMORY_BUDGET
+        elif not isinstance(memory_budget, MemoryBudget):
+            memory_budget = MemoryBudget(memory_budget)
+
+        self.memory_budget = memory_budget
+        self.directory = directory
+        self.memory_bytes = 0
+        self.spilled_bytes = 0
+
+        # (name, (width, height), bytes or None if spilled, offset in spill file, length)
+        self._entries = []
+        self._spill = None
+        self._map = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def sizes(self):
+        ''' (width, height) of each staged image, in staging order. None for files that are not readable images
+        '''
+        return [size for name, size, data, offset, length in self._entries]
+
+    def add(self, name, data):
+        ''' Stage one encoded image, in memory if it fits the budget, otherwise in the spill file
+        '''
+
+        try:
+            size = image_size(data)
+        except Exception:
+            size = None
+
+        length = len(data)
+
+        with self._lock:
+            if self.memory_budget.reserve(length):
+                self._entries.append((name, size, bytes(data), None, length))
+                self.memory_bytes += length
+                return
+
+            self._entries.append((name, size, None, self._write_spill(data), length))
+            self.spilled_bytes += length
+
+    def add_uploaded_files(self, uploaded_files):
+        '''
+        Stage the images in uploaded files (see batch.iter_uploaded_images). Zip archives are
+        decompressed one member at a time, so only one image is held outside the staging area at once
+        '''
+
+        for name, data in iter_uploaded_images(uploaded_files):
+            self.add(name, data)
+
+    def _write_spill(self, data):
+        # append data to the spill file, with the lock held. Returns its offset
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile(prefix='dbsvision-staging-', dir=self.directory)
+
+        # the memory map is made again for the larger file when next needed
+        self._close_map()
+        offset = self._spill.seek(0, os.SEEK_END)
+        self._spill.write(data)
+        return offset
+
+    def _spill_entry(self, index):
+        # move an image kept in memory to the spill file and release its share of the budget
+        with self._lock:
+            if index >= len(self._entries):
+                return
+            name, size, data, offset, length = self._entries[index]
+            if data is None:
+                return
+
+            self._entries[index] = (name, size, None, self._write_spill(data), length)
+            self.memory_bytes -= length
+            self.spilled_bytes += length
+            self.memory_budget.release(length)
+
+    def _close_map(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _read(self, offset, length):
+        with self._lock:
+            if self._map is None:
+                self._spill.flush()
+                self._map = mmap.mmap(self._spill.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._map[offset:offset + length]
+
+    def __iter__(self):
+        '''
+        Yield (file name, encoded image bytes) in staging order. Spilled images are read from disk
+        as they are consumed, and images kept in memory are moved to the spill file once consumed, so
+        their bytes are released as soon as the consumer drops them
+        '''
+
+        # entries are looked up one at a time, as a copy of the list would keep every image in memory
+        index = 0
+        while index < len(self._entries):
+            name, size, data, offset, length = self._entries[index]
+
+            if data is None:
+                yield name, self._read(offset, length)
+            else:
+                yield name, data
+                del data
+                self._spill_entry(index)
+
+            index += 1
+
+    def close(self):
+        ''' Release the staged images and delete the spill file
+        '''
+
+        with self._lock:
+            self._close_map()
+            if self._spill is not None:
+                self._spill.close()
+                self._spill = None
+            self._entries = []
+            self.memory_budget.release(self.memory_bytes)
+            self.memory_bytes = 0
+            self.spilled_bytes = 0
+
+    def __del__(self):
+        # return the share of the shared budget of a staging area dropped without close (e.g. with its session)
+        if self.memory_bytes:
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
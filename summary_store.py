@@ -0,0 +1,467 @@
+'''
+Persistent store of Time Series Analysis summaries, so the full history does not have to be read again
+
+Results are reduced to counts keyed by instrument (mm per pixel) and calendar month: the number of
+results and of acceptable, small and multispotted DBS, and the number of times each equiv_diam_mm
+occurs, as in analysis.MonthlyAggregates. Counts merge exactly, so adding a batch only updates the rows
+of the months in it, and the mean, median, IQR and P5/P95 of any set of months and instruments are the
+values from the raw rows:
+
+    store = SummaryStore()
+    store.add_files(uploaded_files)                   # see add_files for files that are skipped
+    summary = analysis.PeriodSummary(store.aggregates())
+
+Loading a summary reads one row per month and distinct diameter, which grows with the number of months
+but not with the number of results in each.
+
+Rows are not identified, so results added twice are counted twice. Files with the same contents are
+only added once, and add_files skips files whose dates overlap a stored file of the same instrument
+(e.g. an export that repeats earlier days, or the same results as CSV and as Parquet) unless asked
+to add them. The counts of each file are kept, so a file added by mistake can be removed again with
+remove_batch. Every row is counted, so "first punch for each sample ID" still needs the original files.
+
+The stored files can be listed, and removed, from the command line:
+
+    python summary_store.py                 # list the stored files
+    python summary_store.py --remove 3      # remove the file with id 3
+'''
+
+import os
+import sys
+import time
+import argparse
+import sqlite3
+import hashlib
+import threading
+
+import numpy as np
+import pandas as pd
+
+from analysis import MonthlyAggregates, CLASS_COLUMNS, dbs_classes, month_codes
+from results_io import iter_results_chunks, to_results_types, ANALYSIS_COLUMNS
+
+DEFAULT_STORE_PATH = os.environ.get(
+    'DBSVISION_SUMMARY_STORE', os.path.join(os.path.expanduser('~'), '.cache', 'dbsvision', 'summaries.sqlite'))
+
+# Columns read from results files
+STORE_COLUMNS = ANALYSIS_COLUMNS + ['mm_per_pixel']
+
+# Instrument key of results without a mm per pixel
+UNKNOWN_INSTRUMENT = 0.0
+
+# Version of the database layout, stored as the SQLite user_version
+SCHEMA_VERSION = 3
+
+# Outcomes of add_files for each file
+ADDED = 'added'
+ALREADY_ADDED = 'already added'
+OVERLAPPING = 'overlapping'
+
+
+def file_key(file):
+    '''
+    Key identifying the contents of a results file (path or file object, e.g. a Streamlit UploadedFile)
+    '''
+
+    h = hashlib.sha256()
+
+    if isinstance(file, str):
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    else:
+        h.update(file.getvalue() if hasattr(file, 'getvalue') else file.read())
+
+    return h.hexdigest()
+
+
+def instrument_keys(mm_per_pixel):
+    ''' Instrument keys of an array of mm per pixel values, UNKNOWN_INSTRUMENT where missing
+    '''
+    return np.nan_to_num(np.asarray(mm_per_pixel, dtype=float).round(6), nan=UNKNOWN_INSTRUMENT)
+
+
+def batch_counts(df):
+    '''
+    Counts of a chunk of results with STORE_COLUMNS, as (classes, diameters, (first, last)):
+
+    classes: DataFrame indexed by (instrument, month) with CLASS_COLUMNS counts
+    diameters: Series indexed by (instrument, month, diameter) with the number of results of each diameter
+    first, last: earliest and latest datetime (NaT if no result has one)
+    '''
+
+    df = to_results_types(df)
+    instruments = instrument_keys(df['mm_per_pixel'])
+    months = month_codes(df['datetime'])
+    acceptable, small, multispot = dbs_classes(df)
+
+    classes = pd.DataFrame({'instrument': instruments, 'month': months, 'total': 1, 'acceptable': acceptable,
+                            'small': small, 'multispotted': multispot})
+    classes = classes.astype({column: np.int64 for column in CLASS_COLUMNS})
+    classes = classes.groupby(['instrument', 'month']).sum()
+
+    diam = df['equiv_diam_mm'].to_numpy(dtype=float)
+    measured = ~np.isnan(diam)
+    diameters = pd.Series(1, index=pd.MultiIndex.from_arrays(
+        [instruments[measured], months[measured], diam[measured]], names=['instrument', 'month', 'diameter']))
+    diameters = diameters.groupby(level=[0, 1, 2]).sum()
+
+    return classes, diameters, (df['datetime'].min(), df['datetime'].max())
+
+
+def _time_value(timestamp):
+    # nanoseconds since the epoch of a timestamp, None for NaT
+    return None if pd.isna(timestamp) else pd.Timestamp(timestamp).value
+
+
+class SummaryStore:
+    '''
+    Counts of results by instrument and month, stored in a SQLite database (see the module docstring)
+
+    A single instance can be shared between threads.
+    '''
+
+    def __init__(self, path=DEFAULT_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        tables = self._conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table'").fetchone()[0]
+        if tables and version != SCHEMA_VERSION:
+            self._conn.close()
+            raise ValueError(f"Summary store {path} was written by another version of the app. "
+                             "Delete it and add the results files again")
+
+        # classes and diameters hold the totals of all batches, so summaries are loaded without adding
+        # up batches. batch_classes and batch_diameters hold the counts of each batch, for remove_batch
+        self._conn.executescript(f"""
+            CREATE TABLE IF NOT EXISTS batches (
+                id INTEGER PRIMARY KEY, key TEXT UNIQUE, name TEXT, rows INTEGER NOT NULL,
+                first INTEGER, last INTEGER, added REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS classes (
+                instrument REAL NOT NULL, month INTEGER NOT NULL, total INTEGER NOT NULL,
+                acceptable INTEGER NOT NULL, small INTEGER NOT NULL, multispotted INTEGER NOT NULL,
+                PRIMARY KEY (instrument, month));
+            CREATE TABLE IF NOT EXISTS diameters (
+                instrument REAL NOT NULL, month INTEGER NOT NULL, diameter REAL NOT NULL, count INTEGER NOT NULL,
+                PRIMARY KEY (instrument, month, diameter));
+            CREATE TABLE IF NOT EXISTS batch_classes (
+                batch INTEGER NOT NULL, instrument REAL NOT NULL, month INTEGER NOT NULL, total INTEGER NOT NULL,
+                acceptable INTEGER NOT NULL, small INTEGER NOT NULL, multispotted INTEGER NOT NULL,
+                PRIMARY KEY (batch, instrument, month));
+            CREATE TABLE IF NOT EXISTS batch_diameters (
+                batch INTEGER NOT NULL, instrument REAL NOT NULL, month INTEGER NOT NULL, diameter REAL NOT NULL,
+                count INTEGER NOT NULL, PRIMARY KEY (batch, instrument, month, diameter));
+            PRAGMA user_version = {SCHEMA_VERSION};
+        """)
+
+    def add(self, df, key=None, name=None, skip_overlapping=False):
+        '''
+        Add the counts of a DataFrame of results with STORE_COLUMNS. See add_chunks
+        '''
+        return self.add_chunks([df], key=key, name=name, skip_overlapping=skip_overlapping)
+
+    def add_chunks(self, chunks, key=None, name=None, skip_overlapping=False):
+        '''
+        Add the counts of results read in chunks (see results_io.iter_results_chunks) as one batch
+
+        key: optional key of the batch (e.g. file_key). A batch with a key that has already been added
+             is skipped, so the same file is not counted twice
+        name: name of the batch shown by batches() (e.g. the file name)
+        skip_overlapping: do not add the batch if its dates overlap a stored batch of the same instrument
+
+        Returns (outcome, overlapping) where outcome is ADDED, ALREADY_ADDED or OVERLAPPING and overlapping
+        is a DataFrame of the stored batches whose dates overlap this one (see batches)
+        '''
+
+        no_batches = self._batches(" WHERE 0")
+
+        # saves reading a file that has already been added. The key is checked again when it is inserted
+        if key is not None and self.has_batch(key):
+            return ALREADY_ADDED, no_batches
+
+        classes, diameters, firsts, lasts = [], [], [], []
+        for chunk in chunks:
+            chunk_classes, chunk_diameters, (first, last) = batch_counts(chunk)
+            classes.append(chunk_classes)
+            diameters.append(chunk_diameters)
+            firsts.append(first)
+            lasts.append(last)
+
+        if not classes:
+            return ADDED, no_batches
+
+        classes = pd.concat(classes).groupby(level=[0, 1]).sum()
+        diameters = pd.concat(diameters).groupby(level=[0, 1, 2]).sum()
+        first = _time_value(pd.Series(firsts, dtype='datetime64[ns]').min())
+        last = _time_value(pd.Series(lasts, dtype='datetime64[ns]').max())
+
+        instruments = classes.index.get_level_values('instrument').unique()
+
+        # the overlap check and the insert are one write transaction, so two sessions (or processes) adding
+        # overlapping files at the same time cannot both pass the check
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if key is not None and self._has_batch(key):
+                    self._conn.execute("ROLLBACK")
+                    return ALREADY_ADDED, no_batches
+
+                overlapping = self._read_batches(*self._overlapping_where(first, last, instruments))
+                if skip_overlapping and len(overlapping):
+                    self._conn.execute("ROLLBACK")
+                    return OVERLAPPING, overlapping
+
+                added = self._conn.execute(
+                    "INSERT INTO batches (key, name, rows, first, last, added) VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, name, int(classes['total'].sum()), first, last, time.time()))
+
+                self._write(added.lastrowid, classes, diameters)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        return ADDED, overlapping
+
+    def _write(self, batch, classes, diameters):
+        # record the counts of a batch and add them to the totals
+        class_rows = [(float(i), int(m), *map(int, counts))
+                      for (i, m), counts in zip(classes.index, classes[CLASS_COLUMNS].to_numpy())]
+        diameter_rows = [(float(i), int(m), float(d), int(count)) for (i, m, d), count in diameters.items()]
+
+        self._conn.executemany(
+            "INSERT INTO batch_classes (batch, instrument, month, total, acceptable, small, multispotted) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)", [(batch, *row) for row in class_rows])
+        self._conn.executemany(
+            "INSERT INTO batch_diameters (batch, instrument, month, diameter, count) VALUES (?, ?, ?, ?, ?)",
+            [(batch, *row) for row in diameter_rows])
+
+        self._add_totals(class_rows, diameter_rows)
+
+    def _add_totals(self, class_rows, diameter_rows):
+        # add (or, with negative counts, subtract) counts to the totals. Rows are updated through their
+        # primary keys, so this grows with the size of the batch, not of the history
+        self._conn.executemany(
+            "INSERT INTO classes (instrument, month, total, acceptable, small, multispotted) "
+            "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (instrument, month) DO UPDATE SET "
+            "total = total + excluded.total, acceptable = acceptable + excluded.acceptable, "
+            "small = small + excluded.small, multispotted = multispotted + excluded.multispotted", class_rows)
+        self._conn.executemany(
+            "INSERT INTO diameters (instrument, month, diameter, count) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (instrument, month, diameter) DO UPDATE SET count = count + excluded.count", diameter_rows)
+
+    def remove_batch(self, batch):
+        '''
+        Remove a batch (its id from batches(), or its key) and subtract its counts from the totals.
+        Returns True if the batch was found
+        '''
+
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                batch_id = int(batch) if isinstance(batch, (int, np.integer)) else None
+                row = self._conn.execute("SELECT id FROM batches WHERE id = ? OR key = ?",
+                                         (batch_id, str(batch))).fetchone()
+                if row is None:
+                    self._conn.execute("ROLLBACK")
+                    return False
+                batch_id = row[0]
+
+                class_rows = self._conn.execute(
+                    "SELECT instrument, month, -total, -acceptable, -small, -multispotted FROM batch_classes "
+                    "WHERE batch = ?", (batch_id,)).fetchall()
+                diameter_rows = self._conn.execute(
+                    "SELECT instrument, month, diameter, -count FROM batch_diameters WHERE batch = ?",
+                    (batch_id,)).fetchall()
+                self._add_totals(class_rows, diameter_rows)
+
+                # drop the totals this batch brought to zero, looked up by the keys that were subtracted
+                self._conn.executemany("DELETE FROM classes WHERE instrument = ? AND month = ? AND total = 0",
+                                       [row[:2] for row in class_rows])
+                self._conn.executemany(
+                    "DELETE FROM diameters WHERE instrument = ? AND month = ? AND diameter = ? AND count = 0",
+                    [row[:3] for row in diameter_rows])
+
+                for table in ('batch_classes', 'batch_diameters'):
+                    self._conn.execute(f"DELETE FROM {table} WHERE batch = ?", (batch_id,))
+                self._conn.execute("DELETE FROM batches WHERE id = ?", (batch_id,))
+
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        return True
+
+    def add_files(self, files, skip_overlapping=True):
+        '''
+        Add results files (paths or file objects, e.g. Streamlit UploadedFiles), one batch per file.
+        Files whose contents have already been added are skipped, and so are files whose dates overlap
+        a stored file of the same instrument, unless skip_overlapping is False
+
+        Returns a list of (file name, outcome, overlapping batches) for each file, see add_chunks
+        '''
+
+        outcomes = []
+        for file in files:
+            name = os.path.basename(file) if isinstance(file, str) else getattr(file, 'name', None)
+            outcome, overlapping = self.add_chunks(iter_results_chunks([file], columns=STORE_COLUMNS),
+                                                   key=file_key(file), name=name, skip_overlapping=skip_overlapping)
+            outcomes.append((name, outcome, overlapping))
+
+        return outcomes
+
+    def _has_batch(self, key):
+        # with the lock held
+        return self._conn.execute("SELECT 1 FROM batches WHERE key = ?", (key,)).fetchone() is not None
+
+    def has_batch(self, key):
+        with self._lock:
+            return self._has_batch(key)
+
+    def _read_batches(self, where="", params=()):
+        # batches selected by an SQL condition, with the lock held
+        rows = self._conn.execute(
+            f"SELECT id, key, name, rows, first, last, added FROM batches{where} ORDER BY id", params).fetchall()
+
+        batches = pd.DataFrame(rows, columns=['id', 'key', 'name', 'rows', 'first', 'last', 'added'])
+        for column in ('first', 'last'):
+            batches[column] = pd.to_datetime(batches[column].astype('Int64'), unit='ns')
+        batches['added'] = pd.to_datetime(batches['added'].astype(float), unit='s').dt.floor('s')
+        return batches
+
+    def _batches(self, where="", params=()):
+        with self._lock:
+            return self._read_batches(where, params)
+
+    def batches(self):
+        '''
+        DataFrame of the stored batches, in the order they were added: id, key, name, rows, first and last
+        (earliest and latest datetime) and added (time added)
+        '''
+        return self._batches()
+
+    def overlapping(self, first, last, instruments):
+        '''
+        DataFrame of the stored batches (see batches) with results of any of instruments whose datetimes
+        overlap [first, last] (timestamps or nanoseconds since the epoch)
+        '''
+        return self._batches(*self._overlapping_where(first, last, instruments))
+
+    def _overlapping_where(self, first, last, instruments):
+        # SQL condition and parameters selecting the batches that overlap, see overlapping
+        first = first if first is None or isinstance(first, int) else _time_value(first)
+        last = last if last is None or isinstance(last, int) else _time_value(last)
+        keys = [float(i) for i in instrument_keys(list(instruments))]
+
+        if first is None or last is None or not keys:
+            return " WHERE 0", ()
+
+        return (f" WHERE first <= ? AND last >= ? AND id IN (SELECT batch FROM batch_classes "
+                f"WHERE instrument IN ({', '.join('?' * len(keys))}))", (last, first, *keys))
+
+    def instruments(self):
+        '''
+        DataFrame of the stored instruments (mm_per_pixel, UNKNOWN_INSTRUMENT if unknown) and their
+        number of results
+        '''
+
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT instrument, SUM(total) FROM classes GROUP BY instrument ORDER BY instrument").fetchall()
+
+        return pd.DataFrame(rows, columns=['mm_per_pixel', 'total'])
+
+    def _where(self, instruments):
+        # SQL condition and parameters selecting instruments (None for all)
+        if instruments is None:
+            return "", ()
+
+        keys = tuple(float(i) for i in instrument_keys(list(instruments)))
+        return f" WHERE instrument IN ({', '.join('?' * len(keys))})", keys
+
+    def aggregates(self, instruments=None):
+        '''
+        analysis.MonthlyAggregates of the stored results of instruments (mm per pixel values, default: all)
+        '''
+
+        where, params = self._where(instruments)
+
+        with self._lock:
+            classes = self._conn.execute(
+                f"SELECT month, SUM(total), SUM(acceptable), SUM(small), SUM(multispotted) FROM classes{where} "
+                "GROUP BY month ORDER BY month", params).fetchall()
+            diameters = self._conn.execute(
+                f"SELECT month, diameter, SUM(count) FROM diameters{where} GROUP BY month, diameter "
+                "ORDER BY month, diameter", params).fetchall()
+
+        aggregates = MonthlyAggregates()
+
+        if classes:
+            classes = np.array(classes, dtype=np.int64)
+            aggregates.classes = pd.DataFrame(classes[:, 1:], index=classes[:, 0], columns=CLASS_COLUMNS)
+
+        if diameters:
+            months, values, counts = zip(*diameters)
+            aggregates.diameters = pd.Series(np.array(counts, dtype=np.int64), index=pd.MultiIndex.from_arrays(
+                [np.array(months, dtype=np.int64), np.array(values, dtype=float)], names=['month', 'diameter']))
+
+        return aggregates
+
+    def __len__(self):
+        ''' Number of stored results
+        '''
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(SUM(total), 0) FROM classes").fetchone()[0]
+
+    @property
+    def n_batches(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM batches").fetchone()[0]
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            for table in ('classes', 'diameters', 'batches', 'batch_classes', 'batch_diameters'):
+                self._conn.execute(f"DELETE FROM {table}")
+            self._conn.execute("COMMIT")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="List or remove the files in the summary store")
+    parser.add_argument('--store', default=DEFAULT_STORE_PATH, help=f"summary store (default: {DEFAULT_STORE_PATH})")
+    parser.add_argument('--remove', nargs='+', type=int, default=[], metavar='ID',
+                        help="remove the files with these ids and subtract their counts")
+    args = parser.parse_args(argv)
+
+    store = SummaryStore(args.store)
+    status = 0
+
+    for batch in args.remove:
+        if store.remove_batch(batch):
+            print(f"Removed file {batch}")
+        else:
+            print(f"No file with id {batch}", file=sys.stderr)
+            status = 1
+
+    batches = store.batches()
+    print(batches.drop(columns='key').to_string(index=False) if len(batches) else "The summary store is empty")
+    print(f"{len(store)} results from {len(batches)} file(s) in {args.store}")
+    store.close()
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())